@@ -0,0 +1,162 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Benchmark training steps/sec with default and tuned CPU placement.
+
+Runs several small training processes side by side, as several notebooks
+would share a node, first with the framework's default thread pools and
+then with each copy sized and pinned to its own slice of the CPUs.
+
+Example:
+    python cpu_benchmark.py --copies 4 --steps 50
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from training import cpu
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--copies', default=2, type=int,
+                        help='number of concurrent training processes')
+    parser.add_argument('--steps', default=50, type=int,
+                        help='training steps timed in each process')
+    parser.add_argument('--warmup', default=5, type=int,
+                        help='untimed steps before the timed ones')
+    parser.add_argument('--batch-size', default=16, type=int)
+    parser.add_argument('--image-size', default=64, type=int)
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--debug', action='store_true')
+    return parser
+
+
+def train(steps, warmup, batch_size, image_size):
+    """Train a small conv net on random data and return its steps/sec."""
+    import numpy as np
+    import tensorflow as tf
+
+    model = tf.keras.Sequential([
+        tf.keras.layers.Input((image_size, image_size, 1)),
+        tf.keras.layers.Conv2D(32, 3, padding='same', activation='relu'),
+        tf.keras.layers.Conv2D(32, 3, padding='same', activation='relu'),
+        tf.keras.layers.Conv2D(3, 1, activation='softmax'),
+    ])
+    model.compile(optimizer='sgd', loss='sparse_categorical_crossentropy')
+
+    x = np.random.random((batch_size, image_size, image_size, 1))
+    y = np.random.randint(3, size=(batch_size, image_size, image_size, 1))
+    for _ in range(warmup):
+        model.train_on_batch(x, y)
+
+    start = time.time()
+    for _ in range(steps):
+        model.train_on_batch(x, y)
+    return steps / (time.time() - start)
+
+
+def run_copies(args, placements):
+    """Run one child per placement concurrently and collect steps/sec.
+
+    A placement of None runs the child with the thread variables unset.
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--child',
+           '--steps', str(args.steps), '--warmup', str(args.warmup),
+           '--batch-size', str(args.batch_size),
+           '--image-size', str(args.image_size)]
+    base_env = {k: v for k, v in os.environ.items()
+                if k not in cpu.THREAD_VARIABLES and k != 'KMP_AFFINITY'}
+
+    procs = []
+    for placement in placements:
+        env, prefix = base_env, []
+        if placement is not None:
+            env = dict(base_env, **placement.env())
+            prefix = placement.command()
+        procs.append(subprocess.Popen(prefix + cmd, env=env,
+                                      stdout=subprocess.PIPE))
+
+    rates = []
+    for proc in procs:
+        output, _ = proc.communicate()
+        if proc.returncode:
+            raise RuntimeError('Benchmark process exited with code {}'.format(
+                proc.returncode))
+        rates.append(json.loads(output.decode('utf-8'))['steps_per_sec'])
+    return {'steps_per_sec': rates, 'total_steps_per_sec': sum(rates)}
+
+
+def get_tuned_placements(copies):
+    """Split this process' CPUs evenly between the copies."""
+    allowed = sorted(cpu.get_allowed_cpus())
+    nodes = cpu.get_numa_nodes()
+    share = max(len(allowed) // copies, 1)
+    placements = []
+    for i in range(copies):
+        cpus = set(allowed[i * share:(i + 1) * share]) or set(allowed)
+        cpus = cpu.choose_cpus(cpus, share, nodes)
+        containing = [n for n, c in nodes.items() if c.issuperset(cpus)]
+        node = containing[0] if containing else None
+        placements.append(cpu.CPUPlacement(share, cpus, node))
+    return placements
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+
+    if args.child:
+        os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+        rate = train(args.steps, args.warmup, args.batch_size,
+                     args.image_size)
+        json.dump({'steps_per_sec': rate}, sys.stdout)
+        sys.exit(0)
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format='[%(levelname)s]:[%(name)s]: %(message)s')
+
+    placements = get_tuned_placements(args.copies)
+    report = {
+        'copies': args.copies,
+        'cpus': cpu.format_cpu_list(cpu.get_allowed_cpus()),
+        'placements': [repr(p) for p in placements],
+        'default': run_copies(args, [None] * args.copies),
+        'tuned': run_copies(args, placements),
+    }
+    report['speedup'] = (report['tuned']['total_steps_per_sec'] /
+                         report['default']['total_steps_per_sec'])
+
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
@@ -0,0 +1,102 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Load test the training job queue against a local redis server.
+
+Example:
+    redis-server --port 6380 --save '' &
+    python loadtest.py --redis-port 6380 --jobs 5000 --workers 50
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import functools
+import json
+import logging
+import sys
+
+from training import job_store
+from training import loadtest
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', default=6379, type=int)
+    parser.add_argument('--jobs', default=1000, type=int,
+                        help='number of synthetic jobs to submit')
+    parser.add_argument('--workers', default=10, type=int,
+                        help='number of simulated workers')
+    parser.add_argument('--sleep', default=0, type=float,
+                        help='seconds each job pretends to train')
+    parser.add_argument('--datasets', default=None, type=int,
+                        help='number of distinct datasets, '
+                             'one per job by default')
+    parser.add_argument('--dataset-size', default=1024, type=int,
+                        help='bytes per dataset')
+    parser.add_argument('--prefix', default='loadtest',
+                        help='key prefix of the synthetic jobs')
+    parser.add_argument('--no-events', dest='events', action='store_false',
+                        help='poll for jobs instead of listening for events')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='prefetch the next job\'s dataset')
+    parser.add_argument('--interval', default=None, type=float,
+                        help='seconds between sweeps or polls for jobs')
+    parser.add_argument('--timeout', default=600, type=float)
+    parser.add_argument('--debug', action='store_true')
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format='[%(levelname)s]:[%(name)s]: %(message)s')
+
+    executor = loadtest.noop_executor
+    if args.sleep:
+        executor = loadtest.SleepExecutor(args.sleep)
+
+    report = loadtest.run_load_test(
+        functools.partial(job_store.get_client, args.redis_host,
+                          args.redis_port),
+        num_jobs=args.jobs,
+        num_workers=args.workers,
+        executor=executor,
+        num_datasets=args.datasets,
+        dataset_size=args.dataset_size,
+        prefix=args.prefix,
+        channel='{}-jobs'.format(args.prefix),
+        events=args.events,
+        prefetch=args.prefetch,
+        interval=args.interval,
+        timeout=args.timeout)
+
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+    sys.exit(0 if report['done'] == args.jobs else 1)
@@ -28,17 +28,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import os
 import sys
-import datetime
 import logging
-import tempfile
-
-from redis import StrictRedis
+import signal
 
+from training import async_storage
+from training import cpu
+from training import dispatch
+from training import job_store
 from training import settings
-from training import storage
-from training import utils
+from training import worker
 
 
 def initialize_logger(debug_mode=False):
@@ -62,61 +61,37 @@ if __name__ == '__main__':
 
     _logger = logging.getLogger(__file__)
 
-    storage_client = storage.get_client(settings.CLOUD_PROVIDER)
-
-    redis = StrictRedis(
-        host=settings.REDIS_HOST,
-        port=settings.REDIS_PORT,
-        decode_responses=True,
-        charset='utf-8')
-
-    training_hash = utils.get_hash_with_status(redis, settings.STATUS)
-
-    if training_hash is None:
-        # could not find a hash with status == STATUS
-        sys.exit(0)
-
-    hash_values = redis.hgetall(training_hash)
-
-    try:
-        with tempfile.TemporaryDirectory() as tempdir:
-            data_path = hash_values.get('file_name')
-            local_path = storage_client.download(data_path, tempdir)
-
-            model_name = '{ts}_{dataset}_{type}_{transform}'.format(
-                ts=datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S'),
-                dataset=os.path.splitext(os.path.basename(local_path))[0],
-                type=hash_values.get('training_type', 'conv'),
-                transform=hash_values.get('transform', 'watershed'))
-
-            notebook_path = utils.make_notebook(
-                local_path,
-                model_name=model_name,
-                **hash_values)
-
-            redis.hmset(training_hash, {
-                'model': model_name,
-                'status': 'training'
-            })
+    # upload exports of many small files concurrently
+    storage_client = async_storage.get_client(settings.CLOUD_PROVIDER)
 
-            _logger.debug('Updated model %s status to "training"', model_name)
+    jobs = job_store.JobStore()
 
-            result = utils.run_notebook(notebook_path)
+    # wake up on job events and only sweep for missed ones occasionally
+    listener = None
+    interval = settings.INTERVAL
+    if settings.DISPATCH_EVENTS and settings.RUN_FOREVER:
+        listener = dispatch.JobListener(jobs)
+        interval = settings.RECONCILE_INTERVAL
 
-            redis.expire(training_hash, 10)
+    # size thread pools to the container, not the host
+    placement = None
+    if settings.TUNE_CPU_THREADS:
+        placement = cpu.CPUPlacement.detect()
+        _logger.info('Using CPU placement %s', placement)
 
-            exit_status = 0
+    training_worker = worker.Worker(
+        jobs,
+        storage_client,
+        prefetch=settings.PREFETCH and settings.RUN_FOREVER,
+        interval=interval,
+        placement=placement,
+        listener=listener)
 
-    except Exception as err:
-        _logger.error('Encountered %s during training: %s',
-                      type(err).__name__, err)
+    signal.signal(signal.SIGTERM, training_worker.stop)
+    signal.signal(signal.SIGINT, training_worker.stop)
 
-        redis.hmset(training_hash, {
-            'reason': '{}'.format(err),
-            'status': 'failed'
-        })
-        redis.expire(training_hash, 10)
-        exit_status = 1
+    success = training_worker.run(forever=settings.RUN_FOREVER)
 
+    exit_status = 0 if success else 1
     _logger.info('Exiting with status: %s', exit_status)
     sys.exit(exit_status)
@@ -28,9 +28,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from training import async_storage
+from training import dispatch
+from training import job_store
 from training import settings
 from training import storage
 from training import utils
+from training import worker
 
 del absolute_import
 del division
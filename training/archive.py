@@ -0,0 +1,261 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Stream directories to and from compressed tar archives"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import logging
+import tarfile
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger('training.archive')
+
+EXTENSIONS = {
+    'zstd': '.tar.zst',
+    'gzip': '.tar.gz',
+    'none': '.tar',
+}
+
+
+def get_compression(compression):
+    """Returns the compression to use, falling back to gzip without zstd."""
+    compression = str(compression).lower()
+    if compression not in EXTENSIONS:
+        raise ValueError('Bad value for compression: {}. Expected one of '
+                         '{}.'.format(compression, list(EXTENSIONS)))
+    if compression == 'zstd' and zstandard is None:
+        logger.warning('`zstandard` is not installed, using gzip instead.')
+        compression = 'gzip'
+    return compression
+
+
+def get_archive_name(name, compression):
+    """Returns the archive filename for the given compression."""
+    return '{}{}'.format(name, EXTENSIONS[compression])
+
+
+def compression_from_path(path):
+    """Infer the compression of an archive from its extension.
+
+    Returns:
+        compression: the compression, or None if path is not an archive
+    """
+    for compression, ext in EXTENSIONS.items():
+        if str(path).endswith(ext):
+            return compression
+    return None
+
+
+def write_archive(directory, fileobj, compression='zstd', threads=-1):
+    """Write a tar archive of directory to fileobj as a stream.
+
+    Args:
+        directory: path to the directory to archive
+        fileobj: writable binary file object, need not be seekable
+        compression: one of "zstd", "gzip" or "none"
+        threads: number of zstd compression threads, -1 for all CPUs
+
+    Returns:
+        manifest: list of [relative path, size in bytes] for each file
+    """
+    manifest = []
+
+    def add_files(tar):
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                arcname = os.path.relpath(path, directory)
+                tar.add(path, arcname=arcname, recursive=False)
+                manifest.append([arcname, os.path.getsize(path)])
+
+    if compression == 'zstd':
+        cctx = zstandard.ZstdCompressor(threads=threads)
+        with cctx.stream_writer(fileobj) as compressor:
+            with tarfile.open(fileobj=compressor, mode='w|') as tar:
+                add_files(tar)
+    else:
+        mode = 'w|gz' if compression == 'gzip' else 'w|'
+        with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+            add_files(tar)
+    return manifest
+
+
+def _is_safe(member, dest):
+    path = os.path.realpath(os.path.join(dest, member.name))
+    return path.startswith(os.path.realpath(dest) + os.sep) and \
+        (member.isfile() or member.isdir())
+
+
+def extract_archive(fileobj, dest, compression='zstd'):
+    """Extract a tar archive streamed from fileobj into dest.
+
+    Only regular files and directories inside dest are extracted.
+
+    Args:
+        fileobj: readable binary file object, need not be seekable
+        dest: path to the directory to extract into
+        compression: one of "zstd", "gzip" or "none"
+
+    Returns:
+        paths: list of the extracted file paths
+    """
+    paths = []
+
+    def extract(tar):
+        for member in tar:
+            if not _is_safe(member, dest):
+                logger.warning('Skipping unsafe archive member %s.',
+                               member.name)
+                continue
+            tar.extract(member, dest)
+            if member.isfile():
+                paths.append(os.path.join(dest, member.name))
+
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('Extracting zstd archives requires `zstandard`.')
+        dctx = zstandard.ZstdDecompressor()
+        with dctx.stream_reader(fileobj) as reader:
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                extract(tar)
+    else:
+        mode = 'r|gz' if compression == 'gzip' else 'r|'
+        with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+            extract(tar)
+    return paths
+
+
+class PipeReader(object):
+    """Readable end of a pipe that keeps track of its position.
+
+    Upload clients call tell() on their input, which a raw pipe does
+    not support.
+
+    Args:
+        fileobj: readable end of the pipe
+        on_eof: function called at the end of the stream, which may raise
+            to keep a truncated stream from being taken as complete
+    """
+
+    def __init__(self, fileobj, on_eof=None):
+        self.fileobj = fileobj
+        self.on_eof = on_eof
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        if not data and size != 0 and self.on_eof is not None:
+            self.on_eof()
+        return data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.fileobj.close()
+
+
+class StreamPipe(object):
+    """Connect a producer that writes a stream to a consumer that reads it.
+
+    The producer runs in a background thread, so nothing is staged on
+    disk and at most a pipe buffer of data is held in memory.
+
+    Args:
+        producer: function taking a writable file object
+    """
+
+    def __init__(self, producer):
+        self.producer = producer
+        self.result = None
+        self.error = None
+        self._thread = None
+
+    def _produce(self, writer):
+        try:
+            self.result = self.producer(writer)
+        except Exception as err:  # pylint: disable=broad-except
+            self.error = err
+        finally:
+            # the error is recorded before the reader can see EOF
+            try:
+                writer.close()
+            except Exception as err:  # pylint: disable=broad-except
+                self.error = self.error or err
+
+    def _check_producer(self):
+        """Raise the producer's error once the stream has ended."""
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def consume(self, consumer):
+        """Run consumer on the readable end of the pipe.
+
+        If the producer fails, reading the end of the stream raises its
+        error, so an upload is aborted instead of committing a truncated
+        stream.
+
+        Args:
+            consumer: function taking a readable file object
+
+        Returns:
+            the values returned by the consumer and the producer
+        """
+        read_fd, write_fd = os.pipe()
+        reader = PipeReader(os.fdopen(read_fd, 'rb'),
+                            on_eof=self._check_producer)
+        writer = os.fdopen(write_fd, 'wb')
+        self._thread = threading.Thread(target=self._produce, args=(writer,))
+        self._thread.daemon = True
+        self._thread.start()
+        try:
+            value = consumer(reader)
+            # drain the pipe in case the consumer stopped early
+            while reader.read(64 * 1024):
+                pass
+        finally:
+            reader.close()
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return value, self.result
@@ -0,0 +1,171 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for streaming archive helpers"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import tarfile
+import tempfile
+
+import pytest
+
+from training import archive
+
+
+COMPRESSIONS = ['gzip', 'none']
+if archive.zstandard is not None:
+    COMPRESSIONS.append('zstd')
+
+
+def _make_tree(root):
+    os.makedirs(os.path.join(root, 'models', '1'))
+    files = {
+        'notebook.ipynb': b'{}',
+        os.path.join('models', '1', 'saved_model.pb'): b'x' * 1000,
+    }
+    for name, content in files.items():
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(content)
+    return files
+
+
+def test_get_compression():
+    assert archive.get_compression('GZIP') == 'gzip'
+    assert archive.get_compression('none') == 'none'
+    expected = 'gzip' if archive.zstandard is None else 'zstd'
+    assert archive.get_compression('zstd') == expected
+    with pytest.raises(ValueError):
+        archive.get_compression('bad_value')
+
+
+def test_compression_from_path():
+    assert archive.compression_from_path('a/b.tar.zst') == 'zstd'
+    assert archive.compression_from_path('a/b.tar.gz') == 'gzip'
+    assert archive.compression_from_path('a/b.tar') == 'none'
+    assert archive.compression_from_path('a/b.npz') is None
+    assert archive.get_archive_name('b', 'gzip') == 'b.tar.gz'
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_roundtrip(compression):
+    with tempfile.TemporaryDirectory() as src:
+        files = _make_tree(src)
+        buf = io.BytesIO()
+        manifest = archive.write_archive(src, buf, compression)
+        assert sorted(manifest) == sorted(
+            [k, len(v)] for k, v in files.items())
+
+        buf.seek(0)
+        with tempfile.TemporaryDirectory() as dest:
+            paths = archive.extract_archive(buf, dest, compression)
+            assert len(paths) == len(files)
+            for name, content in files.items():
+                with open(os.path.join(dest, name), 'rb') as f:
+                    assert f.read() == content
+
+
+def test_extract_skips_unsafe_members():
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name in ('../escape.txt', 'safe.txt'):
+            info = tarfile.TarInfo(name)
+            info.size = 3
+            tar.addfile(info, io.BytesIO(b'abc'))
+    buf.seek(0)
+    with tempfile.TemporaryDirectory() as tempdir:
+        dest = os.path.join(tempdir, 'dest')
+        paths = archive.extract_archive(buf, dest, 'none')
+        assert paths == [os.path.join(dest, 'safe.txt')]
+        assert not os.path.exists(os.path.join(tempdir, 'escape.txt'))
+
+
+class TestStreamPipe(object):
+
+    def test_consume(self):
+        data = os.urandom(1024 * 1024)
+
+        def producer(fileobj):
+            for i in range(0, len(data), 1000):
+                fileobj.write(data[i:i + 1000])
+            return 'produced'
+
+        def consumer(fileobj):
+            chunks = []
+            chunk = fileobj.read(4096)
+            while chunk:
+                chunks.append(chunk)
+                chunk = fileobj.read(4096)
+            assert fileobj.tell() == len(data)
+            return b''.join(chunks)
+
+        value, result = archive.StreamPipe(producer).consume(consumer)
+        assert value == data
+        assert result == 'produced'
+
+    def test_consumer_stops_early(self):
+        def producer(fileobj):
+            fileobj.write(b'x' * 1024 * 1024)
+
+        value, _ = archive.StreamPipe(producer).consume(lambda f: f.read(10))
+        assert value == b'x' * 10
+
+    def test_producer_error(self):
+        def producer(fileobj):
+            fileobj.write(b'abc')
+            raise ValueError('thrown-on-purpose')
+
+        with pytest.raises(ValueError):
+            archive.StreamPipe(producer).consume(lambda f: f.read())
+
+    def test_producer_error_aborts_consumer(self):
+        def producer(fileobj):
+            fileobj.write(b'x' * 100 * 1024)
+            raise IOError('file vanished')
+
+        committed = []
+
+        def consumer(fileobj):
+            # an upload only commits once it has read to the end
+            while fileobj.read(4096):
+                pass
+            committed.append(fileobj.tell())
+
+        with pytest.raises(IOError):
+            archive.StreamPipe(producer).consume(consumer)
+        assert not committed
+
+    def test_consumer_error(self):
+        def producer(fileobj):
+            fileobj.write(b'x' * 1024 * 1024)
+
+        def consumer(_):
+            raise ZeroDivisionError('thrown-on-purpose')
+
+        with pytest.raises(ZeroDivisionError):
+            archive.StreamPipe(producer).consume(consumer)
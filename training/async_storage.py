@@ -0,0 +1,476 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Asyncio storage interface for transferring many small files at once"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import logging
+import os
+import posixpath
+import timeit
+
+try:
+    from aiobotocore import session as aiobotocore_session
+except ImportError:
+    aiobotocore_session = None
+
+try:
+    import aiohttp
+    from gcloud.aio import storage as gcloud_storage
+except ImportError:
+    aiohttp = None
+    gcloud_storage = None
+
+from training import checksum
+from training import settings
+from training import storage
+from training.settings import DOWNLOAD_DIR
+
+
+def run_sync(coro):
+    """Run a coroutine to completion from synchronous code.
+
+    Args:
+        coro: the coroutine to run
+
+    Returns:
+        the value returned by the coroutine
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def get_client(cloud_provider):
+    """Returns the AsyncStorage Client appropriate for the cloud provider
+
+    Falls back to the synchronous Storage client if the provider's asyncio
+    library is not installed.
+
+    # Arguments:
+        cloud_provider: Indicates which cloud platform (AWS vs GKE)
+    # Returns:
+        storage_client: Client for interacting with the cloud.
+    """
+    cloud_provider = str(cloud_provider).lower()
+    if cloud_provider == 'aws':
+        client_cls = AsyncS3Storage
+        bucket = settings.AWS_S3_BUCKET
+        available = aiobotocore_session is not None
+    elif cloud_provider == 'gke':
+        client_cls = AsyncGoogleStorage
+        bucket = settings.GCLOUD_STORAGE_BUCKET
+        available = gcloud_storage is not None
+    else:
+        raise ValueError('Bad value for CLOUD_PROVIDER: %s' % cloud_provider)
+
+    if not available:
+        logging.getLogger('async_storage.get_client').warning(
+            'The asyncio client for %s is not installed, transferring one '
+            'file at a time.', cloud_provider)
+        return storage.get_client(cloud_provider)
+    return client_cls(bucket)
+
+
+class AsyncStorage(storage.Storage):
+    """Asynchronous counterpart to Storage for many concurrent transfers.
+
+    All transfers made within one ``async with`` block share a single
+    HTTP session, and at most ``concurrency`` run at once.  The batch
+    methods (``upload_many``, ``download_many``, ``upload_tree``, ...) run
+    the coroutines in a private event loop, so callers do not need to be
+    async themselves.
+
+    The concrete clients also inherit from the matching Storage client,
+    which provides the single file transfers: streamed, resumable and
+    checksum-verified, so that large datasets are not held in memory.
+
+    Args:
+        bucket: cloud storage bucket name
+        download_dir: path to local directory to save downloaded files
+        backoff: seconds to wait before retrying a transient error
+        concurrency: maximum number of simultaneous transfers
+    """
+
+    def __init__(self, bucket, download_dir=DOWNLOAD_DIR, backoff=1.5,
+                 concurrency=settings.STORAGE_CONCURRENCY, **kwargs):
+        super(AsyncStorage, self).__init__(
+            bucket, download_dir, backoff, **kwargs)
+        self.concurrency = concurrency
+        self._semaphore = None
+
+    async def open(self):
+        """Open the shared session."""
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def close(self):
+        """Close the shared session."""
+        self._semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    def is_transient(self, err):
+        """Returns True if the error is safe to retry."""
+        return isinstance(err, self.transient_errors)
+
+    async def _with_retries_async(self, func, *args):
+        failures = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    return await func(*args)
+            except Exception as err:  # pylint: disable=broad-except
+                if not self.is_transient(err):
+                    raise err
+                failures += 1
+                if failures > self.retries:
+                    raise err
+                self.logger.warning('Encountered %s: %s.  Backing off for %s '
+                                    'seconds...', type(err).__name__, err,
+                                    self.backoff)
+                await asyncio.sleep(self.backoff)
+
+    async def upload_file(self, filepath, dest):
+        """Upload a local file to the given key.
+
+        Args:
+            filepath: local path to file to upload
+            dest: key of the file in cloud storage
+
+        Returns:
+            url: public URL of the uploaded file
+        """
+        raise NotImplementedError
+
+    async def download_file(self, filepath, dest):
+        """Download the given key to a local file.
+
+        Args:
+            filepath: key of file in cloud storage to download
+            dest: local path to save the file
+        """
+        raise NotImplementedError
+
+    async def upload_async(self, filepath, subdir=None, dest=None):
+        """Upload a file to the cloud storage bucket.
+
+        Args:
+            filepath: local path to file to upload
+            subdir: optional folder inside the output directory
+            dest: key of the file in cloud storage, overrides subdir
+
+        Returns:
+            dest: key of uploaded file in cloud storage
+            url: public URL of the uploaded file
+        """
+        start = timeit.default_timer()
+        if dest is None:
+            dest = self.get_upload_path(filepath, subdir)
+        try:
+            url = await self._with_retries_async(self.upload_file, filepath, dest)
+            self._record_upload(filepath, dest)
+            self.logger.debug('Uploaded %s to bucket %s in %s seconds.',
+                              filepath, self.bucket,
+                              timeit.default_timer() - start)
+            return dest, url
+        except Exception as err:
+            self.logger.error('Encountered %s: %s while uploading %s.',
+                              type(err).__name__, err, filepath)
+            raise err
+
+    async def download_async(self, filepath, download_dir=None, dest=None):
+        """Download a file from the cloud storage bucket.
+
+        Args:
+            filepath: key of file in cloud storage to download
+            download_dir: path to directory to save file
+            dest: local path to save the file, overrides download_dir
+
+        Returns:
+            dest: local path to downloaded file
+        """
+        start = timeit.default_timer()
+        if filepath.startswith('/'):
+            filepath = filepath[1:]
+        if dest is None:
+            dest = self.get_download_path(filepath, download_dir)
+        elif not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            await self._with_retries_async(self.download_file, filepath, dest)
+            self.logger.debug('Downloaded %s from bucket %s in %s seconds.',
+                              dest, self.bucket,
+                              timeit.default_timer() - start)
+            return dest
+        except Exception as err:
+            self.logger.error('Encountered %s: %s while downloading %s.',
+                              type(err).__name__, err, filepath)
+            raise err
+
+    async def upload_many_async(self, filepaths, subdir=None):
+        """Upload many files concurrently.
+
+        Returns:
+            list of (dest, url) in the same order as filepaths
+        """
+        return await asyncio.gather(
+            *[self.upload_async(f, subdir) for f in filepaths])
+
+    async def download_many_async(self, filepaths, download_dir=None):
+        """Download many files concurrently.
+
+        Returns:
+            list of local paths in the same order as filepaths
+        """
+        return await asyncio.gather(
+            *[self.download_async(f, download_dir) for f in filepaths])
+
+    async def upload_directory_async(self, directory, subdir=None):
+        """Upload every file in directory, keeping the folder structure.
+
+        Args:
+            directory: local path to the directory to upload
+            subdir: optional folder inside the output directory
+
+        Returns:
+            list of (dest, url) for each uploaded file
+        """
+        name = os.path.basename(os.path.normpath(directory))
+        prefix = os.path.join(subdir, name) if subdir else name
+        uploads = []
+        for root, _, files in os.walk(directory):
+            relroot = os.path.relpath(root, directory)
+            folder = os.path.normpath(os.path.join(prefix, relroot))
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                uploads.append(self.upload_async(path, subdir=folder))
+        return await asyncio.gather(*uploads)
+
+    async def upload_tree_async(self, directory, prefix, dedupe=True):
+        """Upload every file in directory under prefix concurrently.
+
+        Args:
+            directory: local path to the directory to upload
+            prefix: key prefix of the uploaded files
+            dedupe: if True, skip files identical to the ones already at
+                their destination
+
+        Returns:
+            list of the keys of the uploaded files
+        """
+        loop = asyncio.get_event_loop()
+
+        async def upload(path, dest):
+            if dedupe:
+                async with self._semaphore:
+                    duplicate = await loop.run_in_executor(
+                        None, self.is_duplicate, path, dest)
+                if duplicate:
+                    self._record_upload(path, dest, skipped=True)
+                    return
+            await self.upload_async(path, dest=dest)
+
+        keys, uploads = [], []
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                relpath = os.path.relpath(path, directory)
+                dest = posixpath.join(prefix, relpath.replace(os.sep, '/'))
+                keys.append(dest)
+                uploads.append(upload(path, dest))
+        await asyncio.gather(*uploads)
+        self.logger.debug('Uploaded %s files from %s to %s.',
+                          len(keys), directory, prefix)
+        return keys
+
+    async def _session_scope(self, coro_func, *args):
+        async with self:
+            return await coro_func(*args)
+
+    def upload_many(self, filepaths, subdir=None):
+        """Synchronous shim for upload_many_async."""
+        return run_sync(self._session_scope(
+            self.upload_many_async, filepaths, subdir))
+
+    def download_many(self, filepaths, download_dir=None):
+        """Synchronous shim for download_many_async."""
+        return run_sync(self._session_scope(
+            self.download_many_async, filepaths, download_dir))
+
+    def upload_directory(self, directory, subdir=None):
+        """Synchronous shim for upload_directory_async."""
+        return run_sync(self._session_scope(
+            self.upload_directory_async, directory, subdir))
+
+    def upload_tree(self, directory, prefix, dedupe=True):
+        """Synchronous shim for upload_tree_async."""
+        return run_sync(self._session_scope(
+            self.upload_tree_async, directory, prefix, dedupe))
+
+
+class AsyncS3Storage(AsyncStorage, storage.S3Storage):
+    """Interact with Amazon S3 buckets using aiobotocore.
+
+    Args:
+        bucket: cloud storage bucket name
+        download_dir: path to local directory to save downloaded files
+    """
+
+    transient_errors = storage.S3Storage.transient_errors + (
+        asyncio.TimeoutError,
+    )
+
+    def __init__(self, bucket, download_dir=DOWNLOAD_DIR, backoff=1.5,
+                 **kwargs):
+        super(AsyncS3Storage, self).__init__(
+            bucket, download_dir, backoff, **kwargs)
+        self._context = None
+        self._client = None
+
+    async def open(self):
+        if aiobotocore_session is None:
+            raise ImportError('AsyncS3Storage requires `aiobotocore`.')
+        await super(AsyncS3Storage, self).open()
+        session = aiobotocore_session.get_session()
+        self._context = session.create_client(
+            's3',
+            region_name=settings.AWS_REGION,
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
+        self._client = await self._context.__aenter__()
+
+    async def close(self):
+        if self._context is not None:
+            await self._context.__aexit__(None, None, None)
+        self._context = self._client = None
+        await super(AsyncS3Storage, self).close()
+
+    async def upload_file(self, filepath, dest):
+        if os.path.getsize(filepath) > self.chunk_size:
+            # stream large files with the multipart transfer of the sync
+            # client rather than holding them in memory
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                None, self._upload_multipart, filepath, dest)
+        with open(filepath, 'rb') as f:
+            body = f.read()
+        await self._client.put_object(Bucket=self.bucket, Key=dest, Body=body)
+        return self.get_public_url(dest)
+
+    def _upload_multipart(self, filepath, dest):
+        digest = checksum.file_digest(filepath, 'md5', self.chunk_size)
+        # multipart ETags are not the MD5, so save it as metadata
+        extra_args = {'Metadata': {'md5': checksum.encode_hex(digest)}}
+        self.get_storage_client().upload_file(
+            filepath, self.bucket, dest, ExtraArgs=extra_args)
+        return self.get_public_url(dest)
+
+    async def download_file(self, filepath, dest):
+        response = await self._client.get_object(
+            Bucket=self.bucket, Key=filepath)
+        async with response['Body'] as stream:
+            body = await stream.read()
+
+        # the ETag is the MD5 of the content for single part uploads
+        etag = str(response.get('ETag', '')).strip('"')
+        if etag and '-' not in etag and \
+                response.get('ServerSideEncryption') != 'aws:kms':
+            hasher = checksum.get_hasher('md5')
+            hasher.update(body)
+            if hasher.digest() != checksum.decode_hex(etag):
+                raise storage.StorageException(
+                    'md5 checksum mismatch for {}.'.format(filepath))
+
+        with open(dest, 'wb') as f:
+            f.write(body)
+
+
+class AsyncGoogleStorage(AsyncStorage, storage.GoogleStorage):
+    """Interact with Google Cloud Storage buckets using gcloud-aio-storage.
+
+    Args:
+        bucket: cloud storage bucket name
+        download_dir: path to local directory to save downloaded files
+    """
+
+    transient_errors = storage.GoogleStorage.transient_errors + (
+        asyncio.TimeoutError,
+    )
+    if aiohttp is not None:
+        transient_errors += (aiohttp.ClientConnectionError,)
+
+    # HTTP status codes worth retrying: rate limits and server errors
+    transient_status_codes = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, bucket, download_dir=DOWNLOAD_DIR, backoff=1.5,
+                 **kwargs):
+        super(AsyncGoogleStorage, self).__init__(
+            bucket, download_dir, backoff, **kwargs)
+        self.bucket_url = 'storage.googleapis.com/{}'.format(bucket)
+        self._session = None
+        self._client = None
+
+    def get_public_url(self, filepath):
+        return 'https://{url}/{obj}'.format(url=self.bucket_url, obj=filepath)
+
+    def is_transient(self, err):
+        if aiohttp is not None and \
+                isinstance(err, aiohttp.ClientResponseError):
+            return err.status in self.transient_status_codes
+        return super(AsyncGoogleStorage, self).is_transient(err)
+
+    async def open(self):
+        if gcloud_storage is None:
+            raise ImportError('AsyncGoogleStorage requires '
+                              '`gcloud-aio-storage`.')
+        await super(AsyncGoogleStorage, self).open()
+        self._session = aiohttp.ClientSession()
+        self._client = gcloud_storage.Storage(session=self._session)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        self._session = self._client = None
+        await super(AsyncGoogleStorage, self).close()
+
+    async def upload_file(self, filepath, dest):
+        await self._client.upload_from_filename(
+            self.bucket, dest, filepath,
+            parameters={'predefinedAcl': 'publicRead'})
+        return self.get_public_url(dest)
+
+    async def download_file(self, filepath, dest):
+        await self._client.download_to_filename(self.bucket, filepath, dest)
@@ -0,0 +1,275 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the AsyncStorage classes"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import hashlib
+import os
+import tempfile
+
+from botocore.exceptions import EndpointConnectionError
+
+import pytest
+
+from training import async_storage
+from training import storage
+
+
+class DummyAsyncStorage(async_storage.AsyncStorage):
+    """Stores files in memory, failing the first ``fail_tolerance`` calls."""
+
+    transient_errors = (EndpointConnectionError,)
+
+    def __init__(self, *args, **kwargs):
+        super(DummyAsyncStorage, self).__init__(*args, **kwargs)
+        self.objects = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.fail_tolerance = 0
+        self.fail_count = 0
+        self.opened = 0
+
+    async def open(self):
+        await super(DummyAsyncStorage, self).open()
+        self.opened += 1
+
+    async def _transfer(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.in_flight, self.max_in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        if self.fail_count < self.fail_tolerance:
+            self.fail_count += 1
+            raise EndpointConnectionError(endpoint_url='thrown-on-purpose')
+
+    async def upload_file(self, filepath, dest):
+        await self._transfer()
+        with open(filepath, 'rb') as f:
+            self.objects[dest] = f.read()
+        return 'url/{}'.format(dest)
+
+    async def download_file(self, filepath, dest):
+        await self._transfer()
+        if filepath not in self.objects:
+            raise storage.StorageException(filepath)
+        with open(dest, 'wb') as f:
+            f.write(self.objects[filepath])
+
+    def get_object_info(self, filepath):
+        if filepath not in self.objects:
+            raise storage.StorageException(filepath)
+        content = self.objects[filepath]
+        return len(content), {'md5': hashlib.md5(content).digest()}
+
+    def upload(self, filepath, subdir=None, dedupe=False):
+        return async_storage.run_sync(self._session_scope(
+            self.upload_async, filepath, subdir))
+
+
+def _make_files(root, count):
+    paths = []
+    for i in range(count):
+        folder = os.path.join(root, 'src', str(i % 3))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, 'file_{}.txt'.format(i))
+        with open(path, 'wb') as f:
+            f.write(str(i).encode())
+        paths.append(path)
+    return paths
+
+
+def test_run_sync():
+    async def add(a, b):
+        await asyncio.sleep(0)
+        return a + b
+
+    assert async_storage.run_sync(add(1, 2)) == 3
+
+
+def test_get_client(monkeypatch):
+    monkeypatch.setattr(async_storage, 'aiobotocore_session', object())
+    monkeypatch.setattr(async_storage, 'gcloud_storage', object())
+    aws = async_storage.get_client('AWS')
+    assert isinstance(aws, async_storage.AsyncS3Storage)
+    # single file transfers are inherited from the sync client
+    assert isinstance(aws, storage.S3Storage)
+    gke = async_storage.get_client('gke')
+    assert isinstance(gke, async_storage.AsyncGoogleStorage)
+    assert isinstance(gke, storage.GoogleStorage)
+    with pytest.raises(ValueError):
+        async_storage.get_client('bad_value')
+
+    # without the asyncio libraries, fall back to the sync clients
+    monkeypatch.setattr(async_storage, 'aiobotocore_session', None)
+    monkeypatch.setattr(async_storage, 'gcloud_storage', None)
+    aws = async_storage.get_client('aws')
+    assert type(aws) is storage.S3Storage
+    gke = async_storage.get_client('gke')
+    assert type(gke) is storage.GoogleStorage
+
+
+class TestAsyncStorage(object):
+
+    def test_upload_and_download_many(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            paths = _make_files(tempdir, 20)
+            stg = DummyAsyncStorage('test-bucket', tempdir, backoff=0,
+                                    concurrency=4)
+
+            results = stg.upload_many(paths, subdir='abc')
+            assert stg.max_in_flight == 4
+            assert stg.opened == 1  # one shared session
+            assert [r[0] for r in results] == [
+                'output/abc/{}'.format(os.path.basename(p)) for p in paths]
+            assert stg.stats['files_uploaded'] == 20
+
+            keys = [r[0] for r in results]
+            local = stg.download_many(keys, os.path.join(tempdir, 'dl'))
+            for path, dest in zip(paths, local):
+                with open(path, 'rb') as f1, open(dest, 'rb') as f2:
+                    assert f1.read() == f2.read()
+
+    def test_upload_directory(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            _make_files(tempdir, 6)
+            stg = DummyAsyncStorage('test-bucket', tempdir, backoff=0)
+            results = stg.upload_directory(
+                os.path.join(tempdir, 'src'), subdir='models')
+            assert sorted(stg.objects) == sorted(r[0] for r in results)
+            assert 'output/models/src/0/file_3.txt' in stg.objects
+
+    def test_retries(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = _make_files(tempdir, 1)[0]
+            stg = DummyAsyncStorage('test-bucket', tempdir, backoff=0)
+            stg.fail_tolerance = 2
+            dest, url = stg.upload(path)
+            assert url == 'url/{}'.format(dest)
+
+            stg.fail_count = 0
+            stg.fail_tolerance = stg.retries + 1
+            with pytest.raises(EndpointConnectionError):
+                stg.upload(path)
+
+            # non-transient errors are not retried
+            with pytest.raises(storage.StorageException):
+                stg.download_many(['does/not/exist.txt'])
+            assert stg.fail_count == stg.retries + 1
+
+    def test_upload_tree(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            paths = _make_files(tempdir, 9)
+            stg = DummyAsyncStorage('test-bucket', tempdir, backoff=0,
+                                    concurrency=4)
+            keys = stg.upload_tree(os.path.join(tempdir, 'src'), 'models/x')
+            assert keys == sorted(keys)
+            assert sorted(stg.objects) == keys
+            assert 'models/x/0/file_3.txt' in keys
+            assert stg.max_in_flight == 4
+            assert stg.stats['files_uploaded'] == 9
+
+            # only changed files are uploaded again
+            with open(paths[0], 'wb') as f:
+                f.write(b'changed')
+            stg.upload_tree(os.path.join(tempdir, 'src'), 'models/x')
+            assert stg.objects['models/x/0/file_0.txt'] == b'changed'
+            assert stg.stats['files_uploaded'] == 10
+            assert stg.stats['files_skipped'] == 8
+
+
+class TestAsyncS3Storage(object):
+
+    def test_download_file(self):
+        content = b'content'
+
+        class Body(object):
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *_):
+                pass
+
+            async def read(self):
+                return content
+
+        class Client(object):
+            etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+
+            async def get_object(self, **_):
+                return {'Body': Body(), 'ETag': self.etag}
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg = async_storage.AsyncS3Storage('test-bucket', tempdir)
+            stg._client = Client()
+            dest = os.path.join(tempdir, 'file.txt')
+            async_storage.run_sync(stg.download_file('file.txt', dest))
+            with open(dest, 'rb') as f:
+                assert f.read() == content
+
+            stg._client.etag = '"{}"'.format(hashlib.md5(b'x').hexdigest())
+            with pytest.raises(storage.StorageException):
+                async_storage.run_sync(stg.download_file('file.txt', dest))
+
+    def test_upload_file(self, monkeypatch):
+        uploads = []
+
+        class Client(object):
+            async def put_object(self, Bucket, Key, Body):
+                uploads.append(('put_object', Key, Body))
+
+            def upload_file(self, filepath, bucket, dest, ExtraArgs=None):
+                uploads.append(('upload_file', dest, ExtraArgs))
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg = async_storage.AsyncS3Storage('test-bucket', tempdir,
+                                               chunk_size=4)
+            stg._client = Client()
+            monkeypatch.setattr(stg, 'get_storage_client', Client)
+            small = os.path.join(tempdir, 'small.txt')
+            large = os.path.join(tempdir, 'large.txt')
+            for path, content in ((small, b'1234'), (large, b'12345')):
+                with open(path, 'wb') as f:
+                    f.write(content)
+
+            url = async_storage.run_sync(stg.upload_file(small, 'a/small'))
+            assert url == stg.get_public_url('a/small')
+            assert uploads.pop() == ('put_object', 'a/small', b'1234')
+
+            # large files are streamed in parts, not read into memory
+            url = async_storage.run_sync(stg.upload_file(large, 'a/large'))
+            assert url == stg.get_public_url('a/large')
+            md5 = hashlib.md5(b'12345').hexdigest()
+            assert uploads.pop() == ('upload_file', 'a/large',
+                                     {'Metadata': {'md5': md5}})
+
+    def test_get_public_url(self):
+        stg = async_storage.AsyncS3Storage('test-bucket')
+        assert stg.get_public_url('test') == \
+            'https://s3.amazonaws.com/test-bucket/test'
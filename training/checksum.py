@@ -0,0 +1,174 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Incremental checksums for files streamed to and from cloud storage"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import binascii
+import hashlib
+import os
+
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def get_hasher(algorithm='md5'):
+    """Returns a new hash object for the algorithm.
+
+    Args:
+        algorithm: "crc32c" or any algorithm supported by hashlib
+
+    Returns:
+        hasher: object with update() and digest() methods
+    """
+    algorithm = str(algorithm).lower()
+    if algorithm == 'crc32c':
+        if google_crc32c is None:
+            raise ValueError('crc32c checksums require `google-crc32c`.')
+        return google_crc32c.Checksum()
+    return hashlib.new(algorithm)
+
+
+def is_supported(algorithm):
+    """Returns True if a hasher for the algorithm is available."""
+    try:
+        get_hasher(algorithm)
+    except ValueError:
+        return False
+    return True
+
+
+def decode_hex(digest):
+    """Decode a hex digest (e.g. an S3 ETag) into raw bytes."""
+    return binascii.unhexlify(str(digest).strip('"'))
+
+
+def encode_hex(digest):
+    """Encode raw digest bytes as a hex string."""
+    return binascii.hexlify(digest).decode('ascii')
+
+
+def decode_b64(digest):
+    """Decode a base64 digest (e.g. a GCS md5_hash) into raw bytes."""
+    return base64.b64decode(digest)
+
+
+def update_from_file(hashers, fileobj, size=None, chunk_size=CHUNK_SIZE):
+    """Feed up to size bytes of fileobj into each hasher.
+
+    Args:
+        hashers: dict of algorithm name to hash object
+        fileobj: readable binary file object
+        size: maximum number of bytes to read, defaults to all
+        chunk_size: number of bytes to read at a time
+
+    Returns:
+        total: the number of bytes read
+    """
+    total = 0
+    while size is None or total < size:
+        toread = chunk_size if size is None else min(chunk_size, size - total)
+        chunk = fileobj.read(toread)
+        if not chunk:
+            break
+        for hasher in hashers.values():
+            hasher.update(chunk)
+        total += len(chunk)
+    return total
+
+
+def file_digest(path, algorithm='md5', chunk_size=CHUNK_SIZE):
+    """Compute the digest of a local file without loading it in memory.
+
+    Args:
+        path: path to the local file
+        algorithm: name of the hash algorithm
+
+    Returns:
+        digest: raw digest bytes
+    """
+    hashers = {algorithm: get_hasher(algorithm)}
+    with open(path, 'rb') as f:
+        update_from_file(hashers, f, chunk_size=chunk_size)
+    return hashers[algorithm].digest()
+
+
+def directory_digest(path, algorithm='md5', chunk_size=CHUNK_SIZE):
+    """Compute a digest of the files in a directory and their layout.
+
+    Args:
+        path: path to the local directory
+        algorithm: name of the hash algorithm
+
+    Returns:
+        digest: raw digest bytes of each relative path and file digest
+    """
+    hasher = get_hasher(algorithm)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filepath = os.path.join(root, name)
+            relpath = os.path.relpath(filepath, path).replace(os.sep, '/')
+            hasher.update(relpath.encode('utf-8'))
+            hasher.update(file_digest(filepath, algorithm, chunk_size))
+    return hasher.digest()
+
+
+class HashingWriter(object):
+    """File-like wrapper that hashes bytes as they are written.
+
+    Args:
+        fileobj: writable binary file object
+        hashers: dict of algorithm name to hash object
+    """
+
+    def __init__(self, fileobj, hashers=None):
+        self.fileobj = fileobj
+        self.hashers = hashers if hashers is not None else {}
+        self.bytes_written = 0
+
+    def write(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        self.bytes_written += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        return self.fileobj.flush()
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def digests(self):
+        """Returns a dict of algorithm name to raw digest bytes."""
+        return {k: h.digest() for k, h in self.hashers.items()}
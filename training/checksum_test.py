@@ -0,0 +1,100 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for checksum helpers"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import hashlib
+import io
+import os
+import tempfile
+
+import pytest
+
+from training import checksum
+
+
+def test_get_hasher():
+    assert checksum.get_hasher('md5').name == 'md5'
+    assert checksum.get_hasher('SHA256').name == 'sha256'
+    assert checksum.is_supported('md5')
+
+    if checksum.google_crc32c is None:
+        assert not checksum.is_supported('crc32c')
+        with pytest.raises(ValueError):
+            checksum.get_hasher('crc32c')
+
+
+def test_decode():
+    digest = hashlib.md5(b'abc').digest()
+    assert checksum.decode_hex('"%s"' % hashlib.md5(b'abc').hexdigest()) \
+        == digest
+    assert checksum.decode_b64(base64.b64encode(digest)) == digest
+
+
+def test_file_digest():
+    with tempfile.NamedTemporaryFile() as temp:
+        temp.write(b'x' * 1000)
+        temp.flush()
+        digest = checksum.file_digest(temp.name, chunk_size=7)
+        assert digest == hashlib.md5(b'x' * 1000).digest()
+
+
+def test_directory_digest():
+    with tempfile.TemporaryDirectory() as tempdir:
+        os.makedirs(os.path.join(tempdir, 'sub'))
+        for name in ('a', os.path.join('sub', 'b')):
+            with open(os.path.join(tempdir, name), 'wb') as f:
+                f.write(b'abc')
+        digest = checksum.directory_digest(tempdir)
+        assert digest == checksum.directory_digest(tempdir)
+
+        # the layout is part of the digest, not only the content
+        os.rename(os.path.join(tempdir, 'sub', 'b'),
+                  os.path.join(tempdir, 'b'))
+        assert digest != checksum.directory_digest(tempdir)
+
+
+def test_update_from_file():
+    hashers = {'md5': checksum.get_hasher('md5')}
+    total = checksum.update_from_file(
+        hashers, io.BytesIO(b'abcdef'), size=4, chunk_size=3)
+    assert total == 4
+    assert hashers['md5'].digest() == hashlib.md5(b'abcd').digest()
+
+
+def test_hashing_writer():
+    buf = io.BytesIO()
+    writer = checksum.HashingWriter(buf, {'md5': checksum.get_hasher('md5')})
+    writer.write(b'abc')
+    writer.write(b'def')
+    writer.flush()
+    assert buf.getvalue() == b'abcdef'
+    assert writer.bytes_written == 6
+    assert writer.tell() == 6
+    assert writer.digests() == {'md5': hashlib.md5(b'abcdef').digest()}
@@ -0,0 +1,283 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Shared test fixtures"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import fnmatch
+import queue
+import threading
+
+from redis import exceptions as redis_exceptions
+
+import pytest
+
+
+class DummyPipeline(object):
+    """Minimal redis pipeline supporting WATCH/MULTI/EXEC."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.watching = False
+        self.watched = {}
+        self.stack = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.reset()
+
+    def __getattr__(self, name):
+        func = getattr(self.redis, name)
+        if self.watching:
+            return func
+
+        def buffered(*args, **kwargs):
+            self.stack.append((func, args, kwargs))
+            return self
+
+        return buffered
+
+    def watch(self, *keys):
+        self.watching = True
+        for key in keys:
+            self.watched[key] = self.redis.versions.get(key, 0)
+
+    def unwatch(self):
+        self.watching = False
+        self.watched = {}
+
+    def multi(self):
+        self.watching = False
+
+    def reset(self):
+        self.unwatch()
+        self.stack = []
+
+    def execute(self):
+        with self.redis.lock:
+            self.redis.maybe_fail()
+            for key, version in self.watched.items():
+                if self.redis.versions.get(key, 0) != version:
+                    self.reset()
+                    raise redis_exceptions.WatchError(key)
+            results = [f(*a, **kw) for f, a, kw in self.stack]
+        self.reset()
+        return results
+
+
+class DummyPubSub(object):
+    """Minimal redis pub/sub connection."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.channels = set()
+        self.patterns = set()
+        self.messages = queue.Queue()
+
+    def subscribe(self, *channels):
+        self.redis.maybe_fail()
+        self.channels.update(channels)
+        self.redis.subscribers.add(self)
+
+    def psubscribe(self, *patterns):
+        self.redis.maybe_fail()
+        self.patterns.update(patterns)
+        self.redis.subscribers.add(self)
+
+    def deliver(self, channel, data):
+        delivered = 0
+        if channel in self.channels:
+            self.messages.put({'type': 'message', 'pattern': None,
+                               'channel': channel, 'data': data})
+            delivered += 1
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(channel, pattern):
+                self.messages.put({'type': 'pmessage', 'pattern': pattern,
+                                   'channel': channel, 'data': data})
+                delivered += 1
+        return delivered
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        self.redis.maybe_fail()
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.redis.subscribers.discard(self)
+
+
+class DummyRedis(object):
+    """In-memory stand-in for the subset of redis used by the training jobs.
+
+    Set ``fail_tolerance`` to make the next N commands raise a
+    ``ConnectionError``, mimicking a dropped connection.  Set
+    ``notify_keyspace_events`` to publish keyspace notifications for
+    hash writes.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.versions = {}
+        self.fail_tolerance = 0
+        self.fail_count = 0
+        self.calls = 0
+        self.lock = threading.RLock()
+        self.subscribers = set()
+        self.notify_keyspace_events = False
+
+    def maybe_fail(self):
+        self.calls += 1
+        if self.fail_count < self.fail_tolerance:
+            self.fail_count += 1
+            raise redis_exceptions.ConnectionError('thrown-on-purpose')
+
+    def _touch(self, key, event=None):
+        self.versions[key] = self.versions.get(key, 0) + 1
+        if event is not None and self.notify_keyspace_events:
+            self._deliver('__keyspace@0__:{}'.format(key), event)
+
+    def _deliver(self, channel, data):
+        return sum(s.deliver(channel, data) for s in list(self.subscribers))
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return DummyPubSub(self)
+
+    def publish(self, channel, message):
+        self.maybe_fail()
+        return self._deliver(channel, str(message))
+
+    def pipeline(self, transaction=True):
+        return DummyPipeline(self)
+
+    def keys(self, pattern='*'):
+        self.maybe_fail()
+        return [k for k in list(self.data) if fnmatch.fnmatch(k, pattern)]
+
+    def scan_iter(self, match='*', count=None):
+        return iter(self.keys(match))
+
+    def type(self, key):
+        self.maybe_fail()
+        value = self.data.get(key)
+        if isinstance(value, dict):
+            return 'hash'
+        if isinstance(value, list):
+            return 'list'
+        return 'string' if value is not None else 'none'
+
+    def exists(self, key):
+        self.maybe_fail()
+        return int(key in self.data)
+
+    def delete(self, *keys):
+        self.maybe_fail()
+        count = 0
+        for key in keys:
+            if self.data.pop(key, None) is not None:
+                self._touch(key)
+                count += 1
+        return count
+
+    def get(self, key):
+        self.maybe_fail()
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        self.maybe_fail()
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value)
+        self._touch(key)
+        if ex is not None:
+            self.ttls[key] = ex
+        return True
+
+    def incr(self, key, amount=1):
+        self.maybe_fail()
+        value = int(self.data.get(key, 0)) + amount
+        self.data[key] = str(value)
+        self._touch(key)
+        return value
+
+    def hget(self, key, field):
+        self.maybe_fail()
+        return self.data.get(key, {}).get(field)
+
+    def hgetall(self, key):
+        self.maybe_fail()
+        return dict(self.data.get(key, {}))
+
+    def hset(self, key, field, value):
+        self.maybe_fail()
+        self.data.setdefault(key, {})[field] = str(value)
+        self._touch(key, 'hset')
+        return 1
+
+    def hmset(self, key, mapping):
+        self.maybe_fail()
+        hvals = self.data.setdefault(key, {})
+        for field, value in mapping.items():
+            hvals[field] = str(value)
+        self._touch(key, 'hset')
+        return True
+
+    def hincrby(self, key, field, amount=1):
+        self.maybe_fail()
+        with self.lock:
+            hvals = self.data.setdefault(key, {})
+            value = int(hvals.get(field, 0)) + amount
+            hvals[field] = str(value)
+            self._touch(key)
+        return value
+
+    def hdel(self, key, *fields):
+        self.maybe_fail()
+        hvals = self.data.get(key, {})
+        removed = [hvals.pop(f) for f in fields if f in hvals]
+        self._touch(key)
+        return len(removed)
+
+    def expire(self, key, seconds):
+        self.maybe_fail()
+        if key not in self.data:
+            return False
+        self.ttls[key] = seconds
+        return True
+
+    def ttl(self, key):
+        self.maybe_fail()
+        return self.ttls.get(key, -1)
+
+
+@pytest.fixture
+def redis_client():
+    return DummyRedis()
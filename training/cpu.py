@@ -0,0 +1,283 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Size thread pools and place the notebook on the container's CPUs"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import json
+import logging
+import shutil
+
+from training import settings
+
+
+logger = logging.getLogger('training.cpu')
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+NODE_ROOT = '/sys/devices/system/node'
+
+# thread pool sizes read by OpenMP, MKL, OpenBLAS and TensorFlow
+THREAD_VARIABLES = (
+    'OMP_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'TF_NUM_INTRAOP_THREADS',
+    'TF_NUM_INTEROP_THREADS',
+)
+
+
+# TensorFlow builds older than 1.14 ignore the TF_NUM_* variables, so the
+# notebook sizes its thread pools explicitly before training.
+THREADING_CELL = """\
+import os
+import tensorflow as tf
+
+_intra = int(os.environ.get('TF_NUM_INTRAOP_THREADS', 0))
+_inter = int(os.environ.get('TF_NUM_INTEROP_THREADS', 0))
+if hasattr(tf, 'config') and hasattr(tf.config, 'threading'):
+    tf.config.threading.set_intra_op_parallelism_threads(_intra)
+    tf.config.threading.set_inter_op_parallelism_threads(_inter)
+else:
+    tf.keras.backend.set_session(tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=_intra,
+        inter_op_parallelism_threads=_inter)))
+"""
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def parse_cpu_list(value):
+    """Parse a kernel CPU list such as "0-3,8" into a set of CPU ids."""
+    cpus = set()
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    """Format CPU ids as a kernel CPU list, e.g. "0-3,8"."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '{}-{}'.format(a, b)
+                    for a, b in ranges)
+
+
+def get_cpu_quota(root=CGROUP_ROOT):
+    """Returns the container's CFS CPU quota in cores, or None if unlimited.
+
+    Supports both the unified (v2) and the legacy (v1) cgroup hierarchy.
+    """
+    value = _read(os.path.join(root, 'cpu.max'))
+    if value:
+        quota, _, period = value.partition(' ')
+        if quota == 'max':
+            return None
+        return int(quota) / int(period or 100000)
+
+    for folder in ('cpu', 'cpu,cpuacct', 'cpuacct,cpu'):
+        quota = _read(os.path.join(root, folder, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(root, folder, 'cpu.cfs_period_us'))
+        if quota is not None and period:
+            return int(quota) / int(period) if int(quota) > 0 else None
+    return None
+
+
+def get_allowed_cpus():
+    """Returns the CPUs this process may run on, i.e. its cpuset."""
+    if hasattr(os, 'sched_getaffinity'):
+        return set(os.sched_getaffinity(0))
+    return set(range(os.cpu_count() or 1))
+
+
+def get_numa_nodes(root=NODE_ROOT):
+    """Returns a dict of NUMA node id to the set of its CPUs."""
+    nodes = {}
+    try:
+        names = os.listdir(root)
+    except (IOError, OSError):
+        return nodes
+    for name in names:
+        match = re.match(r'^node(\d+)$', name)
+        if match:
+            cpulist = _read(os.path.join(root, name, 'cpulist'))
+            nodes[int(match.group(1))] = parse_cpu_list(cpulist)
+    return nodes
+
+
+def choose_cpus(allowed, count, nodes=None):
+    """Pick count of the allowed CPUs, keeping them on as few NUMA nodes
+    as possible.
+
+    Args:
+        allowed: set of CPUs to choose from
+        count: number of CPUs to choose
+        nodes: dict of NUMA node id to the set of its CPUs
+
+    Returns:
+        sorted list of the chosen CPUs
+    """
+    if count >= len(allowed):
+        return sorted(allowed)
+
+    groups = [sorted(allowed & cpus) for cpus in (nodes or {}).values()]
+    groups = sorted((g for g in groups if g), key=lambda g: (-len(g), g[0]))
+    leftover = sorted(allowed.difference(*groups)) if groups \
+        else sorted(allowed)
+    chosen = []
+    for group in groups + [leftover]:
+        chosen.extend(group[:count - len(chosen)])
+    return sorted(chosen)
+
+
+class CPUPlacement(object):
+    """Thread pool sizes and CPU pinning for the training notebook.
+
+    Args:
+        num_threads: size of the intra-op thread pools
+        cpus: CPUs to pin the notebook to, or None not to pin it
+        node: NUMA node to allocate memory on, or None
+    """
+
+    def __init__(self, num_threads, cpus=None, node=None):
+        self.num_threads = max(int(num_threads), 1)
+        self.cpus = sorted(cpus) if cpus else None
+        self.node = node
+
+    def __repr__(self):
+        return '{}(num_threads={}, cpus={}, node={})'.format(
+            type(self).__name__, self.num_threads,
+            format_cpu_list(self.cpus) if self.cpus else None, self.node)
+
+    @classmethod
+    def detect(cls, num_threads=settings.CPU_THREADS, pin=settings.PIN_CPUS,
+               cgroup_root=CGROUP_ROOT, node_root=NODE_ROOT, allowed=None,
+               host_cpus=None):
+        """Size the thread pools to the container's CPU quota and cpuset.
+
+        The notebook is only pinned when the container's cpuset is
+        exclusive, i.e. the quota covers every CPU in it, as with the
+        kubelet's static CPU manager.  Pinning to part of a shared pool
+        would stack every pod on the same CPUs.
+
+        Args:
+            num_threads: thread pool size, 0 to use the CPU quota
+            pin: whether to pin the notebook to its CPUs
+            allowed: CPUs this process may run on, defaults to its cpuset
+            host_cpus: number of CPUs of the host
+
+        Returns:
+            placement: CPUPlacement for the notebook
+        """
+        allowed = set(allowed or get_allowed_cpus())
+        host_cpus = host_cpus or os.cpu_count() or len(allowed)
+        quota = get_cpu_quota(cgroup_root)
+
+        if not num_threads:
+            num_threads = len(allowed)
+            if quota is not None:
+                num_threads = min(num_threads, max(int(quota), 1))
+
+        cpus, node = None, None
+        exclusive = quota is not None and len(allowed) <= quota + 1e-6
+        if pin and exclusive and len(allowed) < host_cpus:
+            nodes = get_numa_nodes(node_root)
+            cpus = choose_cpus(allowed, num_threads, nodes)
+            containing = [n for n, c in nodes.items() if c.issuperset(cpus)]
+            node = containing[0] if containing else None
+
+        placement = cls(num_threads, cpus, node)
+        logger.debug('CPU quota: %s, cpuset: %s, placement: %s', quota,
+                     format_cpu_list(allowed), placement)
+        return placement
+
+    def env(self):
+        """Returns the environment variables sizing the thread pools."""
+        num_threads = self.num_threads
+        env = {name: str(num_threads) for name in THREAD_VARIABLES}
+        # a few ops run in parallel, each on the intra-op pool
+        env['TF_NUM_INTEROP_THREADS'] = str(2 if num_threads >= 4 else 1)
+        if self.cpus:
+            # bind OpenMP threads to the pinned CPUs (Intel MKL builds)
+            env['KMP_AFFINITY'] = 'granularity=fine,compact,1,0'
+        return env
+
+    def command(self, which=shutil.which):
+        """Returns the command prefix pinning a process to the CPUs.
+
+        Uses numactl to also allocate memory on the local NUMA node, or
+        taskset if numactl is not installed.
+        """
+        if not self.cpus:
+            return []
+        cpulist = format_cpu_list(self.cpus)
+        if self.node is not None and which('numactl'):
+            return ['numactl', '--physcpubind={}'.format(cpulist),
+                    '--membind={}'.format(self.node)]
+        if which('taskset'):
+            return ['taskset', '-c', cpulist]
+        logger.warning('Neither numactl nor taskset is installed, '
+                       'not pinning to CPUs %s.', cpulist)
+        return []
+
+
+def configure_notebook(notebook_path):
+    """Size TensorFlow's thread pools in the notebook itself.
+
+    Inserts a first cell applying TF_NUM_INTRAOP_THREADS and
+    TF_NUM_INTEROP_THREADS through the TensorFlow API, which older
+    TensorFlow builds require.
+
+    Args:
+        notebook_path: path to the notebook to edit in place
+    """
+    with open(notebook_path) as f:
+        notebook = json.load(f)
+    notebook.setdefault('cells', []).insert(0, {
+        'cell_type': 'code',
+        'execution_count': None,
+        'metadata': {},
+        'outputs': [],
+        'source': THREADING_CELL.splitlines(True),
+    })
+    with open(notebook_path, 'w') as f:
+        json.dump(notebook, f, indent=1)
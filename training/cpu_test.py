@@ -0,0 +1,190 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for CPU thread sizing and placement"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+from training import cpu
+
+
+def _write(root, path, value):
+    path = os.path.join(root, path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def _make_nodes(root, *cpulists):
+    for i, cpulist in enumerate(cpulists):
+        _write(root, os.path.join('node{}'.format(i), 'cpulist'), cpulist)
+    _write(root, 'online', '0-{}'.format(len(cpulists) - 1))
+
+
+def test_cpu_list():
+    assert cpu.parse_cpu_list('0-3,8,10-11\n') == {0, 1, 2, 3, 8, 10, 11}
+    assert cpu.parse_cpu_list('') == set()
+    assert cpu.format_cpu_list({0, 1, 2, 3, 8, 10, 11}) == '0-3,8,10-11'
+    assert cpu.format_cpu_list([5]) == '5'
+
+
+def test_get_cpu_quota():
+    with tempfile.TemporaryDirectory() as tempdir:
+        assert cpu.get_cpu_quota(tempdir) is None
+
+        # cgroup v1
+        _write(tempdir, 'cpu,cpuacct/cpu.cfs_quota_us', '-1')
+        _write(tempdir, 'cpu,cpuacct/cpu.cfs_period_us', '100000')
+        assert cpu.get_cpu_quota(tempdir) is None
+        _write(tempdir, 'cpu,cpuacct/cpu.cfs_quota_us', '250000')
+        assert cpu.get_cpu_quota(tempdir) == 2.5
+
+        # cgroup v2
+        _write(tempdir, 'cpu.max', 'max 100000')
+        assert cpu.get_cpu_quota(tempdir) is None
+        _write(tempdir, 'cpu.max', '400000 100000')
+        assert cpu.get_cpu_quota(tempdir) == 4
+
+
+def test_get_numa_nodes():
+    with tempfile.TemporaryDirectory() as tempdir:
+        _make_nodes(tempdir, '0-3', '4-7')
+        assert cpu.get_numa_nodes(tempdir) == {0: {0, 1, 2, 3},
+                                               1: {4, 5, 6, 7}}
+        assert cpu.get_numa_nodes(os.path.join(tempdir, 'x')) == {}
+
+
+def test_choose_cpus():
+    nodes = {0: {0, 1, 2, 3}, 1: {4, 5, 6, 7}}
+    assert cpu.choose_cpus({1, 2}, 4, nodes) == [1, 2]
+    # the node with the most allowed CPUs is filled first
+    assert cpu.choose_cpus({3, 4, 5, 6}, 3, nodes) == [4, 5, 6]
+    assert cpu.choose_cpus({2, 3, 4, 5, 6}, 4, nodes) == [2, 4, 5, 6]
+    assert cpu.choose_cpus({0, 1, 2, 3, 8}, 5, nodes) == [0, 1, 2, 3, 8]
+    assert cpu.choose_cpus({0, 5, 9}, 2, None) == [0, 5]
+
+
+class TestCPUPlacement(object):
+
+    def test_detect(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            cgroup = os.path.join(tempdir, 'cgroup')
+            nodes = os.path.join(tempdir, 'node')
+            _make_nodes(nodes, '0-3', '4-7')
+
+            def detect(**kwargs):
+                return cpu.CPUPlacement.detect(
+                    cgroup_root=cgroup, node_root=nodes, host_cpus=8,
+                    **kwargs)
+
+            # no quota: use every allowed CPU without pinning
+            placement = detect(num_threads=0, allowed=set(range(8)))
+            assert placement.num_threads == 8
+            assert placement.cpus is None
+
+            # a quota in a shared pool sizes the threads but does not pin
+            _write(cgroup, 'cpu.max', '250000 100000')
+            placement = detect(num_threads=0, allowed=set(range(8)))
+            assert placement.num_threads == 2
+            assert placement.cpus is None
+
+            # an exclusive cpuset is pinned along with its NUMA node
+            _write(cgroup, 'cpu.max', '200000 100000')
+            placement = detect(num_threads=0, allowed={4, 5})
+            assert placement.num_threads == 2
+            assert placement.cpus == [4, 5]
+            assert placement.node == 1
+
+            _write(cgroup, 'cpu.max', '200000 100000')
+            placement = detect(num_threads=0, allowed={3, 4})
+            assert placement.cpus == [3, 4]
+            assert placement.node is None
+
+            placement = detect(num_threads=0, allowed={4, 5}, pin=False)
+            assert placement.cpus is None
+
+            placement = detect(num_threads=6, allowed=set(range(8)))
+            assert placement.num_threads == 6
+
+    def test_env(self):
+        env = cpu.CPUPlacement(8).env()
+        assert env['OMP_NUM_THREADS'] == '8'
+        assert env['TF_NUM_INTRAOP_THREADS'] == '8'
+        assert env['TF_NUM_INTEROP_THREADS'] == '2'
+        assert 'KMP_AFFINITY' not in env
+
+        env = cpu.CPUPlacement(1, cpus=[3]).env()
+        assert env['TF_NUM_INTEROP_THREADS'] == '1'
+        assert 'KMP_AFFINITY' in env
+
+    @pytest.mark.parametrize('installed,expected', [
+        (('numactl', 'taskset'),
+         ['numactl', '--physcpubind=4-5', '--membind=1']),
+        (('taskset',), ['taskset', '-c', '4-5']),
+        ((), []),
+    ])
+    def test_command(self, installed, expected):
+        def which(name):
+            return '/usr/bin/' + name if name in installed else None
+
+        placement = cpu.CPUPlacement(2, cpus=[4, 5], node=1)
+        assert placement.command(which=which) == expected
+        assert cpu.CPUPlacement(2).command(which=which) == []
+
+
+def test_configure_notebook():
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, 'train.ipynb')
+        with open(path, 'w') as f:
+            json.dump({'cells': [{'cell_type': 'code', 'source': ['x']}],
+                       'nbformat': 4}, f)
+        cpu.configure_notebook(path)
+        with open(path) as f:
+            notebook = json.load(f)
+        assert len(notebook['cells']) == 2
+        assert ''.join(notebook['cells'][0]['source']) == cpu.THREADING_CELL
+        assert notebook['cells'][1]['source'] == ['x']
+        compile(cpu.THREADING_CELL, path, 'exec')
+
+
+def test_threading_cell():
+    pytest.importorskip('tensorflow')
+    code = cpu.THREADING_CELL + (
+        'print(tf.config.threading.get_intra_op_parallelism_threads(), '
+        'tf.config.threading.get_inter_op_parallelism_threads())')
+    env = dict(os.environ, TF_NUM_INTRAOP_THREADS='3',
+               TF_NUM_INTEROP_THREADS='2')
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    assert output.split()[-2:] == [b'3', b'2']
@@ -0,0 +1,160 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Wake idle workers when training jobs are submitted"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import threading
+
+from training import job_store
+from training import settings
+
+
+# hash writes that may make a job claimable; HMSET is reported as "hset"
+KEYSPACE_EVENTS = ('hset', 'hsetnx', 'hmset')
+
+
+class JobListener(object):
+    """Collect the keys of newly submitted jobs from redis pub/sub.
+
+    Jobs are announced on a channel by JobStore.publish and, if the redis
+    server has keyspace notifications for hashes enabled
+    (notify-keyspace-events "Kh"), by any write to a job hash.  Events
+    are lost while disconnected, so callers should still scan for jobs
+    whenever wait returns None.
+
+    Args:
+        jobs: JobStore whose client, prefix and channel are used
+        timeout: seconds to block waiting for each message
+    """
+
+    def __init__(self, jobs, timeout=1):
+        self.jobs = jobs
+        self.timeout = timeout
+        self.keyspace_pattern = '__keyspace@*__:{}*'.format(jobs.prefix)
+        self._keys = set()
+        self._missed = False
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.logger = logging.getLogger(str(self.__class__.__name__))
+
+    def start(self):
+        """Start listening in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._listen)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop listening and wake any waiting caller."""
+        self._stop.set()
+        self._event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _subscribe(self):
+        pubsub = self.jobs.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.jobs.channel)
+        pubsub.psubscribe(self.keyspace_pattern)
+        return pubsub
+
+    def _listen(self):
+        pubsub = None
+        while not self._stop.is_set():
+            try:
+                if pubsub is None:
+                    pubsub = self._subscribe()
+                    self.logger.debug('Subscribed to %s and %s.',
+                                      self.jobs.channel,
+                                      self.keyspace_pattern)
+                message = pubsub.get_message(timeout=self.timeout)
+            except job_store.TRANSIENT_ERRORS as err:
+                self.logger.warning('Encountered %s: %s while listening for '
+                                    'jobs.  Backing off for %s seconds...',
+                                    type(err).__name__, err,
+                                    self.jobs.backoff)
+                pubsub = None
+                self.notify(None)  # events may have been missed
+                self._stop.wait(self.jobs.backoff)
+                continue
+            key = self.get_job_key(message) if message else None
+            if key is not None:
+                self.notify(key)
+        if pubsub is not None:
+            pubsub.close()
+
+    def get_job_key(self, message):
+        """Returns the job key announced by a pub/sub message, if any."""
+        if message.get('type') == 'pmessage':
+            if message.get('data') not in KEYSPACE_EVENTS:
+                return None
+            key = message['channel'].split(':', 1)[-1]
+        elif message.get('type') == 'message':
+            key = message.get('data')
+        else:
+            return None
+        if key and key.startswith(self.jobs.prefix):
+            return key
+        return None
+
+    def notify(self, key):
+        """Wake the waiting caller, optionally with a candidate job key.
+
+        Args:
+            key: key of the job, or None to request a full scan
+        """
+        with self._lock:
+            if key is None:
+                self._missed = True
+            else:
+                self._keys.add(key)
+        self._event.set()
+
+    def wait(self, timeout=settings.RECONCILE_INTERVAL):
+        """Block until jobs are announced or the timeout expires.
+
+        Args:
+            timeout: seconds to wait before a reconciliation sweep is due
+
+        Returns:
+            list of announced job keys, or None if a full scan is due
+        """
+        self._event.wait(timeout)
+        with self._lock:
+            keys, missed = sorted(self._keys), self._missed
+            self._keys = set()
+            self._missed = False
+            self._event.clear()
+        if missed or not keys:
+            return None
+        return keys
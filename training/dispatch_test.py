@@ -0,0 +1,110 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for event-driven job dispatch"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from training import dispatch
+from training import job_store
+
+
+def _listener(redis_client):
+    jobs = job_store.JobStore(redis_client, prefix='train', backoff=0,
+                              channel='jobs')
+    return jobs, dispatch.JobListener(jobs, timeout=0.05)
+
+
+class TestJobListener(object):
+
+    def test_get_job_key(self, redis_client):
+        _, listener = _listener(redis_client)
+        keyspace = '__keyspace@0__:train_1'
+        assert listener.get_job_key(
+            {'type': 'message', 'channel': 'jobs', 'data': 'train_1'}
+        ) == 'train_1'
+        assert listener.get_job_key(
+            {'type': 'pmessage', 'channel': keyspace, 'data': 'hset'}
+        ) == 'train_1'
+        # only writes make a job claimable
+        assert listener.get_job_key(
+            {'type': 'pmessage', 'channel': keyspace, 'data': 'expired'}
+        ) is None
+        # other prefixes and message types are ignored
+        assert listener.get_job_key(
+            {'type': 'message', 'channel': 'jobs', 'data': 'predict_1'}
+        ) is None
+        assert listener.get_job_key(
+            {'type': 'subscribe', 'channel': 'jobs', 'data': 1}) is None
+
+    def test_wait(self, redis_client):
+        jobs, listener = _listener(redis_client)
+        # a sweep is due when nothing is announced
+        assert listener.wait(0.01) is None
+
+        listener.start()
+        try:
+            while not redis_client.subscribers:
+                listener.wait(0.01)
+            jobs.publish('train_1')
+            jobs.publish('train_1')
+            jobs.publish('predict_1')
+            assert listener.wait(5) == ['train_1']
+
+            # keyspace notifications are ignored unless redis sends them
+            redis_client.hset('train_2', 'status', 'new')
+            assert listener.wait(0.2) is None
+
+            redis_client.notify_keyspace_events = True
+            redis_client.hset('train_2', 'status', 'new')
+            redis_client.hset('predict_2', 'status', 'new')
+            assert listener.wait(5) == ['train_2']
+        finally:
+            listener.stop()
+
+    def test_reconnect(self, redis_client):
+        jobs, listener = _listener(redis_client)
+        redis_client.fail_tolerance = 2
+        listener.start()
+        try:
+            # events may have been missed while disconnected
+            assert listener.wait(5) is None
+            while redis_client.fail_count < 2:
+                listener.wait(0.05)
+            while not redis_client.subscribers:
+                listener.wait(0.05)
+            jobs.publish('train_1')
+            assert listener.wait(5) == ['train_1']
+        finally:
+            listener.stop()
+        assert not redis_client.subscribers
+
+    def test_stop(self, redis_client):
+        _, listener = _listener(redis_client)
+        listener.start()
+        listener.stop()
+        # stopping wakes a waiting caller at once
+        assert listener.wait(30) is None
@@ -0,0 +1,396 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Coordinate multi-worker data-parallel training through the job hash"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import json
+import logging
+import os
+import re
+import socket
+import time
+
+from training import settings
+from training import utils
+
+
+logger = logging.getLogger('training.distributed')
+
+# Status of jobs waiting for participants
+GATHERING = 'gathering'
+
+# Fields the participants add to the job hash while gathering
+CLUSTER_FIELDS = ('ranks', 'rendezvous', 'model')
+CLUSTER_PREFIXES = ('worker_', 'barrier_')
+
+# The training script only trains a fully convolutional foreground /
+# background model, so other parameters must keep these values.
+SUPPORTED = {
+    'train_type': 'conv',
+    'transform': 'fgbg',
+    'skips': 0,
+}
+
+
+# tf.distribute.MultiWorkerMirroredStrategy is stable from this version
+MIN_TENSORFLOW_VERSION = (2, 4)
+
+# Distributions TensorFlow may be installed from
+TENSORFLOW_DISTRIBUTIONS = ('tensorflow', 'tensorflow-gpu', 'tensorflow-cpu',
+                            'tf-nightly')
+
+
+class RendezvousError(Exception):
+    """Raised when the participants of a distributed job fail to meet."""
+
+
+def get_num_workers(hash_values):
+    """Returns the number of workers the job is trained by."""
+    value = hash_values.get('num_workers')
+    return max(int(value), 1) if value not in (None, '') else 1
+
+
+def get_tensorflow_version():
+    """Returns the installed TensorFlow version without importing it.
+
+    Returns:
+        the version as a tuple of ints, or None if TensorFlow is not
+        installed
+    """
+    try:
+        from importlib import metadata
+        get_version = metadata.version
+        not_found = metadata.PackageNotFoundError
+    except ImportError:  # Python < 3.8
+        import pkg_resources
+
+        def get_version(name):
+            return pkg_resources.get_distribution(name).version
+        not_found = pkg_resources.DistributionNotFound
+
+    for name in TENSORFLOW_DISTRIBUTIONS:
+        try:
+            version = get_version(name)
+        except not_found:
+            continue
+        # e.g. "2.4.0", "2.5.0rc1" or "2.6.0-dev20210601"
+        return tuple(int(re.match(r'\d*', part).group() or 0)
+                     for part in version.split('.')[:2])
+    return None
+
+
+def check_supported(**kwargs):
+    """Raise ValueError if the training script cannot train the model.
+
+    Args:
+        kwargs: named key/value pairs from the redis hash
+    """
+    # the base image may ship an older TensorFlow, so check before
+    # anyone gathers for or downloads the job
+    version = get_tensorflow_version()
+    if version is None or version < MIN_TENSORFLOW_VERSION:
+        raise ValueError(
+            'Multi-worker training requires TensorFlow {} or later, '
+            'found {}'.format(
+                '.'.join(map(str, MIN_TENSORFLOW_VERSION)),
+                '.'.join(map(str, version)) if version else 'none'))
+
+    training_kwargs = utils.get_training_kwargs(**kwargs)
+    for name, supported in sorted(SUPPORTED.items()):
+        if training_kwargs[name] != supported:
+            raise ValueError(
+                'Multi-worker training only supports {} {!r}, got {!r}'.format(
+                    name, supported, training_kwargs[name]))
+
+
+def get_address(host=settings.WORKER_HOST, port=settings.WORKER_PORT):
+    """Returns the "host:port" the other participants reach this worker at.
+
+    Args:
+        host: hostname or IP address, defaults to the host's IP address
+        port: port of the collective ops server, 0 for a free port
+    """
+    if not host:
+        host = socket.gethostbyname(socket.gethostname())
+    if not port:
+        with contextlib.closing(socket.socket()) as sock:
+            sock.bind(('', 0))
+            port = sock.getsockname()[1]
+    return '{}:{}'.format(host, port)
+
+
+class Rendezvous(object):
+    """A participant of a distributed job, coordinated through its hash.
+
+    The chief (rank 0) is the worker that claimed the job.  Each other
+    participant takes the next free rank with JobStore.join and records
+    the address of its collective ops server in the "worker_<rank>" field.
+
+    Args:
+        jobs: JobStore of training job hashes
+        key: redis key of the job hash
+        rank: this worker's index in the cluster
+        num_workers: number of participants
+        timeout: seconds to wait for the others at a barrier
+        interval: seconds between checks of the job hash
+    """
+
+    def __init__(self, jobs, key, rank, num_workers,
+                 timeout=settings.RENDEZVOUS_TIMEOUT, interval=1):
+        self.jobs = jobs
+        self.key = key
+        self.rank = rank
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.interval = interval
+        self.logger = logging.getLogger(str(self.__class__.__name__))
+
+    @property
+    def is_chief(self):
+        return self.rank == 0
+
+    def barrier(self, name):
+        """Wait until every participant has reached the barrier.
+
+        Returns:
+            dict of the job hash once all participants have arrived
+        """
+        worker = 'worker_{}'.format(self.rank)
+        address = self.jobs.get_field(self.key, worker)
+        arrived = self.jobs.arrive(self.key, name)
+        self.logger.debug('Rank %s of %s arrived at barrier "%s" (%s/%s).',
+                          self.rank, self.key, name, arrived,
+                          self.num_workers)
+        start = time.time()
+        while True:
+            job = self.jobs.get_job(self.key)
+            arrived = int(job.get('barrier_{}'.format(name), 0))
+            status = job.get('status')
+            if job.get(worker) != address:
+                raise RendezvousError('Job {} was put back before all '
+                                      'workers arrived at barrier "{}"'.format(
+                                          self.key, name))
+
+            # the others may already be done by the time this one looks
+            if status != 'failed' and arrived >= self.num_workers:
+                return job
+
+            if status != GATHERING:
+                raise RendezvousError('Job {} is {} before all workers '
+                                      'arrived at barrier "{}"'.format(
+                                          self.key, status, name))
+
+            if time.time() - start > self.timeout:
+                raise RendezvousError(
+                    'Only {} of {} workers arrived at barrier "{}" within {} '
+                    'seconds'.format(arrived, self.num_workers, name,
+                                     self.timeout))
+            time.sleep(self.interval)
+
+    def get_cluster(self, job):
+        """Returns the participants' addresses, ordered by rank."""
+        return [job['worker_{}'.format(i)] for i in range(self.num_workers)]
+
+    def get_tf_config(self, job):
+        """Returns the TF_CONFIG of this participant."""
+        return {
+            'cluster': {'worker': self.get_cluster(job)},
+            'task': {'type': 'worker', 'index': self.rank},
+        }
+
+
+SCRIPT_TEMPLATE = '''\
+"""Multi-worker training of {model_name}, rank {rank}"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+CONFIG = json.loads({config!r})
+os.environ['TF_CONFIG'] = json.dumps(CONFIG['tf_config'])
+
+import numpy as np
+import tensorflow as tf
+
+if not hasattr(tf.distribute, 'MultiWorkerMirroredStrategy'):
+    sys.exit('Multi-worker training requires TensorFlow 2.4 or later, '
+             'found TensorFlow %s' % tf.__version__)
+
+
+def load_data(path):
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, f)
+                       for root, _, files in os.walk(path)
+                       for f in files if f.endswith('.npz'))
+    X, y = [], []
+    for p in paths:
+        with np.load(p) as data:
+            X.append(data['X'].astype('float32'))
+            y.append(data['y'])
+    X, y = np.concatenate(X), np.concatenate(y)
+    if CONFIG['normalization'] == 'std':
+        axes = tuple(range(1, X.ndim))
+        X = X - X.mean(axis=axes, keepdims=True)
+        X = X / np.maximum(X.std(axis=axes, keepdims=True), 1e-7)
+    # pixelwise foreground/background targets
+    return X, (y > 0).astype('int32')
+
+
+def build_model(channels, ndim):
+    conv = tf.keras.layers.Conv3D if ndim == 3 else tf.keras.layers.Conv2D
+    inputs = tf.keras.Input((None,) * ndim + (channels,))
+    x = inputs
+    for filters in (32, 64, 64):
+        x = conv(filters, 3, padding='same', activation='relu')(x)
+        x = tf.keras.layers.BatchNormalization()(x)
+    outputs = conv(2, 1, activation='softmax')(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+def save(model, path):
+    if hasattr(model, 'export'):
+        model.export(path)
+    else:
+        tf.saved_model.save(model, path)
+
+
+strategy = tf.distribute.MultiWorkerMirroredStrategy()
+task = CONFIG['tf_config']['task']
+is_chief = task['index'] == 0
+
+X, y = load_data(CONFIG['data'])
+batch_size = CONFIG['batch_size'] * strategy.num_replicas_in_sync
+steps_per_epoch = max(len(X) // batch_size, 1)
+options = tf.data.Options()
+options.experimental_distribute.auto_shard_policy = \\
+    tf.data.experimental.AutoShardPolicy.DATA
+dataset = tf.data.Dataset.from_tensor_slices((X, y))
+dataset = dataset.shuffle(len(X), seed=0).repeat().batch(batch_size)
+dataset = dataset.with_options(options)
+iterator = iter(strategy.experimental_distribute_dataset(dataset))
+
+with strategy.scope():
+    model = build_model(X.shape[-1], CONFIG['ndim'])
+    optimizer = tf.keras.optimizers.get(CONFIG['optimizer'])
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(
+        reduction='none')
+
+
+def step(inputs, targets):
+    with tf.GradientTape() as tape:
+        losses = loss_fn(targets, model(inputs, training=True))
+        losses = tf.reduce_mean(
+            tf.reshape(losses, [tf.shape(losses)[0], -1]), axis=-1)
+        loss = tf.nn.compute_average_loss(
+            losses, global_batch_size=batch_size)
+    grads = tape.gradient(loss, model.trainable_variables)
+    optimizer.apply_gradients(zip(grads, model.trainable_variables))
+    return loss
+
+
+@tf.function
+def train_step(iterator):
+    loss = strategy.run(step, args=next(iterator))
+    return strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None)
+
+
+writer = None
+if is_chief and CONFIG['log_dir']:
+    writer = tf.summary.create_file_writer(
+        os.path.join(CONFIG['log_dir'], CONFIG['model_name']))
+
+for epoch in range(CONFIG['epochs']):
+    total = 0.0
+    for _ in range(steps_per_epoch):
+        total += float(train_step(iterator))
+    print('Epoch %d/%d - loss: %.4f' % (
+        epoch + 1, CONFIG['epochs'], total / steps_per_epoch), flush=True)
+    if writer is not None:
+        with writer.as_default():
+            tf.summary.scalar('loss', total / steps_per_epoch, step=epoch)
+
+# every worker must save, but only the chief's export is kept
+if is_chief:
+    save(model, os.path.join(CONFIG['export_dir'], CONFIG['model_name'], '1'))
+else:
+    tempdir = tempfile.mkdtemp()
+    save(model, tempdir)
+    shutil.rmtree(tempdir, ignore_errors=True)
+'''
+
+
+def make_script(data, tf_config, **kwargs):
+    """Write a training script using a multi-worker strategy.
+
+    Args:
+        data: the path to the downloaded dataset
+        tf_config: TF_CONFIG of this participant
+        kwargs: named key/value pairs from the redis hash.  The output_dir,
+            export_dir and log_dir default to the configured settings.
+
+    Returns:
+        path to the script
+
+    Raises:
+        ValueError: if the script cannot train the requested model
+    """
+    if not data:
+        raise ValueError('`data` is required to download training data')
+
+    check_supported(**kwargs)
+
+    training_kwargs = utils.get_training_kwargs(**kwargs)
+    rank = tf_config['task']['index']
+    output_dir = kwargs.get('output_dir', settings.NOTEBOOK_DIR)
+    config = {
+        'data': os.path.abspath(data),
+        'tf_config': tf_config,
+        'model_name': kwargs.get('model_name'),
+        'export_dir': kwargs.get('export_dir', settings.EXPORT_DIR),
+        'log_dir': kwargs.get('log_dir', settings.LOG_DIR),
+        'batch_size': int(kwargs.get('batch_size', 16)),
+        'epochs': training_kwargs['epochs'],
+        'ndim': training_kwargs['ndim'],
+        'optimizer': training_kwargs['optimizer'],
+        'normalization': training_kwargs['normalization'],
+    }
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    script_path = os.path.join(output_dir, '{}_worker{}.py'.format(
+        config['model_name'], rank))
+    with open(script_path, 'w') as f:
+        f.write(SCRIPT_TEMPLATE.format(
+            model_name=config['model_name'], rank=rank,
+            config=json.dumps(config, sort_keys=True)))
+
+    logger.info('Saved training script to %s', script_path)
+    return script_path
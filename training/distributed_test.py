@@ -0,0 +1,258 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for multi-worker training coordination"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import pytest
+
+from training import distributed
+from training import job_store
+from training import loadtest
+from training import settings
+from training import worker
+
+
+def _gathering(redis_client, num_workers=2):
+    redis_client.hmset('train_a', {
+        'status': 'gathering',
+        'num_workers': num_workers,
+        'ranks': num_workers,
+    })
+    for i in range(num_workers):
+        redis_client.hset('train_a', 'worker_{}'.format(i),
+                          'host:{}'.format(i))
+    return job_store.JobStore(redis_client, prefix='train', backoff=0)
+
+
+def test_get_num_workers():
+    assert distributed.get_num_workers({}) == 1
+    assert distributed.get_num_workers({'num_workers': ''}) == 1
+    assert distributed.get_num_workers({'num_workers': '0'}) == 1
+    assert distributed.get_num_workers({'num_workers': '4'}) == 4
+
+
+def test_get_tensorflow_version():
+    version = distributed.get_tensorflow_version()
+    try:
+        import tensorflow as tf
+    except ImportError:
+        assert version is None
+    else:
+        assert version == tuple(int(v) for v in tf.__version__.split('.')[:2])
+
+
+def test_check_supported(monkeypatch):
+    monkeypatch.setattr(distributed, 'get_tensorflow_version',
+                        lambda: (2, 4))
+    distributed.check_supported(transform='fgbg')
+    distributed.check_supported(transform='fgbg', training_type='conv',
+                                skips='0', distance_bins='2')
+    # the default transform is watershed
+    with pytest.raises(ValueError):
+        distributed.check_supported()
+    for kwargs in ({'training_type': 'sample'}, {'skips': '1'}):
+        with pytest.raises(ValueError):
+            distributed.check_supported(transform='fgbg', **kwargs)
+
+    # the base image may ship TensorFlow 1.x
+    for version in ((1, 15), None):
+        monkeypatch.setattr(distributed, 'get_tensorflow_version',
+                            lambda: version)
+        with pytest.raises(ValueError) as excinfo:
+            distributed.check_supported(transform='fgbg')
+        assert 'requires TensorFlow 2.4' in str(excinfo.value)
+
+
+def test_get_address():
+    assert distributed.get_address('host', 1234) == 'host:1234'
+    host, port = distributed.get_address('localhost', 0).split(':')
+    assert host == 'localhost'
+    assert int(port) > 0
+
+
+class TestRendezvous(object):
+
+    def test_barrier(self, redis_client):
+        jobs = _gathering(redis_client, num_workers=3)
+        results = []
+
+        def participate(rank):
+            rendezvous = distributed.Rendezvous(jobs, 'train_a', rank, 3,
+                                                timeout=10, interval=0.01)
+            job = rendezvous.barrier('ready')
+            results.append(rendezvous.get_tf_config(job))
+
+        threads = [threading.Thread(target=participate, args=(i,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        assert sorted(r['task']['index'] for r in results) == [0, 1, 2]
+        for result in results:
+            assert result['task']['type'] == 'worker'
+            assert result['cluster'] == {
+                'worker': ['host:0', 'host:1', 'host:2']}
+
+    def test_timeout(self, redis_client):
+        jobs = _gathering(redis_client)
+        rendezvous = distributed.Rendezvous(jobs, 'train_a', 0, 2,
+                                            timeout=0.05, interval=0.01)
+        with pytest.raises(distributed.RendezvousError) as excinfo:
+            rendezvous.barrier('ready')
+        assert 'Only 1 of 2 workers' in str(excinfo.value)
+
+    def test_failed_job(self, redis_client):
+        jobs = _gathering(redis_client)
+        jobs.mark_failed('train_a', 'boom')
+        rendezvous = distributed.Rendezvous(jobs, 'train_a', 1, 2,
+                                            timeout=10, interval=0.01)
+        with pytest.raises(distributed.RendezvousError):
+            rendezvous.barrier('ready')
+
+    def test_requeued_job(self, redis_client):
+        jobs = _gathering(redis_client)
+        rendezvous = distributed.Rendezvous(jobs, 'train_a', 1, 2,
+                                            timeout=10, interval=0.01)
+
+        def requeue():
+            time.sleep(0.05)
+            jobs.requeue('train_a', 'gathering',
+                         fields=distributed.CLUSTER_FIELDS,
+                         prefixes=distributed.CLUSTER_PREFIXES)
+
+        thread = threading.Thread(target=requeue)
+        thread.start()
+        try:
+            with pytest.raises(distributed.RendezvousError) as excinfo:
+                rendezvous.barrier('ready')
+            assert 'was put back' in str(excinfo.value)
+        finally:
+            thread.join()
+
+
+def test_make_script(monkeypatch):
+    monkeypatch.setattr(distributed, 'get_tensorflow_version',
+                        lambda: (2, 4))
+    tf_config = {'cluster': {'worker': ['host:0', 'host:1']},
+                 'task': {'type': 'worker', 'index': 1}}
+    with tempfile.TemporaryDirectory() as tempdir:
+        with pytest.raises(ValueError):
+            distributed.make_script(None, tf_config, model_name='m')
+        with pytest.raises(ValueError):
+            distributed.make_script('data.npz', tf_config, model_name='m',
+                                    output_dir=tempdir, transform='watershed')
+
+        path = distributed.make_script(
+            'data.npz', tf_config, model_name='m', output_dir=tempdir,
+            export_dir='exports', log_dir='', epochs='3', batch_size='4',
+            transform='fgbg')
+        assert path == os.path.join(tempdir, 'm_worker1.py')
+
+        with open(path) as f:
+            source = f.read()
+        compile(source, path, 'exec')
+        namespace = {}
+        exec(source.split('\nimport numpy')[0], namespace)
+        config = namespace['CONFIG']
+        assert config['tf_config'] == tf_config
+        assert config['data'] == os.path.abspath('data.npz')
+        assert config['epochs'] == 3
+        assert config['batch_size'] == 4
+        assert json.loads(os.environ.pop('TF_CONFIG')) == tf_config
+
+
+def test_multi_worker_training(redis_client, monkeypatch):
+    # two workers train one job, each in its own process on this host
+    pytest.importorskip('tensorflow')
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        for name in ('bucket/uploads', 'notebooks', 'exports'):
+            os.makedirs(os.path.join(tempdir, name))
+        monkeypatch.setattr(settings, 'NOTEBOOK_DIR',
+                            os.path.join(tempdir, 'notebooks'))
+        monkeypatch.setattr(settings, 'EXPORT_DIR',
+                            os.path.join(tempdir, 'exports'))
+        monkeypatch.setattr(settings, 'LOG_DIR', '')
+
+        rng = np.random.RandomState(0)
+        np.savez(os.path.join(tempdir, 'bucket', 'uploads', 'data.npz'),
+                 X=rng.random_sample((8, 16, 16, 1)),
+                 y=rng.randint(0, 3, size=(8, 16, 16, 1)))
+        redis_client.hmset('train_a', {
+            'status': 'new',
+            'file_name': 'uploads/data.npz',
+            'num_workers': 2,
+            'transform': 'fgbg',
+            'epochs': 1,
+            'batch_size': 2,
+        })
+        jobs = job_store.JobStore(redis_client, prefix='train', backoff=0)
+
+        trainers, threads = [], []
+        for i in range(2):
+            download_dir = os.path.join(tempdir, 'download_{}'.format(i))
+            os.makedirs(download_dir)
+            trainer = worker.Worker(
+                jobs, loadtest.LocalStorage(os.path.join(tempdir, 'bucket'),
+                                            download_dir),
+                download_dir=download_dir, prefetch=False,
+                cache_results=False, worker_host='localhost', interval=0.05)
+            trainers.append(trainer)
+            threads.append(threading.Thread(target=trainer.run,
+                                            args=(True,)))
+            threads[-1].daemon = True
+            threads[-1].start()
+
+        # the chief finishes the job once both workers have trained
+        deadline = time.time() + 300
+        while time.time() < deadline and \
+                redis_client.hget('train_a', 'status') not in ('done',
+                                                               'failed'):
+            time.sleep(0.1)
+        for trainer in trainers:
+            trainer.stop()
+        for thread in threads:
+            thread.join(30)
+
+        job = redis_client.hgetall('train_a')
+        assert job['status'] == 'done', job.get('reason')
+        assert job['ranks'] == '2'
+        assert job['barrier_ready'] == '2'
+        assert job['rendezvous'] == job['worker_0']
+        export = os.path.join(tempdir, 'exports', job['model'], '1')
+        assert os.path.isfile(os.path.join(export, 'saved_model.pb'))
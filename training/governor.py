@@ -0,0 +1,325 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Enforce per-job resource limits on the notebook process tree"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import logging
+import signal
+import subprocess
+import threading
+import time
+import timeit
+
+from training import settings
+
+
+logger = logging.getLogger('training.governor')
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class ResourceLimitExceeded(Exception):
+    """Raised when a job exceeds one of its resource limits.
+
+    Args:
+        limit: name of the limit, e.g. "max_memory"
+        value: the measured value
+        maximum: the configured limit
+    """
+
+    def __init__(self, limit, value, maximum):
+        self.limit = limit
+        self.value = value
+        self.maximum = maximum
+        super(ResourceLimitExceeded, self).__init__(
+            'Exceeded {}: {} > {}'.format(limit, value, maximum))
+
+
+def get_directory_size(path):
+    """Returns the total size in bytes of all files under path."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:  # removed while walking
+                pass
+    return total
+
+
+def get_processes():
+    """Returns the parent PID, session ID, start time, state and resident
+    memory of every running process.
+
+    Returns:
+        processes: dict of PID to a (ppid, session, start, state, rss)
+            tuple, with rss in bytes
+    """
+    processes = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', pid, 'stat')) as f:
+                stat = f.read()
+            # the command name may contain spaces, so split after it.
+            # fields[0] is the state, fields[1] the parent PID, fields[3]
+            # the session ID, fields[19] the start time and fields[21]
+            # the RSS in pages.
+            fields = stat.rsplit(')', 1)[1].split()
+            processes[int(pid)] = (
+                int(fields[1]), int(fields[3]), int(fields[19]),
+                fields[0], int(fields[21]) * PAGE_SIZE)
+        except (IOError, OSError, IndexError, ValueError):
+            continue  # the process exited
+    return processes
+
+
+def get_process_tree(pid, processes=None):
+    """Returns every process started by pid.
+
+    The notebook kernel is launched in a session of its own, so the tree
+    is found by parent PID rather than by session.  Processes left in
+    pid's session after their parent exited are included as well.
+
+    Args:
+        pid: PID of the root process
+        processes: optional result of get_processes()
+
+    Returns:
+        tree: dict of PID to start time of pid and all its descendants,
+            so a PID reused by an unrelated process can be told apart
+    """
+    if processes is None:
+        processes = get_processes()
+
+    children = {}
+    for child, (ppid, session, _, _, _) in processes.items():
+        children.setdefault(ppid, []).append(child)
+        if session == pid and child != pid:
+            children.setdefault(pid, []).append(child)
+
+    tree = {}
+    pending = [pid]
+    while pending:
+        parent = pending.pop()
+        if parent in tree or parent not in processes:
+            continue
+        tree[parent] = processes[parent][2]
+        pending.extend(children.get(parent, []))
+    return tree
+
+
+def get_tree_rss(pid):
+    """Returns the total resident memory of pid and all its descendants.
+
+    Args:
+        pid: PID of the root process
+
+    Returns:
+        rss: resident set size in bytes
+    """
+    processes = get_processes()
+    return sum(processes[p][4] for p in get_process_tree(pid, processes))
+
+
+def _alive(tree):
+    """Returns the PIDs in tree that are still running."""
+    processes = get_processes()
+    return [pid for pid, start in tree.items()
+            if pid in processes and processes[pid][2] == start
+            and processes[pid][3] != 'Z']
+
+
+def _parse_limit(hash_values, field, default):
+    value = hash_values.get(field)
+    if value in (None, ''):
+        return default
+    try:
+        value = float(value)
+    except ValueError:
+        raise ValueError('Bad value for {}: {}'.format(field, value))
+    # jobs may lower a configured limit, but never lift it
+    if default and (not value or value > default):
+        return default
+    return value
+
+
+class ResourceGovernor(object):
+    """Run a command and kill it if it exceeds its resource limits.
+
+    The whole process tree of the command is measured and terminated,
+    including processes that started sessions of their own.  A limit of 0
+    is unlimited.
+
+    Args:
+        max_runtime: maximum wall-clock time in seconds
+        max_memory: maximum total resident memory in bytes
+        max_disk: maximum size of scratch_dir in bytes
+        scratch_dir: directory the command writes to
+        interval: seconds between checks
+        grace: seconds to wait after SIGTERM before sending SIGKILL
+        placement: optional CPUPlacement sizing the command's thread
+            pools and pinning it to CPUs
+    """
+
+    def __init__(self, max_runtime=settings.MAX_RUNTIME,
+                 max_memory=settings.MAX_MEMORY,
+                 max_disk=settings.MAX_DISK,
+                 scratch_dir=None,
+                 interval=settings.RESOURCE_CHECK_INTERVAL,
+                 grace=settings.TERMINATION_GRACE,
+                 placement=None):
+        self.max_runtime = max_runtime
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.scratch_dir = scratch_dir
+        self.interval = interval
+        self.grace = grace
+        self.placement = placement
+
+    @classmethod
+    def from_hash(cls, hash_values, scratch_dir=None, placement=None):
+        """Create a governor using the limits in the job hash.
+
+        Args:
+            hash_values: job hash with optional max_runtime, max_memory and
+                max_disk fields, falling back to the settings defaults.
+                Non-zero defaults cap the job's values.
+            scratch_dir: directory the job writes to
+            placement: optional CPUPlacement of the job
+
+        Returns:
+            governor: ResourceGovernor for the job
+        """
+        return cls(
+            max_runtime=_parse_limit(
+                hash_values, 'max_runtime', settings.MAX_RUNTIME),
+            max_memory=_parse_limit(
+                hash_values, 'max_memory', settings.MAX_MEMORY),
+            max_disk=_parse_limit(
+                hash_values, 'max_disk', settings.MAX_DISK),
+            scratch_dir=scratch_dir,
+            placement=placement)
+
+    def check(self, pid, runtime):
+        """Raise ResourceLimitExceeded if the process tree is over a limit.
+
+        Args:
+            pid: PID of the root process
+            runtime: seconds since the process started
+        """
+        if self.max_runtime and runtime > self.max_runtime:
+            raise ResourceLimitExceeded(
+                'max_runtime', int(runtime), self.max_runtime)
+
+        if self.max_memory:
+            rss = get_tree_rss(pid)
+            if rss > self.max_memory:
+                raise ResourceLimitExceeded('max_memory', rss, self.max_memory)
+
+        if self.max_disk and self.scratch_dir:
+            used = get_directory_size(self.scratch_dir)
+            if used > self.max_disk:
+                raise ResourceLimitExceeded('max_disk', used, self.max_disk)
+
+    def terminate(self, proc):
+        """Send SIGTERM to the process and all its descendants, then
+        SIGKILL after the grace period to any that have not exited."""
+        tree = {}
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            # descendants may have been orphaned by now, so keep the
+            # ones already seen
+            tree.update(get_process_tree(proc.pid))
+            for pid in _alive(tree):
+                try:
+                    os.kill(pid, sig)
+                except OSError:  # already exited
+                    pass
+
+            deadline = timeit.default_timer() + self.grace
+            while timeit.default_timer() < deadline:
+                if proc.poll() is not None and not _alive(tree):
+                    return
+                time.sleep(min(self.interval, 0.1))
+            logger.warning('Process %s did not exit %s seconds after '
+                           'signal %s.', proc.pid, self.grace, sig)
+        proc.wait()
+
+    def check_output(self, cmd):
+        """Run cmd, enforcing the limits, and return its output.
+
+        Like subprocess.check_output with stderr merged into stdout.
+
+        Returns:
+            output: the combined stdout and stderr bytes
+
+        Raises:
+            ResourceLimitExceeded: if a limit was hit
+            subprocess.CalledProcessError: if cmd exits with an error
+        """
+        env = None
+        if self.placement is not None:
+            cmd = self.placement.command() + list(cmd)
+            # variables set explicitly take precedence
+            env = dict(self.placement.env(), **os.environ)
+
+        start = timeit.default_timer()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=True,
+                                env=env)
+
+        # drain the output in a thread so the pipe never fills up
+        chunks = []
+        reader = threading.Thread(
+            target=lambda: chunks.extend(iter(proc.stdout.readline, b'')))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            while True:
+                try:
+                    proc.wait(timeout=self.interval)
+                    break
+                except subprocess.TimeoutExpired:
+                    self.check(proc.pid, timeit.default_timer() - start)
+        except BaseException as err:
+            logger.error('Terminating `%s`: %s', ' '.join(cmd), err)
+            self.terminate(proc)
+            raise err
+        finally:
+            reader.join(self.grace)
+            proc.stdout.close()
+
+        output = b''.join(chunks)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(
+                proc.returncode, cmd, output=output)
+        return output
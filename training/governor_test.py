@@ -0,0 +1,190 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the per-job resource governor"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+from training import cpu
+from training import governor
+from training import settings
+
+
+def _python(code):
+    return [sys.executable, '-c', code]
+
+
+def test_get_directory_size():
+    with tempfile.TemporaryDirectory() as tempdir:
+        os.makedirs(os.path.join(tempdir, 'sub'))
+        for path, size in (('a', 10), (os.path.join('sub', 'b'), 5)):
+            with open(os.path.join(tempdir, path), 'wb') as f:
+                f.write(b'x' * size)
+        assert governor.get_directory_size(tempdir) == 15
+        assert governor.get_directory_size(os.path.join(tempdir, 'x')) == 0
+
+
+def test_get_process_tree():
+    proc = subprocess.Popen(_python('import time; time.sleep(30)'))
+    try:
+        tree = governor.get_process_tree(os.getpid())
+        assert os.getpid() in tree
+        assert proc.pid in tree
+        assert os.getppid() not in tree
+        assert governor.get_process_tree(-1) == {}
+        assert governor.get_tree_rss(os.getpid()) > 0
+        assert governor.get_tree_rss(-1) == 0
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+class TestResourceGovernor(object):
+
+    def test_from_hash(self):
+        gov = governor.ResourceGovernor.from_hash({}, scratch_dir='dir')
+        assert gov.max_runtime == settings.MAX_RUNTIME
+        assert gov.max_memory == settings.MAX_MEMORY
+        assert gov.max_disk == settings.MAX_DISK
+        assert gov.scratch_dir == 'dir'
+
+        gov = governor.ResourceGovernor.from_hash(
+            {'max_runtime': '60', 'max_memory': '1e9', 'max_disk': ''})
+        assert gov.max_runtime == 60
+        assert gov.max_memory == 1e9
+        assert gov.max_disk == settings.MAX_DISK
+
+        with pytest.raises(ValueError):
+            governor.ResourceGovernor.from_hash({'max_runtime': 'forever'})
+
+    def test_from_hash_capped(self, monkeypatch):
+        monkeypatch.setattr(settings, 'MAX_RUNTIME', 3600)
+        monkeypatch.setattr(settings, 'MAX_MEMORY', 1e9)
+        monkeypatch.setattr(settings, 'MAX_DISK', 0)
+        # jobs cannot lift the configured limits
+        gov = governor.ResourceGovernor.from_hash(
+            {'max_runtime': '0', 'max_memory': '1e12', 'max_disk': '1e12'})
+        assert gov.max_runtime == 3600
+        assert gov.max_memory == 1e9
+        assert gov.max_disk == 1e12
+
+        gov = governor.ResourceGovernor.from_hash(
+            {'max_runtime': '60', 'max_memory': '1e6'})
+        assert gov.max_runtime == 60
+        assert gov.max_memory == 1e6
+        assert gov.max_disk == 0
+
+    def test_check_output(self):
+        gov = governor.ResourceGovernor(interval=0.1)
+        output = gov.check_output(_python('print("hello")'))
+        assert output.strip() == b'hello'
+
+        with pytest.raises(subprocess.CalledProcessError) as excinfo:
+            gov.check_output(_python('import sys; print("bad"); sys.exit(3)'))
+        assert excinfo.value.returncode == 3
+        assert excinfo.value.output.strip() == b'bad'
+
+    def test_placement(self, monkeypatch):
+        monkeypatch.setenv('MKL_NUM_THREADS', '5')
+        monkeypatch.delenv('OMP_NUM_THREADS', raising=False)
+        code = ('import os; print(os.environ["OMP_NUM_THREADS"], '
+                'os.environ["MKL_NUM_THREADS"], '
+                'sorted(os.sched_getaffinity(0)))')
+        cpus = sorted(os.sched_getaffinity(0))[:1]
+        placement = cpu.CPUPlacement(3, cpus=cpus)
+        gov = governor.ResourceGovernor(interval=0.1, placement=placement)
+        output = gov.check_output(_python(code)).decode().split()
+        # variables already set are kept
+        assert output[:2] == ['3', '5']
+        if placement.command():
+            assert ' '.join(output[2:]) == str(cpus)
+
+    def test_max_runtime(self):
+        gov = governor.ResourceGovernor(max_runtime=0.5, interval=0.1,
+                                        grace=1)
+        with pytest.raises(governor.ResourceLimitExceeded) as excinfo:
+            gov.check_output(_python('import time; time.sleep(30)'))
+        assert excinfo.value.limit == 'max_runtime'
+
+    def test_max_runtime_kills_ignored_sigterm(self):
+        code = ('import signal, time; '
+                'signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+                'print("ready", flush=True); time.sleep(30)')
+        gov = governor.ResourceGovernor(max_runtime=0.5, interval=0.1,
+                                        grace=0.5)
+        with pytest.raises(governor.ResourceLimitExceeded):
+            gov.check_output(_python(code))
+
+    def test_max_memory(self):
+        code = 'import time; x = bytearray(200 * 1024 ** 2); time.sleep(30)'
+        gov = governor.ResourceGovernor(max_memory=100 * 1024 ** 2,
+                                        interval=0.1, grace=1)
+        with pytest.raises(governor.ResourceLimitExceeded) as excinfo:
+            gov.check_output(_python(code))
+        assert excinfo.value.limit == 'max_memory'
+        assert excinfo.value.value > 100 * 1024 ** 2
+
+    def test_max_memory_new_session(self):
+        # the notebook kernel is started in a session of its own
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'pid')
+            child = ('import os, time; os.setsid(); '
+                     'open({!r}, "w").write(str(os.getpid())); '
+                     'x = bytearray(200 * 1024 ** 2); '
+                     'time.sleep(30)').format(path)
+            code = ('import subprocess, sys; '
+                    'subprocess.call([sys.executable, "-c", {!r}])'
+                    ).format(child)
+            gov = governor.ResourceGovernor(max_memory=100 * 1024 ** 2,
+                                            interval=0.1, grace=1)
+            with pytest.raises(governor.ResourceLimitExceeded) as excinfo:
+                gov.check_output(_python(code))
+            assert excinfo.value.limit == 'max_memory'
+
+            with open(path) as f:
+                pid = int(f.read())
+            # the orphaned process may linger as a zombie until reaped
+            state = governor.get_processes().get(pid, (0, 0, 0, 'Z', 0))[3]
+            assert state == 'Z'
+
+    def test_max_disk(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'out')
+            code = ('import time; open({!r}, "wb").write(b"x" * 4096); '
+                    'time.sleep(30)').format(path)
+            gov = governor.ResourceGovernor(max_disk=1024, scratch_dir=tempdir,
+                                            interval=0.1, grace=1)
+            with pytest.raises(governor.ResourceLimitExceeded) as excinfo:
+                gov.check_output(_python(code))
+            assert excinfo.value.limit == 'max_disk'
+            assert str(excinfo.value) == 'Exceeded max_disk: 4096 > 1024'
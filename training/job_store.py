@@ -0,0 +1,385 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Redis access layer for training job hashes"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import logging
+
+import redis
+from redis import exceptions as redis_exceptions
+
+from training import settings
+
+
+# Errors worth retrying: the command never reached redis or redis is busy.
+TRANSIENT_ERRORS = (
+    redis_exceptions.ConnectionError,
+    redis_exceptions.TimeoutError,
+    redis_exceptions.BusyLoadingError,
+)
+
+
+def get_client(host=settings.REDIS_HOST, port=settings.REDIS_PORT,
+               timeout=settings.REDIS_TIMEOUT):
+    """Returns a redis client backed by a shared connection pool.
+
+    Args:
+        host: hostname of the redis server
+        port: port of the redis server
+        timeout: socket timeout in seconds
+
+    Returns:
+        client: StrictRedis client that decodes responses to strings
+    """
+    pool = redis.ConnectionPool(
+        host=host,
+        port=port,
+        socket_timeout=timeout,
+        socket_connect_timeout=timeout,
+        decode_responses=True,
+        encoding='utf-8')
+    return redis.StrictRedis(connection_pool=pool)
+
+
+class JobStore(object):
+    """Read and update training job hashes in redis.
+
+    Related field updates are grouped into a single MULTI/EXEC pipeline
+    so a job is never observed half-updated, and idempotent operations
+    are retried when redis drops the connection.
+
+    Args:
+        client: redis client, defaults to a new pooled client
+        prefix: only hashes with keys starting with prefix are jobs
+        retries: number of times to retry a transient error
+        backoff: seconds to wait between retries
+        expire_time: seconds to keep finished or failed hashes
+        cache_prefix: prefix of the keys indexing completed results
+        cache_ttl: seconds to keep an indexed result, 0 to keep forever
+        channel: pub/sub channel announcing the keys of new jobs
+    """
+
+    def __init__(self, client=None, prefix=settings.HASH_PREFIX,
+                 retries=settings.REDIS_RETRIES,
+                 backoff=settings.REDIS_BACKOFF,
+                 expire_time=settings.EXPIRE_TIME,
+                 cache_prefix=settings.RESULT_CACHE_PREFIX,
+                 cache_ttl=settings.RESULT_CACHE_TTL,
+                 channel=settings.JOB_CHANNEL):
+        if client is None:
+            client = get_client()
+        self.client = client
+        self.prefix = prefix
+        self.cache_prefix = cache_prefix
+        self.cache_ttl = cache_ttl
+        self.channel = channel
+        self.retries = retries
+        self.backoff = backoff
+        self.expire_time = expire_time
+        self.logger = logging.getLogger(str(self.__class__.__name__))
+
+    def _retry(self, func, *args, **kwargs):
+        """Call func, retrying on transient redis errors.
+
+        Only idempotent operations should be wrapped, as a command may
+        have been applied before the connection was lost.
+        """
+        attempts = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except TRANSIENT_ERRORS as err:
+                attempts += 1
+                if attempts > self.retries:
+                    self.logger.error('Encountered %s: %s after %s attempts.',
+                                      type(err).__name__, err, attempts)
+                    raise err
+                self.logger.warning('Encountered %s: %s.  Backing off for %s '
+                                    'seconds...', type(err).__name__, err,
+                                    self.backoff)
+                time.sleep(self.backoff)
+
+    def _iter_keys(self):
+        match = '{}*'.format(self.prefix)
+        return list(self.client.scan_iter(match=match))
+
+    def iter_job_keys(self):
+        """Returns the keys of all job hashes.
+
+        Uses SCAN rather than KEYS to avoid blocking redis.
+        """
+        for key in self._retry(self._iter_keys):
+            if self._retry(self.client.type, key) == 'hash':
+                yield key
+
+    def get_hash_with_status(self, status=settings.STATUS):
+        """Find a job hash with the given status.
+
+        Args:
+            status: value of the hash's status field
+
+        Returns:
+            key of the first matching hash, or None if there is none
+        """
+        for key in self.iter_job_keys():
+            if self._retry(self.client.hget, key, 'status') == status:
+                self.logger.debug('Found key %s with status "%s".',
+                                  key, status)
+                return key
+
+        self.logger.debug('Could not find a redis hash with status "%s".',
+                          status)
+        return None
+
+    def claim(self, key, status, new_status, **fields):
+        """Atomically move a hash from status to new_status.
+
+        Uses WATCH/MULTI so that only one worker can claim the job.
+        Not retried: the transition is not idempotent.
+
+        Args:
+            key: redis key of the job hash
+            status: the status the job must currently have
+            new_status: the status to set if the claim succeeds
+            fields: additional fields to set along with the status
+
+        Returns:
+            True if this call claimed the job, otherwise False
+        """
+        fields['status'] = new_status
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.hget(key, 'status') != status:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.hmset(key, fields)
+                pipe.execute()
+            except redis_exceptions.WatchError:
+                self.logger.debug('Lost race to claim %s.', key)
+                return False
+        self.logger.debug('Claimed %s with status "%s".', key, new_status)
+        return True
+
+    def claim_next(self, status=settings.STATUS, new_status='claimed',
+                   keys=None, **fields):
+        """Claim the first available job hash with the given status.
+
+        Args:
+            status: the status the job must currently have
+            new_status: the status to set if the claim succeeds
+            keys: candidate keys to try instead of scanning all jobs
+            fields: additional fields to set along with the status
+
+        Returns:
+            key of the claimed hash, or None if no job could be claimed
+        """
+        if keys is None:
+            keys = self.iter_job_keys()
+        for key in keys:
+            if self._retry(self.client.hget, key, 'status') != status:
+                continue
+            if self.claim(key, status, new_status, **fields):
+                return key
+        return None
+
+    def join(self, key, address, status='gathering'):
+        """Atomically take the next free rank of a distributed job.
+
+        Uses WATCH/MULTI so that every rank is taken by a single worker.
+        Not retried: the transition is not idempotent.
+
+        Args:
+            key: redis key of the job hash
+            address: "host:port" the other participants reach this worker at
+            status: the status of jobs waiting for participants
+
+        Returns:
+            the rank taken, or None if the job is not waiting or is full
+        """
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                job = pipe.hgetall(key)
+                rank = int(job.get('ranks', 0))
+                if job.get('status') != status or \
+                        rank >= int(job.get('num_workers', 1)):
+                    pipe.unwatch()
+                    return None
+                pipe.multi()
+                pipe.hmset(key, {
+                    'ranks': rank + 1,
+                    'worker_{}'.format(rank): address,
+                })
+                pipe.execute()
+            except redis_exceptions.WatchError:
+                self.logger.debug('Lost race to join %s.', key)
+                return None
+        self.logger.debug('Joined %s as rank %s.', key, rank)
+        return rank
+
+    def join_next(self, address, status='gathering', keys=None):
+        """Join the first distributed job waiting for participants.
+
+        Args:
+            address: "host:port" the other participants reach this worker at
+            status: the status of jobs waiting for participants
+            keys: candidate keys to try instead of scanning all jobs
+
+        Returns:
+            key of the joined hash and the rank taken, or (None, None)
+        """
+        if keys is None:
+            keys = self.iter_job_keys()
+        for key in keys:
+            if self._retry(self.client.hget, key, 'status') != status:
+                continue
+            rank = self.join(key, address, status)
+            if rank is not None:
+                return key, rank
+        return None, None
+
+    def requeue(self, key, status, new_status=settings.STATUS, fields=(),
+                prefixes=()):
+        """Atomically move a hash from status back to new_status.
+
+        Uses WATCH/MULTI so that a participant joining at the same time
+        is not left behind in the cleared hash.
+
+        Args:
+            key: redis key of the job hash
+            status: the status the job must currently have
+            new_status: the status to put the job back in
+            fields: names of the fields to delete
+            prefixes: delete every field starting with one of these
+
+        Returns:
+            True if this call put the job back, otherwise False
+        """
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                job = pipe.hgetall(key)
+                if job.get('status') != status:
+                    pipe.unwatch()
+                    return False
+                names = [name for name in job if name in fields or
+                         any(name.startswith(p) for p in prefixes)]
+                pipe.multi()
+                if names:
+                    pipe.hdel(key, *names)
+                pipe.hset(key, 'status', new_status)
+                pipe.execute()
+            except redis_exceptions.WatchError:
+                self.logger.debug('Lost race to requeue %s.', key)
+                return False
+        self.logger.debug('Put %s back with status "%s".', key, new_status)
+        return True
+
+    def arrive(self, key, barrier):
+        """Count a participant of a distributed job at a barrier.
+
+        Not retried: the increment is not idempotent.
+
+        Returns:
+            number of participants that have arrived
+        """
+        return self.client.hincrby(key, 'barrier_{}'.format(barrier), 1)
+
+    def publish(self, key):
+        """Announce that the job is ready so idle workers claim it at once.
+
+        Returns:
+            number of subscribers that received the message
+        """
+        return self._retry(self.client.publish, self.channel, key)
+
+    def get_job(self, key):
+        """Returns all fields of the job hash as a dict."""
+        return self._retry(self.client.hgetall, key)
+
+    def get_field(self, key, field):
+        """Returns a single field of the job hash."""
+        return self._retry(self.client.hget, key, field)
+
+    def _update(self, key, fields, expire=None):
+        with self.client.pipeline() as pipe:
+            pipe.hmset(key, fields)
+            if expire is not None:
+                pipe.expire(key, expire)
+            return pipe.execute()
+
+    def update(self, key, expire=None, **fields):
+        """Set fields of the job hash in a single transaction.
+
+        Args:
+            key: redis key of the job hash
+            expire: optional TTL in seconds applied in the same transaction
+            fields: field/value pairs to write
+        """
+        self._retry(self._update, key, fields, expire)
+
+    def set_status(self, key, status, expire=None, **fields):
+        """Set the job status with any related fields."""
+        fields['status'] = status
+        self.update(key, expire=expire, **fields)
+
+    def mark_training(self, key, model, **fields):
+        """Record the model name and move the job to "training"."""
+        self.set_status(key, 'training', model=model, **fields)
+
+    def mark_done(self, key, **fields):
+        """Move the job to "done" and schedule the hash to expire."""
+        self.set_status(key, 'done', expire=self.expire_time, **fields)
+
+    def mark_failed(self, key, reason, **fields):
+        """Record the failure reason and schedule the hash to expire."""
+        self.set_status(key, 'failed', expire=self.expire_time,
+                        reason='{}'.format(reason), **fields)
+
+    def _cache_key(self, fingerprint):
+        return '{}:{}'.format(self.cache_prefix, fingerprint)
+
+    def get_cached_result(self, fingerprint):
+        """Returns the indexed result of an identical job, if any.
+
+        Args:
+            fingerprint: fingerprint of the training request
+
+        Returns:
+            dict of the cached result fields, or None
+        """
+        result = self._retry(self.client.hgetall, self._cache_key(fingerprint))
+        return result or None
+
+    def cache_result(self, fingerprint, **fields):
+        """Index the result of a completed job by its fingerprint."""
+        expire = self.cache_ttl if self.cache_ttl else None
+        self._retry(self._update, self._cache_key(fingerprint), fields, expire)
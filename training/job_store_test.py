@@ -0,0 +1,187 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the redis JobStore"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from redis import exceptions as redis_exceptions
+
+import pytest
+
+from training import job_store
+from training import settings
+
+
+def _make_jobs(client, prefix, status='new'):
+    client.hmset('%s_hash_1' % prefix, {'status': status})
+    client.hmset('%s_hash_2' % prefix, {'status': status})
+    client.hmset('hash_1', {'status': status})
+    client.set('%s_string_1' % prefix, 'value')
+
+
+class TestJobStore(object):
+
+    def test_get_hash_with_status(self, redis_client):
+        prefix = settings.HASH_PREFIX
+        _make_jobs(redis_client, prefix)
+        store = job_store.JobStore(redis_client, prefix=prefix, backoff=0)
+
+        rhash = store.get_hash_with_status('new')
+        assert rhash == '%s_hash_1' % prefix
+        assert store.get_hash_with_status('no_status') is None
+
+        # transient errors are retried
+        redis_client.fail_tolerance = 2
+        rhash = store.get_hash_with_status('new')
+        assert rhash == '%s_hash_1' % prefix
+
+        # but not forever
+        redis_client.fail_count = 0
+        redis_client.fail_tolerance = store.retries + 1
+        with pytest.raises(redis_exceptions.ConnectionError):
+            store.get_hash_with_status('new')
+
+    def test_iter_job_keys(self, redis_client):
+        prefix = settings.HASH_PREFIX
+        _make_jobs(redis_client, prefix)
+        store = job_store.JobStore(redis_client, prefix=prefix, backoff=0)
+        keys = sorted(store.iter_job_keys())
+        assert keys == ['%s_hash_1' % prefix, '%s_hash_2' % prefix]
+
+    def test_claim(self, redis_client):
+        store = job_store.JobStore(redis_client, prefix='train', backoff=0)
+        redis_client.hmset('train_a', {'status': 'new'})
+
+        assert store.claim('train_a', 'new', 'downloading', worker='w1')
+        assert redis_client.hget('train_a', 'status') == 'downloading'
+        assert redis_client.hget('train_a', 'worker') == 'w1'
+
+        # a second claim fails since the status has changed
+        assert not store.claim('train_a', 'new', 'downloading')
+
+        # another worker modifies the hash between WATCH and EXEC
+        redis_client.hmset('train_b', {'status': 'new'})
+        original_hget = redis_client.hget
+
+        def racing_hget(key, field):
+            value = original_hget(key, field)
+            redis_client.hset(key, 'worker', 'w2')
+            return value
+
+        redis_client.hget = racing_hget
+        assert not store.claim('train_b', 'new', 'downloading')
+        redis_client.hget = original_hget
+        assert redis_client.hget('train_b', 'status') == 'new'
+
+    def test_claim_next(self, redis_client):
+        store = job_store.JobStore(redis_client, prefix='train', backoff=0)
+        assert store.claim_next('new') is None
+
+        redis_client.hmset('train_a', {'status': 'done'})
+        redis_client.hmset('train_b', {'status': 'new'})
+        key = store.claim_next('new', 'downloading')
+        assert key == 'train_b'
+        assert store.claim_next('new', 'downloading') is None
+
+    def test_join(self, redis_client):
+        store = job_store.JobStore(redis_client, prefix='train', backoff=0)
+        redis_client.hmset('train_a', {'status': 'new', 'num_workers': 3})
+        assert store.join_next('host:1') == (None, None)
+
+        redis_client.hmset('train_a', {'status': 'gathering', 'ranks': 1,
+                                       'worker_0': 'host:0'})
+        assert store.join_next('host:1') == ('train_a', 1)
+        assert store.join('train_a', 'host:2') == 2
+        # every rank is taken
+        assert store.join('train_a', 'host:3') is None
+        job = store.get_job('train_a')
+        assert job['ranks'] == '3'
+        assert [job['worker_{}'.format(i)] for i in range(3)] == \
+            ['host:0', 'host:1', 'host:2']
+
+        assert store.arrive('train_a', 'ready') == 1
+        assert store.arrive('train_a', 'ready') == 2
+        assert store.get_field('train_a', 'barrier_ready') == '2'
+
+    def test_requeue(self, redis_client):
+        store = job_store.JobStore(redis_client, prefix='train', backoff=0)
+        redis_client.hmset('train_a', {
+            'status': 'gathering', 'num_workers': 2, 'ranks': 1,
+            'worker_0': 'host:0', 'barrier_ready': 1, 'model': 'm'})
+        assert not store.requeue('train_a', 'training')
+        assert store.requeue('train_a', 'gathering', 'new',
+                             fields=('ranks', 'model'),
+                             prefixes=('worker_', 'barrier_'))
+        assert store.get_job('train_a') == {'status': 'new',
+                                            'num_workers': '2'}
+        # already put back
+        assert not store.requeue('train_a', 'gathering')
+
+    def test_update(self, redis_client):
+        store = job_store.JobStore(redis_client, prefix='train', backoff=0)
+        redis_client.hmset('train_a', {'status': 'new'})
+
+        redis_client.fail_tolerance = 1
+        store.update('train_a', expire=30, model='abc')
+        assert store.get_field('train_a', 'model') == 'abc'
+        assert redis_client.ttl('train_a') == 30
+
+        store.mark_training('train_a', 'model-name')
+        job = store.get_job('train_a')
+        assert job['status'] == 'training'
+        assert job['model'] == 'model-name'
+
+    def test_mark_done(self, redis_client):
+        store = job_store.JobStore(redis_client, prefix='train',
+                                   backoff=0, expire_time=5)
+        redis_client.hmset('train_a', {'status': 'training'})
+        store.mark_done('train_a')
+        assert redis_client.hget('train_a', 'status') == 'done'
+        assert redis_client.ttl('train_a') == 5
+
+    def test_mark_failed(self, redis_client):
+        store = job_store.JobStore(redis_client, prefix='train',
+                                   backoff=0, expire_time=5)
+        redis_client.hmset('train_a', {'status': 'training'})
+        store.mark_failed('train_a', ValueError('bad input'))
+        job = store.get_job('train_a')
+        assert job['status'] == 'failed'
+        assert job['reason'] == 'bad input'
+        assert redis_client.ttl('train_a') == 5
+
+    def test_cached_result(self, redis_client):
+        store = job_store.JobStore(redis_client, prefix='train', backoff=0,
+                                   cache_prefix='cache/training',
+                                   cache_ttl=60)
+        assert store.get_cached_result('abc') is None
+
+        store.cache_result('abc', model='model-name', job='train_a')
+        result = store.get_cached_result('abc')
+        assert result == {'model': 'model-name', 'job': 'train_a'}
+        assert redis_client.ttl('cache/training:abc') == 60
+        # the index is not mistaken for a job
+        assert not list(store.iter_job_keys())
@@ -0,0 +1,496 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Load test the job queue with simulated workers on a single machine"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import multiprocessing
+import os
+import logging
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+
+from training import checksum
+from training import dispatch
+from training import job_store
+from training import settings
+from training import storage
+from training import worker
+
+
+logger = logging.getLogger('training.loadtest')
+
+
+class LocalStorage(storage.Storage):
+    """A fake object store backed by a local directory.
+
+    Args:
+        bucket: path to the directory holding the objects
+        download_dir: path to local directory to save downloaded files
+    """
+
+    def _get_path(self, filepath):
+        return os.path.join(self.bucket, filepath.lstrip('/'))
+
+    def get_public_url(self, filepath):
+        return 'file://{}'.format(os.path.abspath(self._get_path(filepath)))
+
+    def get_object_info(self, filepath):
+        path = self._get_path(filepath)
+        if not os.path.isfile(path):
+            raise storage.StorageException('{} not found.'.format(filepath))
+        digest = checksum.file_digest(path, 'md5', self.chunk_size)
+        return os.path.getsize(path), {'md5': digest}
+
+    def list_objects(self, prefix):
+        objects = []
+        for root, _, files in os.walk(self.bucket):
+            for name in files:
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.bucket).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    objects.append((key, os.path.getsize(path)))
+        return sorted(objects)
+
+    def download_range(self, filepath, fileobj, start=0):
+        with open(self._get_path(filepath), 'rb') as f:
+            f.seek(start)
+            shutil.copyfileobj(f, fileobj, self.chunk_size)
+
+    def upload_fileobj(self, fileobj, dest):
+        path = self._get_path(dest)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(fileobj, f, self.chunk_size)
+        return self.get_public_url(dest)
+
+    def upload(self, filepath, subdir=None, dedupe=False):
+        dest = self.get_upload_path(filepath, subdir)
+        if dedupe and self.is_duplicate(filepath, dest):
+            self._record_upload(filepath, dest, skipped=True)
+            return dest, self.get_public_url(dest)
+        with open(filepath, 'rb') as f:
+            self.upload_fileobj(f, dest)
+        self._record_upload(filepath, dest)
+        return dest, self.get_public_url(dest)
+
+
+def noop_executor(notebook_path, governor):
+    """Executor that trains nothing."""
+    pass
+
+
+class SleepExecutor(object):
+    """Executor that pretends to train for a fixed number of seconds."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, notebook_path, governor):
+        time.sleep(self.seconds)
+
+
+def fake_notebook(data, **kwargs):
+    """Stand-in for utils.make_notebook that writes nothing."""
+    return os.path.join(kwargs.get('output_dir', ''),
+                        '{}.ipynb'.format(kwargs.get('model_name')))
+
+
+class CountingClient(object):
+    """Count the redis commands sent through a client.
+
+    Commands queued on a pipeline are counted individually, as redis
+    executes each of them.  Pub/sub connections are not counted.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name == 'pipeline':
+            return lambda *a, **kw: _CountingPipeline(attr(*a, **kw), self)
+        if name == 'pubsub' or not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.count(name)
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+class _CountingPipeline(object):
+
+    # bookkeeping calls that do not send a command
+    uncounted = ('reset', 'multi', 'execute', '__enter__', '__exit__')
+
+    def __init__(self, pipe, counter):
+        self._pipe = pipe
+        self._counter = counter
+
+    def __enter__(self):
+        self._pipe.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._pipe.__exit__(*args)
+
+    def __getattr__(self, name):
+        attr = getattr(self._pipe, name)
+        if name in self.uncounted or not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self._counter.count(name)
+            result = attr(*args, **kwargs)
+            # queued commands return the pipeline for chaining
+            return self if result is self._pipe else result
+
+        return counted
+
+
+class RecordingJobStore(job_store.JobStore):
+    """A JobStore that records when each job is claimed and trained."""
+
+    def __init__(self, client=None, events=None, **kwargs):
+        super(RecordingJobStore, self).__init__(client, **kwargs)
+        self.events = events
+
+    def _record(self, event, key):
+        self.events.append((event, key, time.time()))
+
+    def claim(self, key, status, new_status, **fields):
+        claimed = super(RecordingJobStore, self).claim(
+            key, status, new_status, **fields)
+        if claimed and new_status != status:
+            self._record('claim:{}'.format(status), key)
+        return claimed
+
+    def mark_training(self, key, model, **fields):
+        self._record('training', key)
+        super(RecordingJobStore, self).mark_training(key, model, **fields)
+
+    def mark_done(self, key, **fields):
+        super(RecordingJobStore, self).mark_done(key, **fields)
+        self._record('done', key)
+
+    def mark_failed(self, key, reason, **fields):
+        super(RecordingJobStore, self).mark_failed(key, reason, **fields)
+        self._record('failed', key)
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+def _get_commands_processed(client):
+    try:
+        return int(client.info('stats')['total_commands_processed'])
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def submit_jobs(jobs, datasets, num_jobs, status, publish=True):
+    """Write synthetic training job hashes, as the frontend would.
+
+    Args:
+        jobs: JobStore to write the hashes with
+        datasets: keys of the uploaded datasets, assigned in turn
+        num_jobs: number of jobs to submit
+        status: status of new jobs
+        publish: whether to announce each job on the job channel
+
+    Returns:
+        dict of job key to submission time
+    """
+    submitted = {}
+    for i in range(num_jobs):
+        key = '{}_{}'.format(jobs.prefix, i)
+        jobs.update(key, status=status, file_name=datasets[i % len(datasets)],
+                    epochs=1)
+        submitted[key] = time.time()
+        if publish:
+            jobs.publish(key)
+    return submitted
+
+
+def summarize(events, submitted, duration, num_ops=None):
+    """Compute the load test report from the recorded events.
+
+    Args:
+        events: list of (event, key, timestamp) tuples
+        submitted: dict of job key to submission time
+        duration: seconds from the first submission to the last finished job
+        num_ops: number of redis commands sent by the workers
+
+    Returns:
+        dict of load test metrics
+    """
+    claimed, trained = {}, collections.Counter()
+    finished = collections.Counter()
+    for event, key, timestamp in events:
+        if event.startswith('claim:') and key not in claimed and \
+                key in submitted:
+            claimed[key] = timestamp
+        elif event == 'training':
+            trained[key] += 1
+        elif event in ('done', 'failed'):
+            finished[event] += 1
+
+    latencies = [claimed[k] - submitted[k] for k in claimed]
+    num_jobs = len(submitted)
+    return {
+        'jobs': num_jobs,
+        'done': finished['done'],
+        'failed': finished['failed'],
+        'duration': duration,
+        'throughput': finished['done'] / duration if duration else None,
+        'claim_latency_p50': _percentile(latencies, 50),
+        'claim_latency_p95': _percentile(latencies, 95),
+        'claim_latency_p99': _percentile(latencies, 99),
+        'claim_latency_max': max(latencies) if latencies else None,
+        'duplicate_claims': sum(n - 1 for n in trained.values() if n > 1),
+        'redis_ops': num_ops,
+        'redis_ops_per_job': (num_ops / num_jobs if num_ops and num_jobs
+                              else None),
+    }
+
+
+class _QueueEvents(object):
+    """List-like sink sending the recorded events to the load test."""
+
+    def __init__(self, events_queue):
+        self.events_queue = events_queue
+
+    def append(self, event):
+        self.events_queue.put(event)
+
+
+def _run_worker(get_client, bucket, download_dir, events_queue,
+                results_queue, measuring, stopping, events=True, **kwargs):
+    """Run one simulated worker until stopping is set.
+
+    Runs in a process of its own, with its own redis client, like a pod.
+    A "ready" event is sent once the worker starts.  Once measuring is
+    set, the redis commands sent so far are forgotten, and the rest are
+    put on results_queue when the worker exits.
+    """
+    counter = None
+    try:
+        counter = CountingClient(get_client())
+        jobs = RecordingJobStore(counter, events=_QueueEvents(events_queue),
+                                 prefix=kwargs.pop('prefix'),
+                                 channel=kwargs.pop('channel'), backoff=0.1)
+        sim = worker.Worker(
+            jobs, LocalStorage(bucket, download_dir),
+            download_dir=download_dir,
+            cache_results=False,
+            make_notebook=fake_notebook,
+            listener=dispatch.JobListener(jobs) if events else None,
+            **kwargs)
+
+        def supervise():
+            measuring.wait()
+            counter.reset()
+            stopping.wait()
+            sim.stop()
+
+        supervisor = threading.Thread(target=supervise)
+        supervisor.daemon = True
+        supervisor.start()
+        events_queue.put(('ready', None, time.time()))
+        sim.run(forever=True)
+    finally:
+        results_queue.put(dict(counter.counts) if counter else {})
+
+
+def run_load_test(get_client, num_jobs=1000, num_workers=10,
+                  executor=noop_executor, num_datasets=None, dataset_size=1024,
+                  prefix='loadtest', channel='loadtest-jobs', status='new',
+                  events=True, prefetch=False, interval=None, timeout=600,
+                  storage_dir=None, processes=True):
+    """Submit synthetic jobs and train them with simulated workers.
+
+    Each worker runs in its own process with its own redis client and
+    download directory, like a training pod, and shares only a local
+    directory standing in for the bucket.
+
+    Args:
+        get_client: function returning a new redis client, e.g. for a
+            redis-server on localhost.  Must be picklable.
+        num_jobs: number of jobs to submit
+        num_workers: number of simulated workers
+        executor: function standing in for utils.run_notebook
+        num_datasets: number of distinct datasets shared by the jobs,
+            defaults to one per job
+        dataset_size: size in bytes of each dataset
+        prefix: key prefix of the synthetic jobs, which are deleted after
+        channel: pub/sub channel announcing the jobs
+        status: status of new jobs
+        events: whether workers are woken by a JobListener, otherwise
+            they poll every interval seconds
+        prefetch: whether workers prefetch the next job's dataset
+        interval: seconds between sweeps or polls for jobs, defaults to
+            RECONCILE_INTERVAL with events and INTERVAL without
+        timeout: seconds to wait for all jobs to finish
+        storage_dir: directory for the fake bucket and downloads,
+            defaults to a new temporary directory
+        processes: if False, run the workers as threads of this process,
+            which only suits an in-memory redis client, as they contend
+            for the GIL
+
+    Returns:
+        dict of load test metrics
+    """
+    if interval is None:
+        interval = settings.RECONCILE_INTERVAL if events else settings.INTERVAL
+    if processes:
+        runner, make_queue, make_event = (
+            multiprocessing.Process, multiprocessing.Queue,
+            multiprocessing.Event)
+    else:
+        runner, make_queue, make_event = (
+            threading.Thread, queue.Queue, threading.Event)
+    events_queue, results_queue = make_queue(), make_queue()
+    measuring, stopping = make_event(), make_event()
+
+    client = get_client()
+    recorded = []
+    tempdir = None
+    if storage_dir is None:
+        storage_dir = tempdir = tempfile.mkdtemp(prefix='loadtest-')
+
+    submitter = job_store.JobStore(client, prefix=prefix, channel=channel)
+    bucket = os.path.join(storage_dir, 'bucket')
+    uploader = LocalStorage(bucket)
+    datasets = []
+    for i in range(num_datasets or num_jobs):
+        path = os.path.join(storage_dir, 'dataset_{}.npz'.format(i))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(dataset_size))
+        dest, _ = uploader.upload(path, subdir='uploads')
+        datasets.append(dest)
+
+    workers = []
+    for i in range(num_workers):
+        download_dir = os.path.join(storage_dir, 'worker_{}'.format(i))
+        os.makedirs(download_dir)
+        sim = runner(target=_run_worker, kwargs={
+            'get_client': get_client,
+            'bucket': bucket,
+            'download_dir': download_dir,
+            'events_queue': events_queue,
+            'results_queue': results_queue,
+            'measuring': measuring,
+            'stopping': stopping,
+            'events': events,
+            'prefix': prefix,
+            'channel': channel,
+            'executor': executor,
+            'prefetch': prefetch,
+            'status': status,
+            'interval': interval,
+        })
+        sim.daemon = True
+        workers.append(sim)
+
+    counts = collections.Counter()
+    try:
+        for sim in workers:
+            sim.start()
+        ready = 0
+        while ready < num_workers:
+            ready += events_queue.get(timeout=timeout)[0] == 'ready'
+        time.sleep(0.5)  # let the workers subscribe and go idle
+
+        before = _get_commands_processed(client)
+        measuring.set()
+        start = timeit.default_timer()
+        submitted = submit_jobs(submitter, datasets, num_jobs, status,
+                                publish=events)
+
+        deadline = start + timeout
+        finished = 0
+        while finished < num_jobs:
+            remaining = deadline - timeit.default_timer()
+            if remaining <= 0:
+                logger.warning('Timed out after %s seconds.', timeout)
+                break
+            try:
+                event = events_queue.get(timeout=min(remaining, 1))
+            except queue.Empty:
+                continue
+            recorded.append(event)
+            if event[0] in ('done', 'failed'):
+                finished += 1
+        duration = timeit.default_timer() - start
+        after = _get_commands_processed(client)
+    finally:
+        stopping.set()
+        for _ in workers:
+            try:
+                counts.update(results_queue.get(timeout=timeout))
+            except queue.Empty:
+                logger.warning('A worker did not report its redis commands.')
+        for sim in workers:
+            sim.join(timeout)
+        keys = list(submitter.iter_job_keys())
+        if keys:
+            client.delete(*keys)
+        if tempdir is not None:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+    num_ops = sum(counts.values())
+    server_ops = None
+    if before is not None and after is not None:
+        server_ops = after - before
+    logger.debug('Redis commands sent by workers: %s', counts)
+
+    report = summarize(recorded, submitted, duration, num_ops)
+    report['redis_server_ops'] = server_ops
+    return report
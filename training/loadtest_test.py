@@ -0,0 +1,141 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the load test harness"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+import io
+import os
+import tempfile
+
+import pytest
+
+from training import job_store
+from training import loadtest
+from training import storage
+
+
+class TestLocalStorage(object):
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg = loadtest.LocalStorage(os.path.join(tempdir, 'bucket'),
+                                        os.path.join(tempdir, 'download'))
+            path = os.path.join(tempdir, 'data.npz')
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+
+            dest, url = stg.upload(path, subdir='uploads')
+            assert url.startswith('file://')
+            local_path = stg.download(dest)
+            with open(local_path, 'rb') as f:
+                assert f.read() == b'x' * 100
+
+            stg.upload(path, subdir='uploads', dedupe=True)
+            assert stg.stats['files_skipped'] == 1
+
+            with pytest.raises(storage.StorageException):
+                stg.get_object_info('missing')
+
+            url = stg.upload_fileobj(io.BytesIO(b'y'), 'other/file')
+            assert url == stg.get_public_url('other/file')
+            assert stg.get_object_info('other/file')[0] == 1
+
+    def test_download_top_level_dataset(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg = loadtest.LocalStorage(os.path.join(tempdir, 'bucket'),
+                                        os.path.join(tempdir, 'download'))
+            for name in ('a.npz', 'b.npz'):
+                stg.upload_fileobj(io.BytesIO(b'x'), 'shards/' + name)
+            dest = stg.download_dataset('shards/')
+            assert dest == os.path.join(tempdir, 'download', 'shards')
+            assert sorted(os.listdir(dest)) == ['a.npz', 'b.npz']
+
+
+class TestCountingClient(object):
+
+    def test_counts(self, redis_client):
+        client = loadtest.CountingClient(redis_client)
+        client.hset('a', 'b', 'c')
+        with client.pipeline() as pipe:
+            pipe.watch('a')
+            pipe.hget('a', 'b')
+            pipe.multi()
+            pipe.hmset('a', {'b': 'd'})
+            pipe.execute()
+        assert client.hget('a', 'b') == 'd'
+        assert client.counts == {'hset': 1, 'watch': 1, 'hget': 2,
+                                 'hmset': 1}
+
+
+def test_summarize():
+    submitted = {'a': 0, 'b': 1}
+    events = [
+        ('claim:new', 'a', 1), ('training', 'a', 1), ('done', 'a', 2),
+        ('claim:new', 'b', 3), ('training', 'b', 3), ('training', 'b', 3),
+        ('failed', 'b', 4),
+    ]
+    report = loadtest.summarize(events, submitted, 4, num_ops=10)
+    assert report['done'] == 1
+    assert report['failed'] == 1
+    assert report['throughput'] == 0.25
+    assert report['claim_latency_max'] == 2
+    assert report['duplicate_claims'] == 1
+    assert report['redis_ops_per_job'] == 5
+
+
+@pytest.mark.parametrize('events', [True, False])
+def test_run_load_test(redis_client, events):
+    # the in-memory client cannot be shared by processes
+    report = loadtest.run_load_test(
+        lambda: redis_client, num_jobs=40, num_workers=4, events=events,
+        prefetch=True, interval=0.05, timeout=30,
+        executor=loadtest.SleepExecutor(0.01), processes=False)
+    assert report['done'] == 40
+    assert report['failed'] == 0
+    assert report['duplicate_claims'] == 0
+    assert report['redis_ops_per_job'] > 0
+    assert report['claim_latency_max'] < 30
+    # the synthetic jobs are cleaned up
+    assert not redis_client.keys('loadtest*')
+
+
+def test_run_load_test_processes():
+    get_client = functools.partial(job_store.get_client, 'localhost', 6379)
+    try:
+        get_client().ping()
+    except job_store.TRANSIENT_ERRORS:
+        pytest.skip('No redis server on localhost:6379')
+
+    report = loadtest.run_load_test(
+        get_client, num_jobs=40, num_workers=4, interval=0.05, timeout=60,
+        executor=loadtest.SleepExecutor(0.01))
+    assert report['done'] == 40
+    assert report['duplicate_claims'] == 0
+    assert report['redis_ops_per_job'] > 0
+    assert not get_client().keys('loadtest*')
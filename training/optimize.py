@@ -0,0 +1,408 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Build and benchmark a serving-optimized variant of an exported model"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import logging
+import timeit
+
+import numpy as np
+
+from training import settings
+
+
+logger = logging.getLogger('training.optimize')
+
+QUANTIZATIONS = ('none', 'float16', 'int8')
+
+SERVING_TAG = 'serve'
+SIGNATURE_KEY = 'serving_default'
+
+# graph_transforms applied to the frozen graph, when available
+TRANSFORMS = [
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+]
+
+
+def _tf():
+    # imported on first use, so that workers not optimizing exports
+    # never load TensorFlow
+    try:
+        import tensorflow as tf
+    except ImportError:
+        raise ImportError('TensorFlow is required to optimize exports.')
+    return tf
+
+
+def _v1():
+    """Returns the TF1 graph-mode API of the installed TensorFlow."""
+    tf = _tf()
+    compat = getattr(tf, 'compat', None)
+    return getattr(compat, 'v1', tf)
+
+
+def _lite():
+    tf = _tf()
+    if hasattr(tf, 'lite'):
+        return tf.lite
+    return tf.contrib.lite
+
+
+def _node_name(tensor_name):
+    return tensor_name.split(':')[0]
+
+
+def get_quantization(quantization):
+    """Validate the quantization, returning its canonical name."""
+    quantization = str(quantization or 'none').lower()
+    if quantization not in QUANTIZATIONS:
+        raise ValueError('Bad value for quantization: {}'.format(
+            quantization))
+    return quantization
+
+
+def find_saved_model(export_dir):
+    """Returns the directory holding the first saved_model.pb in export_dir.
+
+    Exports are usually written as <export_dir>/<model>/<version>/.
+    """
+    for root, dirs, files in os.walk(export_dir):
+        dirs.sort()
+        if 'saved_model.pb' in files:
+            return root
+    raise IOError('No saved_model.pb found in {}'.format(export_dir))
+
+
+def load_calibration_data(dataset_path,
+                          num_samples=settings.CALIBRATION_SAMPLES, seed=0):
+    """Sample images from a training dataset.
+
+    Args:
+        dataset_path: path to an npz file with an "X" array, or to a
+            directory of them, of which the first is used
+        num_samples: maximum number of samples
+        seed: seed of the random sample
+
+    Returns:
+        float32 array of at most num_samples images
+    """
+    if os.path.isdir(dataset_path):
+        paths = sorted(os.path.join(root, f)
+                       for root, _, files in os.walk(dataset_path)
+                       for f in files if f.endswith('.npz'))
+        if not paths:
+            raise IOError('No npz files found in {}'.format(dataset_path))
+        dataset_path = paths[0]
+
+    with np.load(dataset_path) as data:
+        X = data['X']
+    rng = np.random.RandomState(seed)
+    indices = rng.permutation(len(X))[:num_samples]
+    return X[np.sort(indices)].astype('float32')
+
+
+def fit_to_input(X, shape):
+    """Crop or zero-pad images to the known dimensions of a model input.
+
+    Args:
+        X: batch of images
+        shape: model input shape, with None or -1 for any size
+
+    Returns:
+        X: batch of images matching every known dimension of shape
+    """
+    for axis, size in enumerate(shape):
+        if axis == 0 or size is None or size < 0 or axis >= X.ndim:
+            continue
+        if X.shape[axis] > size:
+            X = np.take(X, np.arange(size), axis=axis)
+        elif X.shape[axis] < size:
+            pad = [(0, 0)] * X.ndim
+            pad[axis] = (0, size - X.shape[axis])
+            X = np.pad(X, pad, mode='constant')
+    return X
+
+
+def compare_outputs(expected, actual):
+    """Compare the predictions of a variant to those of the original.
+
+    Returns:
+        dict of the max and mean absolute error, and the fraction of
+        pixels with the same most likely class
+    """
+    expected = np.asarray(expected, dtype='float32')
+    actual = np.asarray(actual, dtype='float32')
+    error = np.abs(expected - actual)
+    agreement = np.mean(np.argmax(expected, axis=-1) ==
+                        np.argmax(actual, axis=-1))
+    return {
+        'max_abs_error': float(error.max()),
+        'mean_abs_error': float(error.mean()),
+        'agreement': float(agreement),
+    }
+
+
+def measure_latency(predict, X, num_runs=settings.BENCHMARK_RUNS):
+    """Returns the median latency in milliseconds of predicting one image.
+
+    The first prediction is a warm-up and is not timed.
+    """
+    batch = X[:1]
+    predict(batch)
+    times = []
+    for _ in range(num_runs):
+        start = timeit.default_timer()
+        predict(batch)
+        times.append(timeit.default_timer() - start)
+    return float(np.median(times) * 1000)
+
+
+class SavedModelRunner(object):
+    """Predict with the serving signature of a SavedModel on the CPU."""
+
+    def __init__(self, saved_model_dir, signature_key=SIGNATURE_KEY):
+        v1 = _v1()
+        self.graph = v1.Graph()
+        config = v1.ConfigProto(device_count={'GPU': 0})
+        self.session = v1.Session(graph=self.graph, config=config)
+        meta_graph = v1.saved_model.loader.load(
+            self.session, [SERVING_TAG], saved_model_dir)
+        self.signature = meta_graph.signature_def[signature_key]
+        inputs = list(self.signature.inputs.values())
+        outputs = list(self.signature.outputs.values())
+        if len(inputs) != 1:
+            raise ValueError('Only models with a single input are supported.')
+        self.input_name = inputs[0].name
+        self.output_name = outputs[0].name
+        self.input_shape = [d.size for d in inputs[0].tensor_shape.dim]
+
+    def __call__(self, X):
+        return self.session.run(self.output_name,
+                                feed_dict={self.input_name: X})
+
+    def close(self):
+        self.session.close()
+
+
+class TFLiteRunner(object):
+    """Predict with a TensorFlow Lite model on the CPU."""
+
+    def __init__(self, model_path):
+        self.interpreter = _lite().Interpreter(model_path=model_path)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_shape = None
+
+    def __call__(self, X):
+        if self.batch_shape != X.shape:
+            self.interpreter.resize_tensor_input(self.input_index, X.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_shape = X.shape
+        self.interpreter.set_tensor(self.input_index, X)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+    def close(self):
+        pass
+
+
+def fold_constants(graph_def, inputs, outputs):
+    """Fold constants and batch norms, if graph_transforms is available.
+
+    Grappler folds constants at load time anyway, so this only saves the
+    serving tier that work and shrinks the graph on disk.
+    """
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        logger.debug('graph_transforms is not available, not folding.')
+        return graph_def
+    return TransformGraph(graph_def, inputs, outputs, TRANSFORMS)
+
+
+def freeze_saved_model(saved_model_dir, output_dir,
+                       signature_key=SIGNATURE_KEY):
+    """Write a SavedModel with its variables folded into constants.
+
+    The serving signature is kept, so the frozen model is a drop-in
+    replacement for the original.
+
+    Args:
+        saved_model_dir: directory of the original SavedModel
+        output_dir: directory to write the frozen SavedModel
+        signature_key: the signature to keep
+    """
+    v1 = _v1()
+    with v1.Session(graph=v1.Graph()) as sess:
+        meta_graph = v1.saved_model.loader.load(
+            sess, [SERVING_TAG], saved_model_dir)
+        signature = meta_graph.signature_def[signature_key]
+        inputs = [_node_name(t.name) for t in signature.inputs.values()]
+        outputs = [_node_name(t.name) for t in signature.outputs.values()]
+        graph_def = v1.graph_util.convert_variables_to_constants(
+            sess, sess.graph.as_graph_def(), outputs)
+
+    graph_def = fold_constants(graph_def, inputs, outputs)
+
+    with v1.Session(graph=v1.Graph()) as sess:
+        v1.import_graph_def(graph_def, name='')
+        builder = v1.saved_model.builder.SavedModelBuilder(output_dir)
+        builder.add_meta_graph_and_variables(
+            sess, [SERVING_TAG],
+            signature_def_map={signature_key: signature},
+            strip_default_attrs=True)
+        builder.save()
+    return output_dir
+
+
+def quantize_saved_model(saved_model_dir, output_path, quantization,
+                         calibration_data=None, signature_key=SIGNATURE_KEY):
+    """Write a post-training quantized TensorFlow Lite model.
+
+    Args:
+        saved_model_dir: directory of the original SavedModel
+        output_path: path to write the .tflite model
+        quantization: "float16" weights, or "int8" weights and activations
+        calibration_data: images used to calibrate int8 activation ranges
+
+    Returns:
+        output_path: path to the quantized model
+    """
+    lite = _lite()
+    converter_cls = lite.TFLiteConverter
+    try:
+        converter = converter_cls.from_saved_model(
+            saved_model_dir, signature_keys=[signature_key])
+    except TypeError:  # TensorFlow 1.x
+        converter = converter_cls.from_saved_model(
+            saved_model_dir, signature_key=signature_key)
+
+    converter.optimizations = [lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [_v1().float16]
+    elif quantization == 'int8':
+        if calibration_data is None or not len(calibration_data):
+            raise ValueError('int8 quantization requires calibration data.')
+
+        def representative_dataset():
+            for x in calibration_data:
+                yield [x[np.newaxis]]
+
+        converter.representative_dataset = representative_dataset
+    else:
+        raise ValueError('Bad value for quantization: {}'.format(
+            quantization))
+
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+    return output_path
+
+
+def optimize_export(export_dir, output_dir, calibration_data=None,
+                    quantization=settings.EXPORT_QUANTIZATION,
+                    num_runs=settings.BENCHMARK_RUNS):
+    """Build a serving-optimized variant of an export and benchmark it.
+
+    The variant is a frozen, constant-folded SavedModel in the same
+    <version>/ layout as the original and, if quantized, a TensorFlow
+    Lite model.  The first half of the calibration data calibrates int8
+    quantization and the second half compares each variant's CPU latency
+    and predictions to the original's.
+
+    Args:
+        export_dir: directory containing the exported SavedModel
+        output_dir: directory to write the variant to
+        calibration_data: images sampled from the training data
+        quantization: one of "none", "float16" or "int8"
+        num_runs: number of timed predictions
+
+    Returns:
+        dict of benchmark results of the original and each variant
+    """
+    quantization = get_quantization(quantization)
+    saved_model_dir = find_saved_model(export_dir)
+    version = os.path.basename(os.path.normpath(saved_model_dir))
+    if not version.isdigit():
+        version = '1'
+
+    frozen_dir = os.path.join(output_dir, version)
+    freeze_saved_model(saved_model_dir, frozen_dir)
+
+    quantized_path = None
+    calibration, evaluation = None, None
+    runners = {'original': SavedModelRunner(saved_model_dir),
+               'optimized': SavedModelRunner(frozen_dir)}
+    try:
+        if calibration_data is not None and len(calibration_data):
+            X = fit_to_input(calibration_data,
+                             runners['original'].input_shape)
+            # a single image is used for both
+            half = max(len(X) // 2, 1)
+            calibration = X[:half]
+            evaluation = X[half:] if len(X) > 1 else X
+
+        if quantization != 'none':
+            quantized_path = os.path.join(
+                output_dir, 'model_{}.tflite'.format(quantization))
+            quantize_saved_model(saved_model_dir, quantized_path,
+                                 quantization, calibration)
+            runners['quantized'] = TFLiteRunner(quantized_path)
+
+        results = {'quantization': quantization}
+        if evaluation is None:
+            logger.warning('No calibration data, not benchmarking %s.',
+                           export_dir)
+            return results
+
+        original = runners['original']
+        expected = original(evaluation)
+        results['original'] = {'latency_ms': measure_latency(
+            original, evaluation, num_runs)}
+        for name in sorted(runners):
+            if name == 'original':
+                continue
+            runner = runners[name]
+            result = {'latency_ms': measure_latency(
+                runner, evaluation, num_runs)}
+            predicted = np.concatenate(
+                [runner(evaluation[i:i + 1])
+                 for i in range(len(evaluation))])
+            result.update(compare_outputs(expected, predicted))
+            result['speedup'] = (results['original']['latency_ms'] /
+                                 result['latency_ms'])
+            results[name] = result
+        if quantized_path is not None:
+            results['quantized']['path'] = os.path.relpath(
+                quantized_path, output_dir)
+        return results
+    finally:
+        for runner in runners.values():
+            runner.close()
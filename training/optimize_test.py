@@ -0,0 +1,154 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the export optimization pass"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+import pytest
+
+from training import optimize
+
+
+def test_get_quantization():
+    assert optimize.get_quantization(None) == 'none'
+    assert optimize.get_quantization('INT8') == 'int8'
+    with pytest.raises(ValueError):
+        optimize.get_quantization('int4')
+
+
+def test_find_saved_model():
+    with tempfile.TemporaryDirectory() as tempdir:
+        with pytest.raises(IOError):
+            optimize.find_saved_model(tempdir)
+        version_dir = os.path.join(tempdir, 'model', '0')
+        os.makedirs(version_dir)
+        open(os.path.join(version_dir, 'saved_model.pb'), 'w').close()
+        assert optimize.find_saved_model(tempdir) == version_dir
+
+
+def test_load_calibration_data():
+    with tempfile.TemporaryDirectory() as tempdir:
+        X = np.arange(10 * 4 * 4).reshape((10, 4, 4, 1))
+        path = os.path.join(tempdir, 'data.npz')
+        np.savez(path, X=X, y=X)
+
+        sample = optimize.load_calibration_data(path, num_samples=4)
+        assert sample.shape == (4, 4, 4, 1)
+        assert sample.dtype == np.float32
+        # a fixed seed samples the same images every time
+        np.testing.assert_array_equal(
+            sample, optimize.load_calibration_data(path, num_samples=4))
+
+        # the first npz of a sharded dataset is sampled
+        assert optimize.load_calibration_data(tempdir).shape == X.shape
+
+        with pytest.raises(IOError):
+            optimize.load_calibration_data(os.path.join(tempdir, 'x'))
+
+
+def test_fit_to_input():
+    X = np.ones((2, 4, 6, 1))
+    assert optimize.fit_to_input(X, [None, None, None, 1]).shape == X.shape
+    fitted = optimize.fit_to_input(X, [-1, 3, 8, 1])
+    assert fitted.shape == (2, 3, 8, 1)
+    assert fitted[:, :, 6:].sum() == 0
+
+
+def test_compare_outputs():
+    expected = np.array([[0.9, 0.1], [0.4, 0.6]])
+    actual = np.array([[0.8, 0.2], [0.6, 0.4]])
+    result = optimize.compare_outputs(expected, actual)
+    assert result['max_abs_error'] == pytest.approx(0.2)
+    assert result['mean_abs_error'] == pytest.approx(0.15)
+    assert result['agreement'] == 0.5
+
+
+def test_measure_latency():
+    calls = []
+    latency = optimize.measure_latency(calls.append, np.ones((3, 2)),
+                                       num_runs=5)
+    assert latency >= 0
+    # one warm-up and the timed runs, each with a single image
+    assert len(calls) == 6
+    assert all(c.shape == (1, 2) for c in calls)
+
+
+def _save_model(path):
+    tf = pytest.importorskip('tensorflow')
+    v1 = optimize._v1()
+    with v1.Session(graph=tf.Graph()) as sess:
+        x = v1.placeholder(tf.float32, [None, 8, 8, 1], name='x')
+        w = v1.Variable(np.random.rand(3, 3, 1, 2).astype('float32'))
+        y = tf.nn.softmax(tf.nn.conv2d(x, w, [1, 1, 1, 1], 'SAME'))
+        sess.run(v1.global_variables_initializer())
+        signature = v1.saved_model.signature_def_utils.predict_signature_def(
+            {'x': x}, {'y': y})
+        builder = v1.saved_model.builder.SavedModelBuilder(path)
+        builder.add_meta_graph_and_variables(
+            sess, [optimize.SERVING_TAG],
+            signature_def_map={optimize.SIGNATURE_KEY: signature})
+        builder.save()
+
+
+@pytest.mark.parametrize('quantization', ['none', 'float16', 'int8'])
+def test_optimize_export(quantization):
+    with tempfile.TemporaryDirectory() as tempdir:
+        _save_model(os.path.join(tempdir, 'export', 'model', '1'))
+        X = np.random.rand(8, 10, 10, 1).astype('float32')
+        output_dir = os.path.join(tempdir, 'optimized')
+
+        results = optimize.optimize_export(
+            os.path.join(tempdir, 'export'), output_dir, X,
+            quantization=quantization, num_runs=2)
+
+        assert os.path.isfile(
+            os.path.join(output_dir, '1', 'saved_model.pb'))
+        assert results['quantization'] == quantization
+        assert results['original']['latency_ms'] > 0
+        # freezing does not change the predictions
+        assert results['optimized']['max_abs_error'] < 1e-5
+        if quantization == 'none':
+            assert 'quantized' not in results
+        else:
+            assert results['quantized']['agreement'] > 0.5
+            assert os.path.isfile(
+                os.path.join(output_dir, results['quantized']['path']))
+
+
+def test_tensorflow_imported_lazily():
+    # workers that do not optimize exports never load TensorFlow
+    code = 'import sys, training.worker; print("tensorflow" in sys.modules)'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert output.strip() == b'False'
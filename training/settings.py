@@ -51,10 +51,83 @@ HASH_PREFIX = _strip(config('HASH_PREFIX', cast=str, default='train'))
 # Redis client connection
 REDIS_HOST = config('REDIS_HOST', default='redis-master')
 REDIS_PORT = config('REDIS_PORT', default=6379, cast=int)
+REDIS_TIMEOUT = config('REDIS_TIMEOUT', default=30, cast=int)
+
+# Retry transient redis errors (connection drops, timeouts, loading)
+REDIS_RETRIES = config('REDIS_RETRIES', default=5, cast=int)
+REDIS_BACKOFF = config('REDIS_BACKOFF', default=1, cast=float)
 
 # Status of hashes marked for training
 STATUS = config('STATUS', default='new')
 
+# Seconds to keep a finished or failed hash in redis
+EXPIRE_TIME = config('EXPIRE_TIME', default=10, cast=int)
+
+# Default per-job resource limits, 0 is unlimited.  Jobs may lower them
+# with the max_runtime (seconds), max_memory and max_disk (bytes) fields,
+# and may only raise the ones that are unlimited.
+MAX_RUNTIME = config('MAX_RUNTIME', default=0, cast=float)
+MAX_MEMORY = config('MAX_MEMORY', default=0, cast=float)
+MAX_DISK = config('MAX_DISK', default=0, cast=float)
+# Seconds between resource checks and before killing a terminated job
+RESOURCE_CHECK_INTERVAL = config('RESOURCE_CHECK_INTERVAL', default=5,
+                                 cast=float)
+TERMINATION_GRACE = config('TERMINATION_GRACE', default=30, cast=float)
+
+# Build, benchmark and upload a serving-optimized variant of each export:
+# frozen and constant-folded, and optionally quantized ("float16" or
+# "int8") for TensorFlow Lite.  Jobs may override these with the
+# optimize_export and quantization fields.
+OPTIMIZE_EXPORT = config('OPTIMIZE_EXPORT', cast=bool, default=False)
+EXPORT_QUANTIZATION = config('EXPORT_QUANTIZATION', default='none').lower()
+CALIBRATION_SAMPLES = config('CALIBRATION_SAMPLES', default=64, cast=int)
+BENCHMARK_RUNS = config('BENCHMARK_RUNS', default=20, cast=int)
+
+# Size the notebook's thread pools to the container's CPU quota instead of
+# the host's cores, and pin it to an exclusive cpuset and its NUMA node.
+# CPU_THREADS of 0 uses the quota.  Variables already set are kept.
+TUNE_CPU_THREADS = config('TUNE_CPU_THREADS', cast=bool, default=True)
+CPU_THREADS = config('CPU_THREADS', default=0, cast=int)
+PIN_CPUS = config('PIN_CPUS', cast=bool, default=True)
+
+# Jobs with a num_workers field above 1 are trained data-parallel by that
+# many workers.  The worker that claims the job is the chief and the others
+# join it through the job hash.  WORKER_HOST is the address the others reach
+# this worker at, the host's IP by default, and a WORKER_PORT of 0 picks a
+# free port.  A job that not all participants reached within
+# RENDEZVOUS_TIMEOUT seconds (which must be positive) is put back in the queue,
+# so that two chiefs waiting for each other cannot deadlock.
+WORKER_HOST = config('WORKER_HOST', default='')
+WORKER_PORT = config('WORKER_PORT', default=0, cast=int)
+RENDEZVOUS_TIMEOUT = config('RENDEZVOUS_TIMEOUT', default=600, cast=float)
+
+# Reuse the results of identical training requests.  The cache keys must
+# not start with HASH_PREFIX.  A TTL of 0 keeps results forever.
+CACHE_RESULTS = config('CACHE_RESULTS', cast=bool, default=True)
+RESULT_CACHE_PREFIX = _strip(config('RESULT_CACHE_PREFIX',
+                                    default='cache/training'))
+RESULT_CACHE_TTL = config('RESULT_CACHE_TTL', default=30 * 24 * 60 * 60,
+                          cast=int)
+
+# Keep processing jobs instead of exiting after the first one
+RUN_FOREVER = config('RUN_FOREVER', cast=bool, default=False)
+
+# Seconds to wait before checking for new jobs when idle
+INTERVAL = config('INTERVAL', default=10, cast=int)
+
+# Wake idle workers as soon as a job is published on JOB_CHANNEL or, if
+# redis has notify-keyspace-events "Kh" enabled, written to a job hash.
+# Idle workers still sweep for missed jobs every RECONCILE_INTERVAL seconds.
+DISPATCH_EVENTS = config('DISPATCH_EVENTS', cast=bool, default=True)
+JOB_CHANNEL = config('JOB_CHANNEL', default='training-jobs')
+RECONCILE_INTERVAL = config('RECONCILE_INTERVAL', default=60, cast=int)
+
+# Download the next job's dataset while the current job trains
+PREFETCH = config('PREFETCH', cast=bool, default=True)
+# Maximum bytes in DOWNLOAD_DIR, including a dataset being prefetched
+PREFETCH_MAX_BYTES = config('PREFETCH_MAX_BYTES', default=20 * 1024 ** 3,
+                            cast=int)
+
 # Cloud storage
 CLOUD_PROVIDER = config('CLOUD_PROVIDER', cast=str, default='aws').lower()
 
@@ -67,6 +140,26 @@ AWS_SECRET_ACCESS_KEY = config('AWS_SECRET_ACCESS_KEY', default='specify_me')
 # Google credentials
 GCLOUD_STORAGE_BUCKET = config('GKE_BUCKET', default='default-bucket')
 
+# Retry interrupted transfers and stream them in chunks of this many bytes
+STORAGE_RETRIES = config('STORAGE_RETRIES', default=5, cast=int)
+STORAGE_CHUNK_SIZE = config('STORAGE_CHUNK_SIZE', default=8 * 1024 * 1024,
+                            cast=int)
+
+# Datasets may be a folder of shards (a key ending in "/") or a manifest
+# listing shard keys relative to its folder, one per line.  Shards are
+# downloaded by up to DATASET_DOWNLOAD_WORKERS threads.
+MANIFEST_SUFFIX = config('MANIFEST_SUFFIX', default='.manifest')
+DATASET_DOWNLOAD_WORKERS = config('DATASET_DOWNLOAD_WORKERS', default=8,
+                                  cast=int)
+
+# Maximum number of simultaneous transfers of many small files
+STORAGE_CONCURRENCY = config('STORAGE_CONCURRENCY', default=32, cast=int)
+
+# Upload each job's artifacts as a single compressed archive
+PACKAGE_ARTIFACTS = config('PACKAGE_ARTIFACTS', cast=bool, default=False)
+ARTIFACT_PREFIX = _strip(config('ARTIFACT_PREFIX', default='artifacts'))
+ARTIFACT_COMPRESSION = config('ARTIFACT_COMPRESSION', default='zstd').lower()
+
 # Application directories
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DOWNLOAD_DIR = os.path.join(ROOT_DIR, 'download')
@@ -31,13 +31,22 @@ from __future__ import print_function
 import time
 import timeit
 
+import io
 import os
 import logging
+import posixpath
+import threading
+import collections
+from concurrent import futures
 
 import boto3
+from botocore import exceptions as botocore_exceptions
 from google.cloud import storage as google_storage
 from google.cloud import exceptions as google_exceptions
+from requests import exceptions as requests_exceptions
 
+from training import archive
+from training import checksum
 from training import settings
 from training.settings import DOWNLOAD_DIR
 
@@ -47,6 +56,16 @@ class StorageException(Exception):
     pass
 
 
+def _getsize(path):
+    """Returns the size of the file at path, or 0 if it does not exist."""
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def is_dataset(filepath):
+    """Returns whether filepath is a prefix or manifest of dataset shards."""
+    return filepath.endswith(('/', settings.MANIFEST_SUFFIX))
+
+
 def get_client(cloud_provider):
     """Returns the Storage Client appropriate for the cloud provider
     # Arguments:
@@ -74,13 +93,25 @@ class Storage(object):
     Args:
         bucket: cloud storage bucket name
         download_dir: path to local directory to save downloaded files
+        backoff: seconds to wait before retrying a transient error
+        retries: number of consecutive transient errors to tolerate
+        chunk_size: number of bytes to stream at a time
     """
 
-    def __init__(self, bucket, download_dir=DOWNLOAD_DIR, backoff=1.5):
+    # errors which interrupt a transfer but are safe to retry
+    transient_errors = ()
+
+    def __init__(self, bucket, download_dir=DOWNLOAD_DIR, backoff=1.5,
+                 retries=settings.STORAGE_RETRIES,
+                 chunk_size=settings.STORAGE_CHUNK_SIZE):
         self.bucket = bucket
         self.download_dir = download_dir
         self.output_dir = 'output'
         self.backoff = backoff
+        self.retries = retries
+        self.chunk_size = chunk_size
+        # bytes and files transferred or skipped as duplicates
+        self.stats = collections.Counter()
         self.logger = logging.getLogger(str(self.__class__.__name__))
 
     def get_storage_client(self):
@@ -99,35 +130,515 @@ class Storage(object):
         """
         if download_dir is None:
             download_dir = self.download_dir
-        no_upload_dir = os.path.join(*(filepath.split(os.path.sep)[1:]))
+        parts = filepath.split(os.path.sep)
+        # drop the upload folder, unless the key is at the top level
+        no_upload_dir = os.path.join(*(parts[1:] or parts))
         dest = os.path.join(download_dir, no_upload_dir)
         if not os.path.isdir(os.path.dirname(dest)):
             os.makedirs(os.path.dirname(dest))
         return dest
 
-    def download(self, filepath, download_dir):
-        """Download a  file from the cloud storage bucket.
+    def get_upload_path(self, filepath, subdir=None):
+        """Get the cloud storage key for a soon-to-be uploaded file.
+
+        Args:
+            filepath: local path to file to upload
+            subdir: optional folder inside the output directory
+
+        Returns:
+            dest: key of the file in cloud storage
+        """
+        dest = os.path.basename(filepath)
+        if subdir:
+            if str(subdir).startswith('/'):
+                subdir = subdir[1:]
+            dest = os.path.join(subdir, dest)
+        return os.path.join(self.output_dir, dest)
+
+    def get_object_info(self, filepath):
+        """Get the size and checksums of a file in the cloud storage bucket.
+
+        Args:
+            filepath: key of file in cloud storage
+
+        Returns:
+            size: size of the file in bytes
+            checksums: dict of algorithm name to raw digest bytes
+        """
+        raise NotImplementedError
+
+    def get_content_id(self, filepath):
+        """Identify the content of a file without downloading it.
+
+        Args:
+            filepath: key of file in cloud storage
+
+        Returns:
+            content_id: the hex MD5 of the file, or None if unknown
+        """
+        _, checksums = self.get_object_info(filepath)
+        if 'md5' in checksums:
+            return checksum.encode_hex(checksums['md5'])
+        return None
+
+    def download_range(self, filepath, fileobj, start=0):
+        """Stream the bytes of a file from start to the end into fileobj.
+
+        Args:
+            filepath: key of file in cloud storage
+            fileobj: writable binary file object
+            start: offset of the first byte to download
+        """
+        raise NotImplementedError
+
+    def _with_retries(self, func, *args, **kwargs):
+        failures = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except self.transient_errors as err:
+                failures += 1
+                if failures > self.retries:
+                    raise err
+                self.logger.warning('Encountered %s: %s.  Backing off for %s '
+                                    'seconds...', type(err).__name__, err,
+                                    self.backoff)
+                time.sleep(self.backoff)
+
+    def _resume(self, filepath, partial, size, state):
+        """Download the rest of filepath into partial.
+
+        Bytes already on disk are only read back into the hashers if they
+        were not hashed as they streamed in (i.e. a previous job wrote
+        them), so an uninterrupted download is never read twice.
+
+        Args:
+            filepath: key of file in cloud storage
+            partial: local path of the partially downloaded file
+            size: total size of the file in bytes
+            state: dict with the "hashers" and the number of bytes "hashed"
+        """
+        offset = _getsize(partial)
+        if offset > size:
+            self.logger.warning('Partial download of %s is larger than the '
+                                'remote file, restarting.', filepath)
+            os.remove(partial)
+            offset = 0
+
+        if offset != state['hashed']:
+            state['hashers'] = {k: checksum.get_hasher(k)
+                                for k in state['hashers']}
+            with open(partial, 'rb') as f:
+                state['hashed'] = checksum.update_from_file(
+                    state['hashers'], f, offset, self.chunk_size)
+
+        if offset:
+            self.logger.info('Resuming download of %s at byte %s of %s.',
+                             filepath, offset, size)
+
+        with open(partial, 'ab') as f:
+            writer = checksum.HashingWriter(f, state['hashers'])
+            try:
+                if offset < size:
+                    self.download_range(filepath, writer, offset)
+            finally:
+                state['hashed'] += writer.bytes_written
+
+    def download(self, filepath, download_dir=None, extract=False):
+        """Download a file from the cloud storage bucket.
+
+        Bytes are streamed into a ".part" file next to the destination.
+        If a download is interrupted, it is resumed from the bytes already
+        on disk, whether by a retry in this process or by a later job.
+        The file is checksummed as it streams and verified against the
+        checksums reported by the cloud before being moved into place.
 
         Args:
             filepath: key of file in cloud storage to download
             download_dir: path to directory to save file
+            extract: if True and filepath is an archive, stream it through
+                download_archive() instead
 
         Returns:
             dest: local path to downloaded file
         """
+        if extract and archive.compression_from_path(filepath):
+            return self.download_archive(filepath, download_dir)
+
+        dest = self.get_download_path(filepath, download_dir)
+        return self.download_to(filepath, dest)
+
+    def download_to(self, filepath, dest):
+        """Download a file from the cloud storage bucket to dest.
+
+        See download() for how the transfer is resumed and verified.
+
+        Args:
+            filepath: key of file in cloud storage to download
+            dest: local path to save the file
+
+        Returns:
+            dest: local path to downloaded file
+        """
+        start = timeit.default_timer()
+        partial = '{}.part'.format(dest)
+        self.logger.debug('Downloading %s to %s.', filepath, dest)
+        try:
+            size, checksums = self._with_retries(
+                self.get_object_info, filepath)
+            state = {
+                'hashers': {k: checksum.get_hasher(k) for k in checksums},
+                'hashed': 0,
+            }
+            failures = 0
+            while True:
+                written = _getsize(partial)
+                try:
+                    self._resume(filepath, partial, size, state)
+                    break
+                except self.transient_errors as err:
+                    # only give up after repeated errors without progress
+                    progress = _getsize(partial) > written
+                    failures = 0 if progress else failures + 1
+                    if failures > self.retries:
+                        raise err
+                    self.logger.warning(
+                        'Encountered %s: %s after %s of %s bytes.  Backing '
+                        'off for %s seconds...', type(err).__name__, err,
+                        state['hashed'], size, self.backoff)
+                    time.sleep(self.backoff)
+
+            for algorithm, expected in checksums.items():
+                if state['hashers'][algorithm].digest() != expected:
+                    os.remove(partial)
+                    raise StorageException(
+                        '{} checksum mismatch for {}.'.format(
+                            algorithm, filepath))
+
+            os.rename(partial, dest)
+            self.logger.debug('Downloaded %s from bucket %s in %s seconds.',
+                              dest, self.bucket, timeit.default_timer() - start)
+            return dest
+        except Exception as err:
+            self.logger.error('Encountered %s: %s while downloading %s.',
+                              type(err).__name__, err, filepath)
+            raise err
+
+    def list_objects(self, prefix):
+        """List the files in the cloud storage bucket under prefix.
+
+        Args:
+            prefix: key prefix of the files
+
+        Returns:
+            list of (key, size) of each file
+        """
         raise NotImplementedError
 
-    def upload(self, filepath, subdir=None):
+    def read_object(self, filepath):
+        """Returns the contents of a small file in the cloud storage bucket."""
+        buf = io.BytesIO()
+
+        def read():
+            buf.seek(0)
+            buf.truncate()
+            self.download_range(filepath, buf, 0)
+
+        self._with_retries(read)
+        return buf.getvalue()
+
+    def list_dataset(self, filepath):
+        """List the shards of a prefix or manifest dataset.
+
+        Args:
+            filepath: key prefix ending in "/", or key of a manifest listing
+                shard keys relative to its folder, one per line.  Blank
+                lines and lines starting with "#" are ignored.
+
+        Returns:
+            list of (key, relative path) of each shard
+        """
+        if filepath.endswith('/'):
+            objects = self._with_retries(self.list_objects, filepath)
+            shards = [(key, key[len(filepath):]) for key, _ in objects
+                      if not key.endswith('/')]
+        else:
+            folder = posixpath.dirname(filepath)
+            lines = self.read_object(filepath).decode('utf-8').splitlines()
+            relpaths = [line.strip() for line in lines
+                        if line.strip() and not line.strip().startswith('#')]
+            shards = [(posixpath.join(folder, r), r) for r in relpaths]
+
+        for _, relpath in shards:
+            normpath = posixpath.normpath(relpath)
+            if normpath.startswith(('/', '../')) or normpath == '..':
+                raise StorageException('Shard {} of {} is outside of the '
+                                       'dataset.'.format(relpath, filepath))
+        if not shards:
+            raise StorageException('{} does not contain any files.'.format(
+                filepath))
+        return shards
+
+    def get_dataset_size(self, filepath):
+        """Returns the total size in bytes of a file or sharded dataset."""
+        if filepath.endswith('/'):
+            objects = self._with_retries(self.list_objects, filepath)
+            return sum(size for _, size in objects)
+        if is_dataset(filepath):
+            return sum(self._with_retries(self.get_object_info, key)[0]
+                       for key, _ in self.list_dataset(filepath))
+        return self._with_retries(self.get_object_info, filepath)[0]
+
+    def download_dataset(self, filepath, download_dir=None,
+                         max_workers=settings.DATASET_DOWNLOAD_WORKERS):
+        """Download a single file or all shards of a dataset.
+
+        Shards are downloaded concurrently by a bounded pool of threads
+        into a directory named after the prefix or manifest, keeping their
+        relative layout.  Each shard is resumed and verified as in
+        download().
+
+        Args:
+            filepath: key of a file, a prefix ending in "/" or a manifest
+            download_dir: path to directory to save files
+            max_workers: maximum number of simultaneous shard downloads
+
+        Returns:
+            dest: local path to the file or directory of shards
+        """
+        if not is_dataset(filepath):
+            return self.download(filepath, download_dir)
+
+        start = timeit.default_timer()
+        name = filepath.rstrip('/')
+        if name.endswith(settings.MANIFEST_SUFFIX):
+            name = name[:-len(settings.MANIFEST_SUFFIX)]
+        dest = self.get_download_path(name, download_dir)
+
+        shards = self.list_dataset(filepath)
+        self.logger.debug('Downloading %s shards of %s to %s.',
+                          len(shards), filepath, dest)
+        for _, relpath in shards:
+            folder = os.path.dirname(os.path.join(dest, relpath))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+        pool = futures.ThreadPoolExecutor(max_workers=max_workers)
+        pending = []
+        try:
+            pending = [pool.submit(self.download_to, key,
+                                   os.path.join(dest, relpath))
+                       for key, relpath in shards]
+            for future in futures.as_completed(pending):
+                future.result()
+        except Exception as err:
+            for future in pending:
+                future.cancel()
+            self.logger.error('Encountered %s: %s while downloading %s.',
+                              type(err).__name__, err, filepath)
+            raise err
+        finally:
+            pool.shutdown(wait=True)
+
+        self.logger.debug('Downloaded %s shards of %s in %s seconds.',
+                          len(shards), filepath,
+                          timeit.default_timer() - start)
+        return dest
+
+    def download_archive(self, filepath, download_dir=None):
+        """Download a compressed archive and extract it as it streams in.
+
+        The archive is never written to disk; it is checksummed on the fly
+        and verified once extraction completes.
+
+        Args:
+            filepath: key of the archive in cloud storage
+            download_dir: path to directory to save files
+
+        Returns:
+            dest: local path to the directory of extracted files
+        """
+        start = timeit.default_timer()
+        compression = archive.compression_from_path(filepath)
+        dest = self.get_download_path(filepath, download_dir)
+        dest = dest[:-len(archive.EXTENSIONS[compression])]
+        self.logger.debug('Downloading and extracting %s to %s.',
+                          filepath, dest)
+        try:
+            _, checksums = self._with_retries(self.get_object_info, filepath)
+            hashers = {k: checksum.get_hasher(k) for k in checksums}
+
+            def produce(fileobj):
+                writer = checksum.HashingWriter(fileobj, hashers)
+                self.download_range(filepath, writer, 0)
+
+            pipe = archive.StreamPipe(produce)
+            paths, _ = pipe.consume(
+                lambda f: archive.extract_archive(f, dest, compression))
+
+            for algorithm, expected in checksums.items():
+                if hashers[algorithm].digest() != expected:
+                    raise StorageException(
+                        '{} checksum mismatch for {}.'.format(
+                            algorithm, filepath))
+
+            self.logger.debug('Extracted %s files from %s in %s seconds.',
+                              len(paths), filepath,
+                              timeit.default_timer() - start)
+            return dest
+        except Exception as err:
+            self.logger.error('Encountered %s: %s while downloading %s.',
+                              type(err).__name__, err, filepath)
+            raise err
+
+    def is_duplicate(self, filepath, dest, digests=None):
+        """Check whether dest already holds the same bytes as filepath.
+
+        Makes a single metadata request, and only hashes the local file
+        if the sizes match.
+
+        Args:
+            filepath: local path to file to upload
+            dest: key of the file in cloud storage
+            digests: optional dict of already computed local raw digests
+
+        Returns:
+            True if the file in cloud storage is identical
+        """
+        digests = {} if digests is None else digests
+        try:
+            size, checksums = self._with_retries(self.get_object_info, dest)
+        except StorageException:
+            return False
+
+        if size != os.path.getsize(filepath) or not checksums:
+            return False
+
+        for algorithm, expected in checksums.items():
+            if algorithm not in digests:
+                digests[algorithm] = checksum.file_digest(
+                    filepath, algorithm, self.chunk_size)
+            if digests[algorithm] != expected:
+                return False
+        return True
+
+    def _record_upload(self, filepath, dest, skipped=False):
+        size = os.path.getsize(filepath)
+        if skipped:
+            self.stats['files_skipped'] += 1
+            self.stats['bytes_skipped'] += size
+            self.logger.debug('Skipped uploading %s, identical to %s in '
+                              'bucket %s.  Saved %s bytes (%s in total).',
+                              filepath, dest, self.bucket, size,
+                              self.stats['bytes_skipped'])
+        else:
+            self.stats['files_uploaded'] += 1
+            self.stats['bytes_uploaded'] += size
+
+    def upload(self, filepath, subdir=None, dedupe=False):
         """Upload a file to the cloud storage bucket.
 
         Args:
             filepath: local path to file to upload
+            subdir: optional folder inside the output directory
+            dedupe: if True, skip the upload when an identical file
+                already exists at the destination
 
         Returns:
             dest: key of uploaded file in cloud storage
         """
         raise NotImplementedError
 
+    def upload_fileobj(self, fileobj, dest):
+        """Upload the contents of a file object to the cloud storage bucket.
+
+        Args:
+            fileobj: readable binary file object, need not be seekable
+            dest: key of the file in cloud storage
+
+        Returns:
+            url: public URL of the uploaded file
+        """
+        raise NotImplementedError
+
+    def upload_tree(self, directory, prefix, dedupe=True):
+        """Upload every file in directory under prefix, keeping the layout.
+
+        Unlike upload(), the files are not placed in the output folder, so
+        that e.g. a SavedModel can be written next to the original export.
+
+        Args:
+            directory: local path to the directory to upload
+            prefix: key prefix of the uploaded files
+            dedupe: if True, skip files identical to the ones already at
+                their destination, e.g. when a tree is uploaded again
+
+        Returns:
+            list of the keys of the uploaded files
+        """
+        keys = []
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                relpath = os.path.relpath(path, directory)
+                dest = posixpath.join(prefix, relpath.replace(os.sep, '/'))
+                keys.append(dest)
+                if dedupe and self.is_duplicate(path, dest):
+                    self._record_upload(path, dest, skipped=True)
+                    continue
+                with open(path, 'rb') as f:
+
+                    def upload(fileobj=f, dest=dest):
+                        fileobj.seek(0)
+                        return self.upload_fileobj(fileobj, dest)
+
+                    self._with_retries(upload)
+                self._record_upload(path, dest)
+        self.logger.debug('Uploaded %s files from %s to %s.',
+                          len(keys), directory, prefix)
+        return keys
+
+    def upload_archive(self, directory, subdir=None,
+                       compression=settings.ARTIFACT_COMPRESSION,
+                       threads=-1):
+        """Upload a directory as a single compressed tar archive.
+
+        The archive is streamed from the compressor straight into the
+        upload, so it is never staged on disk.
+
+        Args:
+            directory: local path to the directory to upload
+            subdir: optional folder inside the output directory
+            compression: one of "zstd", "gzip" or "none"
+            threads: number of compression threads, -1 for all CPUs
+
+        Returns:
+            dest: key of uploaded archive in cloud storage
+            url: public URL of the uploaded archive
+            manifest: list of [relative path, size in bytes] of each file
+        """
+        start = timeit.default_timer()
+        compression = archive.get_compression(compression)
+        name = os.path.basename(os.path.normpath(directory))
+        dest = self.get_upload_path(
+            archive.get_archive_name(name, compression), subdir)
+        self.logger.debug('Uploading %s as %s to bucket %s.',
+                          directory, dest, self.bucket)
+        try:
+            pipe = archive.StreamPipe(lambda f: archive.write_archive(
+                directory, f, compression, threads))
+            url, manifest = pipe.consume(
+                lambda f: self.upload_fileobj(f, dest))
+            self.logger.debug('Uploaded %s files from %s to bucket %s in %s '
+                              'seconds.', len(manifest), directory,
+                              self.bucket, timeit.default_timer() - start)
+            return dest, url, manifest
+        except Exception as err:
+            self.logger.error('Encountered %s: %s while uploading %s.',
+                              type(err).__name__, err, directory)
+            raise err
+
 
 class GoogleStorage(Storage):
     """Interact with Google Cloud Storage buckets.
@@ -137,8 +648,18 @@ class GoogleStorage(Storage):
         download_dir: path to local directory to save downloaded files
     """
 
-    def __init__(self, bucket, download_dir=DOWNLOAD_DIR, backoff=1.5):
-        super(GoogleStorage, self).__init__(bucket, download_dir, backoff)
+    transient_errors = (
+        google_exceptions.TooManyRequests,
+        google_exceptions.InternalServerError,
+        google_exceptions.ServiceUnavailable,
+        requests_exceptions.ConnectionError,
+        requests_exceptions.ChunkedEncodingError,
+    )
+
+    def __init__(self, bucket, download_dir=DOWNLOAD_DIR, backoff=1.5,
+                 **kwargs):
+        super(GoogleStorage, self).__init__(
+            bucket, download_dir, backoff, **kwargs)
         self.bucket_url = 'www.googleapis.com/storage/v1/b/{}/o'.format(bucket)
 
     def get_storage_client(self):
@@ -160,30 +681,33 @@ class GoogleStorage(Storage):
         blob.make_public()
         return blob.public_url
 
-    def upload(self, filepath, subdir=None):
+    def upload(self, filepath, subdir=None, dedupe=False):
         """Upload a file to the cloud storage bucket.
 
         Args:
             filepath: local path to file to upload
+            subdir: optional folder inside the output directory
+            dedupe: if True, skip the upload when an identical file
+                already exists at the destination
 
         Returns:
             dest: key of uploaded file in cloud storage
         """
         start = timeit.default_timer()
         client = self.get_storage_client()
+        dest = self.get_upload_path(filepath, subdir)
+        if dedupe and self.is_duplicate(filepath, dest):
+            self._record_upload(filepath, dest, skipped=True)
+            return dest, client.get_bucket(self.bucket).blob(dest).public_url
+
         self.logger.debug('Uploading %s to bucket %s.', filepath, self.bucket)
         retrying = True
         while retrying:
             try:
-                dest = os.path.basename(filepath)
-                if subdir:
-                    if str(subdir).startswith('/'):
-                        subdir = subdir[1:]
-                    dest = os.path.join(subdir, dest)
-                dest = os.path.join(self.output_dir, dest)
                 bucket = client.get_bucket(self.bucket)
                 blob = bucket.blob(dest)
                 blob.upload_from_filename(filepath, predefined_acl='publicRead')
+                self._record_upload(filepath, dest)
                 self.logger.debug('Uploaded %s to bucket %s in %s seconds.',
                                   filepath, self.bucket,
                                   timeit.default_timer() - start)
@@ -201,40 +725,71 @@ class GoogleStorage(Storage):
                                   type(err).__name__, err, filepath)
                 raise err
 
-    def download(self, filepath, download_dir=None):
-        """Download a  file from the cloud storage bucket.
+    def get_object_info(self, filepath):
+        """Get the size and checksums of a file in the cloud storage bucket.
 
         Args:
-            filepath: key of file in cloud storage to download
-            download_dir: path to directory to save file
+            filepath: key of file in cloud storage
 
         Returns:
-            dest: local path to downloaded file
+            size: size of the file in bytes
+            checksums: dict of algorithm name to raw digest bytes
         """
         client = self.get_storage_client()
-        dest = self.get_download_path(filepath, download_dir)
-        self.logger.debug('Downloading %s to %s.', filepath, dest)
-        retrying = True
-        while retrying:
-            try:
-                start = timeit.default_timer()
-                blob = client.get_bucket(self.bucket).blob(filepath)
-                blob.download_to_filename(dest)
-                self.logger.debug('Downloaded %s from bucket %s in %s seconds.',
-                                  dest, self.bucket,
-                                  timeit.default_timer() - start)
-                return dest
-            except google_exceptions.TooManyRequests as err:
-                self.logger.warning('Encountered %s: %s.  Backing off for %s '
-                                    'seconds and...', type(err).__name__, err,
-                                    self.backoff)
-                time.sleep(self.backoff)
-                retrying = True  # Unneccessary but explicit
-            except Exception as err:
-                retrying = False
-                self.logger.error('Encountered %s: %s while downloading %s.',
-                                  type(err).__name__, err, filepath)
-                raise err
+        blob = client.get_bucket(self.bucket).get_blob(filepath)
+        if blob is None:
+            raise StorageException('{} does not exist in bucket {}.'.format(
+                filepath, self.bucket))
+        checksums = {}
+        # composite objects do not have an MD5 hash, only a CRC32C.
+        if blob.md5_hash:
+            checksums['md5'] = checksum.decode_b64(blob.md5_hash)
+        elif blob.crc32c and checksum.is_supported('crc32c'):
+            checksums['crc32c'] = checksum.decode_b64(blob.crc32c)
+        return blob.size, checksums
+
+    def list_objects(self, prefix):
+        """List the files in the cloud storage bucket under prefix.
+
+        Args:
+            prefix: key prefix of the files
+
+        Returns:
+            list of (key, size) of each file
+        """
+        client = self.get_storage_client()
+        bucket = client.get_bucket(self.bucket)
+        return [(b.name, b.size) for b in bucket.list_blobs(prefix=prefix)]
+
+    def download_range(self, filepath, fileobj, start=0):
+        """Stream the bytes of a file from start to the end into fileobj.
+
+        Args:
+            filepath: key of file in cloud storage
+            fileobj: writable binary file object
+            start: offset of the first byte to download
+        """
+        client = self.get_storage_client()
+        bucket = client.get_bucket(self.bucket)
+        blob = bucket.blob(filepath, chunk_size=self.chunk_size)
+        blob.download_to_file(fileobj, start=start)
+
+    def upload_fileobj(self, fileobj, dest):
+        """Upload the contents of a file object to the cloud storage bucket.
+
+        Args:
+            fileobj: readable binary file object, need not be seekable
+            dest: key of the file in cloud storage
+
+        Returns:
+            url: public URL of the uploaded file
+        """
+        client = self.get_storage_client()
+        bucket = client.get_bucket(self.bucket)
+        # a chunk size makes this a resumable upload of unknown size
+        blob = bucket.blob(dest, chunk_size=self.chunk_size)
+        blob.upload_from_file(fileobj, predefined_acl='publicRead')
+        return blob.public_url
 
 
 class S3Storage(Storage):
@@ -245,17 +800,28 @@ class S3Storage(Storage):
         download_dir: path to local directory to save downloaded files
     """
 
-    def __init__(self, bucket, download_dir=DOWNLOAD_DIR, backoff=1.5):
-        super(S3Storage, self).__init__(bucket, download_dir, backoff)
+    transient_errors = (
+        botocore_exceptions.ConnectionError,
+        botocore_exceptions.HTTPClientError,
+        botocore_exceptions.IncompleteReadError,
+    )
+
+    def __init__(self, bucket, download_dir=DOWNLOAD_DIR, backoff=1.5,
+                 **kwargs):
+        super(S3Storage, self).__init__(
+            bucket, download_dir, backoff, **kwargs)
         self.bucket_url = 's3.amazonaws.com/{}'.format(bucket)
+        self._client_lock = threading.Lock()
 
     def get_storage_client(self):
         """Returns the storage API client"""
-        return boto3.client(
-            's3',
-            region_name=settings.AWS_REGION,
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
+        # creating clients from the default session is not thread-safe
+        with self._client_lock:
+            return boto3.client(
+                's3',
+                region_name=settings.AWS_REGION,
+                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
 
     def get_public_url(self, filepath):
         """Get the public URL to download the file.
@@ -268,26 +834,36 @@ class S3Storage(Storage):
         """
         return 'https://{url}/{obj}'.format(url=self.bucket_url, obj=filepath)
 
-    def upload(self, filepath, subdir=None):
+    def upload(self, filepath, subdir=None, dedupe=False):
         """Upload a file to the cloud storage bucket.
 
         Args:
             filepath: local path to file to upload
+            subdir: optional folder inside the output directory
+            dedupe: if True, skip the upload when an identical file
+                already exists at the destination
 
         Returns:
             dest: key of uploaded file in cloud storage
         """
         start = timeit.default_timer()
         client = self.get_storage_client()
-        dest = os.path.basename(filepath)
-        if subdir:
-            if str(subdir).startswith('/'):
-                subdir = subdir[1:]
-            dest = os.path.join(subdir, dest)
-        dest = os.path.join(self.output_dir, dest)
-        self.logger.debug('Uploading %s to bucket %s.', filepath, self.bucket)
+        dest = self.get_upload_path(filepath, subdir)
         try:
-            client.upload_file(filepath, self.bucket, dest)
+            extra_args = None
+            if dedupe:
+                digest = checksum.file_digest(filepath, 'md5', self.chunk_size)
+                if self.is_duplicate(filepath, dest, {'md5': digest}):
+                    self._record_upload(filepath, dest, skipped=True)
+                    return dest, self.get_public_url(dest)
+                # multipart ETags are not the MD5, so save it as metadata
+                extra_args = {'Metadata': {'md5': checksum.encode_hex(digest)}}
+
+            self.logger.debug('Uploading %s to bucket %s.',
+                              filepath, self.bucket)
+            client.upload_file(filepath, self.bucket, dest,
+                               ExtraArgs=extra_args)
+            self._record_upload(filepath, dest)
             self.logger.debug('Uploaded %s to bucket %s in %s seconds.',
                               filepath, self.bucket,
                               timeit.default_timer() - start)
@@ -297,30 +873,129 @@ class S3Storage(Storage):
                               type(err).__name__, err, filepath)
             raise err
 
-    def download(self, filepath, download_dir=None):
-        """Download a  file from the cloud storage bucket.
+    def get_object_info(self, filepath):
+        """Get the size and checksums of a file in the cloud storage bucket.
+
+        Args:
+            filepath: key of file in cloud storage
+
+        Returns:
+            size: size of the file in bytes
+            checksums: dict of algorithm name to raw digest bytes
+        """
+        head = self._head_object(filepath)
+        checksums = {}
+        md5 = self._get_md5(head)
+        if md5 is not None:
+            checksums['md5'] = md5
+        return int(head['ContentLength']), checksums
+
+    def get_content_id(self, filepath):
+        """Identify the content of a file without downloading it.
+
+        Objects without a known MD5, such as multipart uploads, are
+        identified by their ETag and size instead.
+
+        Args:
+            filepath: key of file in cloud storage
+
+        Returns:
+            content_id: the hex MD5 of the file, or None if unknown
+        """
+        head = self._head_object(filepath)
+        md5 = self._get_md5(head)
+        if md5 is not None:
+            return checksum.encode_hex(md5)
+        etag = str(head.get('ETag', '')).strip('"')
+        if etag:
+            return 'etag:{}:{}'.format(etag, head['ContentLength'])
+        return None
+
+    def _head_object(self, filepath):
+        client = self.get_storage_client()
+        try:
+            return client.head_object(Bucket=self.bucket, Key=filepath)
+        except botocore_exceptions.ClientError as err:
+            code = err.response.get('Error', {}).get('Code')
+            if str(code) in ('404', 'NoSuchKey', 'NotFound'):
+                raise StorageException('{} does not exist in bucket {}.'.format(
+                    filepath, self.bucket))
+            raise err
+
+    def _get_md5(self, head):
+        # the ETag is only the MD5 of the content for single part uploads
+        # that are not encrypted with SSE-KMS.  Deduplicated uploads save
+        # the MD5 in the metadata instead.
+        etag = str(head.get('ETag', '')).strip('"')
+        metadata = head.get('Metadata') or {}
+        if metadata.get('md5'):
+            return checksum.decode_hex(metadata['md5'])
+        if etag and '-' not in etag and \
+                head.get('ServerSideEncryption') != 'aws:kms':
+            return checksum.decode_hex(etag)
+        return None
+
+    def list_objects(self, prefix):
+        """List the files in the cloud storage bucket under prefix.
+
+        Args:
+            prefix: key prefix of the files
+
+        Returns:
+            list of (key, size) of each file
+        """
+        client = self.get_storage_client()
+        paginator = client.get_paginator('list_objects_v2')
+        objects = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            objects.extend((o['Key'], int(o['Size']))
+                           for o in page.get('Contents', []))
+        return objects
+
+    def download_range(self, filepath, fileobj, start=0):
+        """Stream the bytes of a file from start to the end into fileobj.
+
+        Args:
+            filepath: key of file in cloud storage
+            fileobj: writable binary file object
+            start: offset of the first byte to download
+        """
+        client = self.get_storage_client()
+        response = client.get_object(
+            Bucket=self.bucket,
+            Key=filepath,
+            Range='bytes={}-'.format(start))
+        body = response['Body']
+        for chunk in iter(lambda: body.read(self.chunk_size), b''):
+            fileobj.write(chunk)
+
+    def upload_fileobj(self, fileobj, dest):
+        """Upload the contents of a file object to the cloud storage bucket.
+
+        Args:
+            fileobj: readable binary file object, need not be seekable
+            dest: key of the file in cloud storage
+
+        Returns:
+            url: public URL of the uploaded file
+        """
+        client = self.get_storage_client()
+        client.upload_fileobj(fileobj, self.bucket, dest)
+        return self.get_public_url(dest)
+
+    def download(self, filepath, download_dir=None, extract=False):
+        """Download a file from the cloud storage bucket.
 
         Args:
             filepath: key of file in cloud storage to download
             download_dir: path to directory to save file
+            extract: if True and filepath is an archive, extract it
 
         Returns:
             dest: local path to downloaded file
         """
-        start = timeit.default_timer()
-        client = self.get_storage_client()
         # Bucket keys shouldn't start with "/"
         if filepath.startswith('/'):
             filepath = filepath[1:]
-
-        dest = self.get_download_path(filepath, download_dir)
-        self.logger.debug('Downloading %s to %s.', filepath, dest)
-        try:
-            client.download_file(self.bucket, filepath, dest)
-            self.logger.debug('Downloaded %s from bucket %s in %s seconds.',
-                              dest, self.bucket, timeit.default_timer() - start)
-            return dest
-        except Exception as err:
-            self.logger.error('Encountered %s: %s while downloading %s.',
-                              type(err).__name__, err, filepath)
-            raise err
+        return super(S3Storage, self).download(
+            filepath, download_dir, extract)
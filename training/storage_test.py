@@ -28,20 +28,36 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import base64
+import hashlib
+import io
 import os
 import tempfile
 
+from botocore.exceptions import ClientError
+from botocore.exceptions import EndpointConnectionError
 from google.cloud.exceptions import TooManyRequests
 
 import pytest
 
+from training import archive
 from training import storage
 
 
+CONTENT = b'0123456789' * 100
+
+
 class DummyGoogleClient(object):
     public_url = 'public-url'
     fail_tolerance = 2
     fail_count = 0
+    content = CONTENT
+    md5_hash = base64.b64encode(hashlib.md5(CONTENT).digest())
+    crc32c = None
+
+    @property
+    def size(self):
+        return len(self.content)
 
     def get_bucket(self, *_, **__):
         return self
@@ -49,6 +65,10 @@ class DummyGoogleClient(object):
     def blob(self, *_, **__):
         return self
 
+    def get_blob(self, key, *_, **__):
+        assert key.endswith('test/file.txt')
+        return self
+
     def make_public(self, *_, **__):
         return self
 
@@ -58,19 +78,68 @@ class DummyGoogleClient(object):
             raise TooManyRequests('thrown-on-purpose')
         assert os.path.exists(dest)
 
-    def download_to_filename(self, dest, **_):
+    def download_to_file(self, fileobj, start=None, **_):
+        start = start or 0
         if self.fail_count < self.fail_tolerance:
             self.fail_count += 1
+            # fail halfway through the remaining bytes
+            fileobj.write(self.content[start:start + 100])
             raise TooManyRequests('thrown-on-purpose')
-        assert dest.endswith('/test/file.txt')
+        fileobj.write(self.content[start:])
 
 
 class DummyS3Client(object):
-    def download_file(self, bucket, path, dest, **_):
-        assert path.startswith('test')
+    content = CONTENT
+    etag = '"{}"'.format(hashlib.md5(CONTENT).hexdigest())
+    metadata = {}
+    missing = ('output',)
+    objects = {}
+    fail_tolerance = 0
+    fail_count = 0
+    ranges = []
+
+    def head_object(self, Bucket, Key, **_):
+        if Key.startswith(self.missing):
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        assert Key.startswith(('test', 'output'))
+        if Key in self.objects:
+            return {
+                'ContentLength': len(self.objects[Key]),
+                'ETag': hashlib.md5(self.objects[Key]).hexdigest(),
+            }
+        return {
+            'ContentLength': len(self.content),
+            'ETag': self.etag,
+            'Metadata': self.metadata,
+        }
+
+    def get_object(self, Bucket, Key, Range, **_):
+        assert Key.startswith('test')
+        start = int(Range.replace('bytes=', '').rstrip('-'))
+        self.ranges.append(start)
+        if self.fail_count < self.fail_tolerance:
+            self.fail_count += 1
+            raise EndpointConnectionError(endpoint_url='thrown-on-purpose')
+        content = self.objects.get(Key, self.content)
+        return {'Body': io.BytesIO(content[start:])}
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
 
-    def upload_file(self, path, bucket, dest, **_):
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(k for k in self.objects if k.startswith(Prefix))
+        # two objects per page
+        for i in range(0, len(keys), 2):
+            yield {'Contents': [{'Key': k, 'Size': len(self.objects[k])}
+                                for k in keys[i:i + 2]]}
+
+    def upload_file(self, path, bucket, dest, ExtraArgs=None, **_):
         assert os.path.exists(path)
+        self.extra_args = ExtraArgs
+
+    def upload_fileobj(self, fileobj, bucket, dest, **_):
+        self.uploaded = fileobj.read()
 
 
 def test_get_client():
@@ -104,6 +173,10 @@ class TestStorage(object):
             assert str(path).startswith(tempdir)
             assert str(path).endswith(filekey.replace('upload_dir/', ''))
 
+            # keys at the top level keep their name
+            path = stg.get_download_path('to.zip', tempdir)
+            assert path == os.path.join(tempdir, 'to.zip')
+
 
 class TestGoogleStorage(object):
 
@@ -147,15 +220,85 @@ class TestGoogleStorage(object):
             stg_cls.get_storage_client = DummyGoogleClient
             stg = stg_cls(bucket, tempdir, backoff=0)
 
-            # test succesful download
+            # test succesful download, resumed after each failure
             dest = stg.download(remote_file, tempdir)
             assert dest == stg.get_download_path(remote_file, tempdir)
+            with open(dest, 'rb') as f:
+                assert f.read() == CONTENT
+            assert not os.path.exists('{}.part'.format(dest))
 
             # test failed download
             with pytest.raises(Exception):
                 # self._client raises, but so does storage.download
                 dest = stg.download('bad/file.txt', tempdir)
 
+    def test_upload_dedupe(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'file.txt')
+            with open(path, 'wb') as f:
+                f.write(CONTENT)
+
+            stg_cls = storage.GoogleStorage
+
+            class Client(DummyGoogleClient):
+                fail_tolerance = 0
+
+                def get_blob(self, key, *_, **__):
+                    return self
+
+                def upload_from_filename(self, *_, **__):
+                    raise AssertionError('should not upload')
+
+            stg_cls.get_storage_client = Client
+            stg = stg_cls('test-bucket', tempdir, backoff=0)
+
+            dest, url = stg.upload(path, dedupe=True)
+            assert dest == 'output/file.txt'
+            assert url == 'public-url'
+            assert stg.stats['bytes_skipped'] == len(CONTENT)
+            assert stg.stats['files_skipped'] == 1
+
+            # different content is uploaded
+            with open(path, 'wb') as f:
+                f.write(CONTENT[::-1])
+            with pytest.raises(AssertionError):
+                stg.upload(path, dedupe=True)
+
+    def test_download_checksum_mismatch(self):
+        remote_file = '/test/file.txt'
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg_cls = storage.GoogleStorage
+
+            class BadClient(DummyGoogleClient):
+                fail_tolerance = 0
+                md5_hash = base64.b64encode(hashlib.md5(b'abc').digest())
+
+            stg_cls.get_storage_client = BadClient
+            stg = stg_cls('test-bucket', tempdir, backoff=0)
+
+            with pytest.raises(storage.StorageException):
+                stg.download(remote_file, tempdir)
+            dest = stg.get_download_path(remote_file, tempdir)
+            assert not os.path.exists(dest)
+            assert not os.path.exists('{}.part'.format(dest))
+
+    def test_list_objects(self):
+        class Blob(object):
+            def __init__(self, name, size):
+                self.name, self.size = name, size
+
+        class Client(DummyGoogleClient):
+            def list_blobs(self, prefix=None):
+                assert prefix == 'test/shards/'
+                return [Blob('test/shards/a', 1), Blob('test/shards/b', 2)]
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg = storage.GoogleStorage('test-bucket', tempdir, backoff=0)
+            stg.get_storage_client = Client
+            assert stg.list_objects('test/shards/') == [
+                ('test/shards/a', 1), ('test/shards/b', 2)]
+            assert stg.get_dataset_size('test/shards/') == 3
+
 
 class TestS3Storage(object):
 
@@ -202,8 +345,246 @@ class TestS3Storage(object):
             # test succesful download
             dest = stg.download(remote_file, tempdir)
             assert dest == stg.get_download_path(remote_file[1:], tempdir)
+            with open(dest, 'rb') as f:
+                assert f.read() == CONTENT
 
             # test failed download
             with pytest.raises(Exception):
                 # self._client raises, but so does storage.download
                 dest = stg.download('bad/file.txt', tempdir)
+
+    def test_download_resume(self):
+        remote_file = 'test/file.txt'
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg = storage.S3Storage('test-bucket', tempdir, backoff=0)
+
+            client = DummyS3Client()
+            client.ranges = []
+            client.fail_tolerance = 1
+            stg.get_storage_client = lambda: client
+
+            # a previous job left part of the file on disk
+            dest = stg.get_download_path(remote_file, tempdir)
+            with open('{}.part'.format(dest), 'wb') as f:
+                f.write(CONTENT[:300])
+
+            assert stg.download(remote_file, tempdir) == dest
+            assert client.ranges == [300, 300]
+            with open(dest, 'rb') as f:
+                assert f.read() == CONTENT
+
+            # partial file is larger than the remote file
+            with open('{}.part'.format(dest), 'wb') as f:
+                f.write(CONTENT * 2)
+            client.ranges = []
+            stg.download(remote_file, tempdir)
+            assert client.ranges == [0]
+
+            # too many errors without progress
+            client.fail_count = 0
+            client.fail_tolerance = stg.retries + 1
+            with pytest.raises(EndpointConnectionError):
+                stg.download(remote_file, tempdir)
+
+    def test_download_dataset(self):
+        shards = {
+            'test/shards/fov_0.npz': b'0' * 100,
+            'test/shards/fov_1.npz': b'1' * 200,
+            'test/shards/batch/fov_2.npz': b'2' * 300,
+        }
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg = storage.S3Storage('test-bucket', tempdir, backoff=0)
+            client = DummyS3Client()
+            client.objects = dict(shards)
+            stg.get_storage_client = lambda: client
+
+            assert stg.get_dataset_size('test/shards/') == 600
+
+            dest = stg.download_dataset('test/shards/', max_workers=2)
+            assert dest == os.path.join(tempdir, 'shards')
+            for key, content in shards.items():
+                path = os.path.join(dest, key[len('test/shards/'):])
+                with open(path, 'rb') as f:
+                    assert f.read() == content
+
+            # a manifest lists shards relative to its folder
+            client.objects['test/subset.manifest'] = (
+                b'# two of the shards\nshards/fov_0.npz\n\n'
+                b'shards/batch/fov_2.npz\n')
+            assert stg.get_dataset_size('test/subset.manifest') == 400
+            dest = stg.download_dataset('test/subset.manifest')
+            assert dest == os.path.join(tempdir, 'subset')
+            assert sorted(os.listdir(os.path.join(dest, 'shards'))) == [
+                'batch', 'fov_0.npz']
+
+            # single files are downloaded as before
+            client.objects['test/file.npz'] = b'x'
+            dest = stg.download_dataset('test/file.npz')
+            assert dest == os.path.join(tempdir, 'file.npz')
+
+            # shards may not escape the dataset directory
+            client.objects['test/bad.manifest'] = b'../etc/passwd\n'
+            with pytest.raises(storage.StorageException):
+                stg.download_dataset('test/bad.manifest')
+
+            with pytest.raises(storage.StorageException):
+                stg.download_dataset('test/empty/')
+
+            # a shard that fails to download fails the dataset
+            client.objects['test/missing.manifest'] = b'shards/fov_0.npz\nx'
+            client.missing = ('test/x',)
+            with pytest.raises(storage.StorageException):
+                stg.download_dataset('test/missing.manifest')
+
+    def test_upload_tree(self):
+        uploads = {}
+
+        class Client(DummyS3Client):
+            fail_tolerance = 1
+
+            def head_object(self, Bucket, Key, **_):
+                if Key not in uploads:
+                    raise ClientError({'Error': {'Code': '404'}},
+                                      'HeadObject')
+                return {'ContentLength': len(uploads[Key]),
+                        'ETag': hashlib.md5(uploads[Key]).hexdigest()}
+
+            def upload_fileobj(self, fileobj, bucket, dest, **_):
+                content = fileobj.read()
+                if self.fail_count < self.fail_tolerance:
+                    self.fail_count += 1
+                    raise EndpointConnectionError(
+                        endpoint_url='thrown-on-purpose')
+                uploads[dest] = content
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg = storage.S3Storage('test-bucket', tempdir, backoff=0)
+            client = Client()
+            stg.get_storage_client = lambda: client
+            os.makedirs(os.path.join(tempdir, 'model', '1', 'variables'))
+            for name in ('saved_model.pb', 'variables/data'):
+                path = os.path.join(tempdir, 'model', '1', name)
+                with open(path, 'wb') as f:
+                    f.write(name.encode())
+
+            keys = stg.upload_tree(os.path.join(tempdir, 'model'), 'models/x')
+            assert keys == ['models/x/1/saved_model.pb',
+                            'models/x/1/variables/data']
+            # the retried upload is sent from the start of the file
+            assert uploads == {k: k[len('models/x/1/'):].encode()
+                               for k in keys}
+            assert stg.stats['files_uploaded'] == 2
+
+            # identical files are not uploaded again
+            path = os.path.join(tempdir, 'model', '1', 'saved_model.pb')
+            with open(path, 'wb') as f:
+                f.write(b'changed')
+            stg.upload_tree(os.path.join(tempdir, 'model'), 'models/x')
+            assert uploads['models/x/1/saved_model.pb'] == b'changed'
+            assert stg.stats['files_uploaded'] == 3
+            assert stg.stats['files_skipped'] == 1
+
+    def test_get_object_info(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg = storage.S3Storage('test-bucket', tempdir)
+            client = DummyS3Client()
+            stg.get_storage_client = lambda: client
+
+            size, checksums = stg.get_object_info('test/file.txt')
+            assert size == len(CONTENT)
+            assert checksums == {'md5': hashlib.md5(CONTENT).digest()}
+
+            # multipart ETags are not verified
+            client.etag = '"abc-2"'
+            _, checksums = stg.get_object_info('test/file.txt')
+            assert not checksums
+
+    def test_get_content_id(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            stg = storage.S3Storage('test-bucket', tempdir)
+            client = DummyS3Client()
+            stg.get_storage_client = lambda: client
+
+            assert stg.get_content_id('test/file.txt') == \
+                hashlib.md5(CONTENT).hexdigest()
+
+            # multipart uploads are identified by their ETag and size
+            client.etag = '"abc-2"'
+            assert stg.get_content_id('test/file.txt') == \
+                'etag:abc-2:{}'.format(len(CONTENT))
+
+    def test_upload_archive(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            src = os.path.join(tempdir, 'model-name')
+            os.makedirs(os.path.join(src, 'logs'))
+            with open(os.path.join(src, 'logs', 'events'), 'wb') as f:
+                f.write(CONTENT)
+
+            stg = storage.S3Storage('test-bucket', tempdir)
+            client = DummyS3Client()
+            stg.get_storage_client = lambda: client
+
+            dest, url, manifest = stg.upload_archive(
+                src, subdir='artifacts', compression='gzip')
+            assert dest == 'output/artifacts/model-name.tar.gz'
+            assert url == stg.get_public_url(dest)
+            assert manifest == [[os.path.join('logs', 'events'),
+                                 len(CONTENT)]]
+
+            # the uploaded bytes extract back to the original files
+            client.content = client.uploaded
+            client.etag = hashlib.md5(client.uploaded).hexdigest()
+            local = stg.download('test/model-name.tar.gz', tempdir,
+                                 extract=True)
+            assert local == os.path.join(tempdir, 'model-name')
+            with open(os.path.join(local, 'logs', 'events'), 'rb') as f:
+                assert f.read() == CONTENT
+
+            # corrupted archives fail the checksum
+            client.etag = '"{}"'.format(hashlib.md5(b'abc').hexdigest())
+            with pytest.raises(storage.StorageException):
+                stg.download_archive('test/model-name.tar.gz', tempdir)
+
+    def test_upload_dedupe(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'file.txt')
+            with open(path, 'wb') as f:
+                f.write(CONTENT)
+
+            stg = storage.S3Storage('test-bucket', tempdir)
+            client = DummyS3Client()
+            client.extra_args = None
+            stg.get_storage_client = lambda: client
+            md5 = hashlib.md5(CONTENT).hexdigest()
+
+            # nothing at the destination, so upload with the MD5 metadata
+            dest, _ = stg.upload(path, dedupe=True)
+            assert client.extra_args == {'Metadata': {'md5': md5}}
+            assert stg.stats['bytes_uploaded'] == len(CONTENT)
+
+            # identical file already uploaded (multipart, MD5 in metadata)
+            client.extra_args = None
+            client.etag = '"abc-2"'
+            client.metadata = {'md5': md5}
+            client.missing = ()
+            dest, _ = stg.upload(path, dedupe=True)
+            assert client.extra_args is None
+            assert stg.stats['bytes_skipped'] == len(CONTENT)
+
+            # different size
+            client.content = CONTENT * 2
+            assert not stg.is_duplicate(path, 'test/file.txt')
+
+            # same size, different content
+            client.content = CONTENT
+            client.metadata = {'md5': hashlib.md5(b'abc').hexdigest()}
+            assert not stg.is_duplicate(path, 'test/file.txt')
+
+            # no usable checksum
+            client.metadata = {}
+            assert not stg.is_duplicate(path, 'test/file.txt')
+
+            # missing objects raise StorageException
+            client.missing = ('output',)
+            with pytest.raises(storage.StorageException):
+                stg.get_object_info('output/file.txt')
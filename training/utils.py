@@ -28,38 +28,76 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
+import json
 import logging
 import subprocess
+import sys
 
 from training import settings
+from training.governor import ResourceGovernor
 
 
 logger = logging.getLogger('training.utils')
 
 
-def get_hash_with_status(redis, status='new'):
-    """Iterate over hash values in redis.
-    Yield each hash with a status equal to `watch_status`.
+def get_training_kwargs(**kwargs):
+    """Normalize the training parameters from the redis hash.
+
+    Hash values are strings, so cast them and fill in the defaults so that
+    equivalent requests have equal parameters.
+
+    Args:
+        kwargs: named key/value pairs from the redis hash
 
     Returns:
-        Iterator of all hashes with a valid status
+        dict of deepcell make_notebook training parameters
     """
+    return {
+        'train_type': kwargs.get('training_type', 'conv'),
+        'field_size': int(kwargs.get('field', 61)),
+        'ndim': int(kwargs.get('ndim', 2)),
+        'optimizer': kwargs.get('optimizer', 'sgd'),
+        'skips': int(kwargs.get('skips', 0)),
+        'epochs': int(kwargs.get('epochs', 10)),
+        'normalization': kwargs.get('normalization', 'std'),
+        'transform': kwargs.get('transform', 'watershed'),
+        'distance_bins': int(kwargs.get('distance_bins', 4)),
+        'erosion_width': int(kwargs.get('erosion_width', 0)),
+        'dilation_radius': int(kwargs.get('dilation_radius', 1)),
+    }
+
+
+def get_deepcell_version():
+    """Returns the installed deepcell version, or None if not installed."""
     try:
-        keys = redis.keys()
-        logger.debug('Found %s redis keys', len(keys))
-    except:
-        keys = []
+        import deepcell
+    except ImportError:
+        return None
+    return getattr(deepcell, '__version__', None)
 
-    prefix = settings.HASH_PREFIX
-    for key in keys:
-        # Check if the key is a hash
-        if redis.type(key) == 'hash' and str(key).startswith(prefix):
-            if redis.hget(key, 'status') == status:
-                logger.debug('Found new key: %s', key)
-                return key
 
-    logger.error('Could not find a redis hash with status "%s".', status)
-    return None
+def get_fingerprint(dataset_digest, export=None, **kwargs):
+    """Fingerprint a training request to find identical previous results.
+
+    Args:
+        dataset_digest: hex digest of the dataset content
+        export: optional dict of the requested export variants, e.g.
+            whether to optimize the export and its quantization
+        kwargs: named key/value pairs from the redis hash
+
+    Returns:
+        fingerprint: hex digest identifying the dataset, normalized training
+            parameters, export variants and deepcell version
+    """
+    request = {
+        'dataset': dataset_digest,
+        'params': get_training_kwargs(**kwargs),
+        'export': export,
+        'deepcell': get_deepcell_version(),
+    }
+    encoded = json.dumps(request, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
 
 
 def make_notebook(data, **kwargs):
@@ -67,7 +105,8 @@ def make_notebook(data, **kwargs):
 
     Args:
         data: the path to the properly formatted directory of data
-        kwargs: named key/value pairs from the redis hash
+        kwargs: named key/value pairs from the redis hash.  The output_dir,
+            export_dir and log_dir default to the configured settings.
     """
     if not data:
         raise ValueError('`data` is required to download training data')
@@ -77,20 +116,10 @@ def make_notebook(data, **kwargs):
         notebook_path = train.make_notebook(
             data,
             model_name=kwargs.get('model_name'),
-            train_type=kwargs.get('training_type', 'conv'),
-            field_size=int(kwargs.get('field', 61)),
-            ndim=int(kwargs.get('ndim', 2)),
-            optimizer=kwargs.get('optimizer', 'sgd'),
-            skips=int(kwargs.get('skips', 0)),
-            epochs=int(kwargs.get('epochs', 10)),
-            normalization=kwargs.get('normalization', 'std'),
-            transform=kwargs.get('transform', 'watershed'),
-            distance_bins=int(kwargs.get('distance_bins', 4)),
-            erosion_width=int(kwargs.get('erosion_width', 0)),
-            dilation_radius=int(kwargs.get('dilation_radius', 1)),
-            output_dir=settings.NOTEBOOK_DIR,
-            export_dir=settings.EXPORT_DIR,
-            log_dir=settings.LOG_DIR)
+            output_dir=kwargs.get('output_dir', settings.NOTEBOOK_DIR),
+            export_dir=kwargs.get('export_dir', settings.EXPORT_DIR),
+            log_dir=kwargs.get('log_dir', settings.LOG_DIR),
+            **get_training_kwargs(**kwargs))
 
     except Exception as err:
         logger.error('Failed to write training notebook: %s', err)
@@ -100,11 +129,31 @@ def make_notebook(data, **kwargs):
     return notebook_path
 
 
-def run_notebook(notebook_path):
+def _run(cmd, governor=None):
+    if governor is None:
+        governor = ResourceGovernor()
+
+    logger.debug('Executing subprocess: `%s`', ' '.join(cmd))
+
+    try:
+        output = governor.check_output(cmd)
+    except subprocess.CalledProcessError as err:
+        logger.error('Encountered error while running %s: %s', cmd[-1], err)
+        raise Exception('{} : {}'.format(err, err.stdout.decode('utf-8')))
+
+    output = output.decode('utf-8')  # convert output bytes to string
+    logger.debug('Subprocess Output: %s', output)
+
+    return output
+
+
+def run_notebook(notebook_path, governor=None):
     """Create a training notebook with deepcell and run it.
 
     Args:
         notebook_path: path to generated training notebook
+        governor: ResourceGovernor enforcing the job's limits,
+            defaults to the limits in settings
     """
     cmd = [
         'jupyter', 'nbconvert',
@@ -112,16 +161,15 @@ def run_notebook(notebook_path):
         '--ExecutePreprocessor.timeout=-1',
         '--execute', notebook_path
     ]
+    return _run(cmd, governor)
 
-    logger.debug('Executing subprocess: `%s`', ' '.join(cmd))
 
-    try:
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as err:
-        logger.error('Encountered error while running the notebook: %s', err)
-        raise Exception('{} : {}'.format(err, err.stdout.decode('utf-8')))
-
-    output = output.decode('utf-8')  # convert output bytes to string
-    logger.debug('Subprocess Output: %s', output)
+def run_script(script_path, governor=None):
+    """Run a training script with the current python interpreter.
 
-    return output
+    Args:
+        script_path: path to the training script
+        governor: ResourceGovernor enforcing the job's limits,
+            defaults to the limits in settings
+    """
+    return _run([sys.executable, script_path], governor)
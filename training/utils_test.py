@@ -31,46 +31,10 @@ from __future__ import print_function
 import numpy as np
 
 from training import utils
-from training import settings
 
 
 class TestUtils(object):
 
-    def test_get_hash_with_status(self):
-
-        class Redis(object):
-            def __init__(self, prefix, status):
-                self.prefix = prefix
-                self.status = status
-
-            def keys(self):
-                return ['%s_hash_1' % self.prefix, '%s_hash_2' % self.prefix,
-                        'hash_1', 'hash_2', '%s_string_1' % self.prefix]
-
-            def type(self, thing):
-                if 'hash' in str(thing).lower():
-                    return 'hash'
-                return 'string'
-
-            def hget(self, thing, field):
-                if field == 'status':
-                    return self.status
-                return 'other'
-
-        prefix = settings.HASH_PREFIX
-        status = 'new'
-        redis = Redis(prefix, status)
-        rhash = utils.get_hash_with_status(redis, status)
-        assert rhash == '%s_hash_1' % prefix
-        assert not utils.get_hash_with_status(redis, 'no_status')
-
-        def bad_keys():
-            raise ZeroDivisionError
-
-        redis.keys = bad_keys
-        rhash = utils.get_hash_with_status(redis, 'status')
-        assert rhash is None
-
     def test_make_notebook(self):
         # test bad input data
         with np.testing.assert_raises(ValueError):
@@ -78,3 +42,20 @@ class TestUtils(object):
         # test ImportError raised if deepcell not found
         with np.testing.assert_raises(ImportError):
             _ = utils.make_notebook('random_path')
+
+    def test_get_training_kwargs(self):
+        kwargs = utils.get_training_kwargs(epochs='3', training_type='conv')
+        assert kwargs['epochs'] == 3
+        assert kwargs == utils.get_training_kwargs(epochs=3)
+        with np.testing.assert_raises(ValueError):
+            _ = utils.get_training_kwargs(epochs='three')
+
+    def test_get_fingerprint(self):
+        fingerprint = utils.get_fingerprint('abc', epochs='10', other='x')
+        # defaults, types and unrelated fields do not matter
+        assert fingerprint == utils.get_fingerprint('abc')
+        assert fingerprint == utils.get_fingerprint('abc', model_name='y')
+        assert fingerprint != utils.get_fingerprint('abc', epochs=11)
+        assert fingerprint != utils.get_fingerprint('abd')
+        assert fingerprint != utils.get_fingerprint(
+            'abc', export={'optimize': True, 'quantization': 'int8'})
@@ -0,0 +1,775 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Claim training jobs from redis and train them one after another"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import collections
+import datetime
+import json
+import logging
+import shutil
+import tempfile
+import threading
+
+from training import checksum
+from training import cpu
+from training import distributed
+from training import governor
+from training import job_store
+from training import optimize
+from training import settings
+from training import storage
+from training import utils
+
+
+def _remove(path):
+    """Remove a downloaded dataset file or directory, if it exists."""
+    if path and os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif path and os.path.exists(path):
+        os.remove(path)
+
+
+def _get_download_dir(download_dir, key):
+    """Returns the directory a job's dataset is downloaded to.
+
+    Every job has its own, so that a prefetched job never shares a path
+    with the current one, even if both train the same dataset.
+    """
+    path = os.path.join(download_dir, key)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+class Prefetcher(object):
+    """Reserve the next queued job and download its dataset in a thread.
+
+    The reserved job's status is set to "prefetching" so no other worker
+    claims it.  If the dataset does not fit in the scratch space budget,
+    the reservation is released immediately.  A release also cancels a
+    reservation still being made, and after close() no job is reserved.
+
+    Args:
+        jobs: JobStore used to reserve jobs
+        storage_client: Storage client used to download datasets
+        download_dir: path to the local scratch directory
+        max_bytes: maximum bytes allowed in download_dir
+        status: status of jobs waiting to be trained
+    """
+
+    def __init__(self, jobs, storage_client,
+                 download_dir=settings.DOWNLOAD_DIR,
+                 max_bytes=settings.PREFETCH_MAX_BYTES,
+                 status=settings.STATUS):
+        self.jobs = jobs
+        self.storage_client = storage_client
+        self.download_dir = download_dir
+        self.max_bytes = max_bytes
+        self.status = status
+        self.key = None
+        self.local_path = None
+        self._thread = None
+        self._cancelled = False
+        self._closed = False
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(str(self.__class__.__name__))
+
+    def start(self):
+        """Start prefetching the next job, unless already prefetching."""
+        with self._lock:
+            if self._thread is not None or self._closed:
+                return
+            self._cancelled = False
+        self._thread = threading.Thread(target=self._prefetch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _prefetch(self):
+        if self._cancelled:
+            return
+        key = self.jobs.claim_next(self.status, 'prefetching')
+        if key is None:
+            return
+
+        with self._lock:
+            cancelled = self._cancelled
+            if not cancelled:
+                self.key = key
+        if cancelled:
+            # released while the job was being claimed
+            self._unreserve(key)
+            return
+
+        try:
+            filepath = self.jobs.get_field(key, 'file_name')
+            size = self.storage_client.get_dataset_size(filepath)
+            used = governor.get_directory_size(self.download_dir)
+            if used + size > self.max_bytes:
+                self.logger.info('Not prefetching %s: %s bytes would exceed '
+                                 'the %s byte budget.', key, used + size,
+                                 self.max_bytes)
+                self.release()
+                return
+
+            self.logger.debug('Prefetching %s for %s.', filepath, key)
+            local_path = self.storage_client.download_dataset(
+                filepath, _get_download_dir(self.download_dir, key))
+
+            with self._lock:
+                released = self.key != key
+                if not released:
+                    self.local_path = local_path
+            if released:
+                # nobody takes this download, so do not leave it behind
+                _remove(os.path.join(self.download_dir, key))
+        except Exception as err:  # pylint: disable=broad-except
+            # the worker downloads the dataset again when it takes the job
+            self.logger.warning('Encountered %s while prefetching %s: %s',
+                                type(err).__name__, key, err)
+
+    def take(self):
+        """Wait for the prefetch to finish and hand over the reserved job.
+
+        Returns:
+            key: the reserved job hash, or None if nothing was reserved
+            local_path: path to the downloaded dataset, or None if the
+                download did not complete
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            key, local_path = self.key, self.local_path
+            self.key, self.local_path = None, None
+        return key, local_path
+
+    def release(self):
+        """Return the reserved job, if any, to the queue.
+
+        Does not wait for an in-flight download; the prefetch thread
+        removes it once finished.  A job claimed after the release is
+        returned by the prefetch thread.
+        """
+        with self._lock:
+            key, local_path = self.key, self.local_path
+            self.key, self.local_path = None, None
+            self._cancelled = True
+        if local_path is not None:
+            _remove(os.path.join(self.download_dir, key))
+        if key is not None:
+            self._unreserve(key)
+
+    def close(self):
+        """Release the reserved job and stop reserving new ones."""
+        with self._lock:
+            self._closed = True
+        self.release()
+
+    def _unreserve(self, key):
+        if self.jobs.claim(key, 'prefetching', self.status):
+            self.logger.info('Released reservation of %s.', key)
+            self.jobs.publish(key)
+
+
+class Worker(object):
+    """Claim training jobs, download their data and train them.
+
+    When prefetching, the next job's dataset is downloaded while the
+    current job trains, so the accelerator does not wait on downloads.
+    A job's file_name may be a single file, a prefix ending in "/" or a
+    manifest of shards, which are downloaded into a data directory.
+
+    Jobs with a num_workers field above 1 are trained data-parallel by
+    that many workers.  The worker that claims the job becomes its chief
+    and sets it to "gathering"; idle workers join it before claiming new
+    jobs.  Once every participant has downloaded the dataset, each runs a
+    generated script using a multi-worker strategy, and the chief reports
+    the result.
+
+    Args:
+        jobs: JobStore of training job hashes
+        storage_client: Storage client used to download datasets
+        executor: function that runs a training notebook, called with the
+            notebook path and the job's ResourceGovernor
+        download_dir: path to the local scratch directory
+        prefetch: whether to download the next dataset during training
+        status: status of jobs waiting to be trained
+        interval: seconds to wait between checks for new jobs
+        make_notebook: function that writes the training notebook, defaults
+            to utils.make_notebook
+        distributed_executor: function that runs a distributed training
+            script, called with the script path and the ResourceGovernor
+        make_script: function that writes the distributed training script,
+            defaults to distributed.make_script
+        worker_host: the address other participants of a distributed job
+            reach this worker at, defaults to the host's IP address
+        rendezvous_timeout: seconds to wait for the other participants of
+            a distributed job before putting it back in the queue
+        placement: CPUPlacement sizing the notebook's thread pools and
+            pinning it to CPUs
+        listener: JobListener that wakes the idle worker as soon as a job
+            is submitted, in which case interval is the time between
+            sweeps for jobs whose events were missed
+        package_artifacts: whether to write the notebook, model export and
+            logs locally and upload them as a single compressed archive
+        compression: compression of the artifact archive
+        cache_results: whether to reuse the result of an identical job.
+            Jobs with a truthy "force_retrain" field are always trained.
+        optimize: whether to build and benchmark a serving-optimized
+            variant of the export, unless the job's "optimize_export"
+            field says otherwise
+        quantization: default quantization of the optimized variant
+    """
+
+    # make_notebook arguments that may not be set by the job hash
+    reserved_fields = ('output_dir', 'export_dir', 'log_dir')
+
+    # job hash fields to reuse for identical jobs
+    cached_fields = ('model', 'export_path', 'artifacts', 'artifacts_url',
+                     'artifacts_manifest', 'optimized_export', 'benchmark')
+
+    def __init__(self, jobs, storage_client,
+                 executor=utils.run_notebook,
+                 download_dir=settings.DOWNLOAD_DIR,
+                 prefetch=settings.PREFETCH,
+                 status=settings.STATUS,
+                 interval=settings.INTERVAL,
+                 package_artifacts=settings.PACKAGE_ARTIFACTS,
+                 compression=settings.ARTIFACT_COMPRESSION,
+                 cache_results=settings.CACHE_RESULTS,
+                 optimize=settings.OPTIMIZE_EXPORT,
+                 quantization=settings.EXPORT_QUANTIZATION,
+                 make_notebook=None,
+                 distributed_executor=utils.run_script,
+                 make_script=None,
+                 worker_host=settings.WORKER_HOST,
+                 rendezvous_timeout=settings.RENDEZVOUS_TIMEOUT,
+                 placement=None,
+                 listener=None):
+        self.jobs = jobs
+        self.storage_client = storage_client
+        self.executor = executor
+        self.make_notebook = make_notebook
+        self.distributed_executor = distributed_executor
+        self.make_script = make_script
+        self.worker_host = worker_host
+        self.rendezvous_timeout = rendezvous_timeout
+        self.placement = placement
+        self.download_dir = download_dir
+        self.status = status
+        self.interval = interval
+        self.package_artifacts = package_artifacts
+        self.compression = compression
+        self.cache_results = cache_results
+        self.optimize = optimize
+        self.quantization = quantization
+        self.listener = listener
+        self.prefetcher = None
+        if prefetch:
+            self.prefetcher = Prefetcher(jobs, storage_client,
+                                         download_dir=download_dir,
+                                         status=status)
+        self._stop = threading.Event()
+        self._stopping = None
+        self.logger = logging.getLogger(str(self.__class__.__name__))
+
+    def stop(self, *_):
+        """Stop after the current job.  Usable as a signal handler.
+
+        A prefetched job is released right away, as the current job may
+        outlive the termination grace period.  The release and wake-up
+        take locks and talk to redis, which is unsafe in a signal handler
+        interrupting the main thread, so they run in a thread.
+        """
+        self.logger.info('Stopping after the current job.')
+        self._stop.set()
+        self._stopping = threading.Thread(target=self._release)
+        self._stopping.daemon = True
+        self._stopping.start()
+
+    def _release(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self.listener is not None:
+            self.listener.notify(None)
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def get_model_name(self, local_path, hash_values):
+        return '{ts}_{dataset}_{type}_{transform}'.format(
+            ts=datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S'),
+            dataset=os.path.splitext(os.path.basename(local_path))[0],
+            type=hash_values.get('training_type', 'conv'),
+            transform=hash_values.get('transform', 'watershed'))
+
+    def get_notebook_kwargs(self, model_name, hash_values, rank=None):
+        """Returns the make_notebook keyword arguments for the job.
+
+        When packaging artifacts, everything the notebook writes goes to a
+        local per-job directory to be archived after training.  Only the
+        chief of a distributed job keeps its artifacts, the other
+        participants write theirs to a scratch directory.
+
+        Returns:
+            kwargs: keyword arguments for make_notebook
+            job_dir: the local artifact directory, or None
+        """
+        kwargs = {k: v for k, v in hash_values.items()
+                  if k not in self.reserved_fields}
+        kwargs['model_name'] = model_name
+        job_dir = None
+        if rank:
+            job_dir = os.path.join(settings.NOTEBOOK_DIR, '{}_worker{}'.format(
+                model_name, rank))
+            kwargs['output_dir'] = job_dir
+        elif self.package_artifacts:
+            job_dir = os.path.join(settings.NOTEBOOK_DIR, model_name)
+            kwargs['output_dir'] = job_dir
+            kwargs['export_dir'] = os.path.join(job_dir, 'models')
+            kwargs['log_dir'] = os.path.join(job_dir, 'logs')
+        return kwargs, job_dir
+
+    def upload_artifacts(self, training_hash, job_dir):
+        """Upload the job directory as an archive and record its manifest."""
+        dest, url, manifest = self.storage_client.upload_archive(
+            job_dir,
+            subdir=settings.ARTIFACT_PREFIX,
+            compression=self.compression)
+        self.jobs.update(
+            training_hash,
+            artifacts=dest,
+            artifacts_url=url,
+            artifacts_manifest=json.dumps(manifest))
+        self.logger.info('Uploaded %s artifacts of %s to %s.',
+                         len(manifest), training_hash, dest)
+
+    def should_optimize(self, hash_values):
+        """Returns whether to build an optimized variant of the export."""
+        value = hash_values.get('optimize_export')
+        if value in (None, ''):
+            return self.optimize
+        return str(value).lower() in ('1', 'true', 'yes')
+
+    def optimize_export(self, training_hash, model_name, local_path,
+                        hash_values, job_dir=None):
+        """Build, benchmark and upload a serving-optimized export.
+
+        When packaging artifacts, the variant is written into the job
+        directory to be archived with the original.  Otherwise the export
+        is downloaded and the variant is uploaded next to it.  The job has
+        already been trained, so errors are recorded, not raised.
+        """
+        if not os.path.isdir(self.download_dir):
+            os.makedirs(self.download_dir)
+        workdir = tempfile.mkdtemp(dir=self.download_dir)
+        name = '{}_optimized'.format(model_name)
+        try:
+            quantization = optimize.get_quantization(
+                hash_values.get('quantization') or self.quantization)
+
+            try:
+                calibration_data = optimize.load_calibration_data(local_path)
+            except Exception as err:  # pylint: disable=broad-except
+                self.logger.warning('Could not sample calibration data from '
+                                    '%s: %s', local_path, err)
+                calibration_data = None
+
+            if job_dir is not None:
+                export_dir = os.path.join(job_dir, 'models')
+            else:
+                export_dir = self.storage_client.download_dataset(
+                    '{}/{}/'.format(settings.EXPORT_PREFIX, model_name),
+                    workdir)
+            output_dir = os.path.join(workdir, name)
+
+            results = optimize.optimize_export(
+                export_dir, output_dir, calibration_data, quantization)
+            benchmark = json.dumps(results, sort_keys=True)
+            with open(os.path.join(output_dir, 'benchmark.json'), 'w') as f:
+                f.write(benchmark)
+
+            if job_dir is not None:
+                shutil.move(output_dir, os.path.join(export_dir, name))
+                location = 'models/{}'.format(name)
+            else:
+                self.storage_client.upload_tree(
+                    output_dir, '{}/{}'.format(settings.EXPORT_PREFIX, name))
+                location = '{}/{}'.format(settings.EXPORT_DIR, name)
+
+            self.jobs.update(training_hash, optimized_export=location,
+                             benchmark=benchmark)
+            self.logger.info('Optimized the export of %s: %s',
+                             training_hash, benchmark)
+        except Exception as err:  # pylint: disable=broad-except
+            self.logger.warning('Encountered %s while optimizing the export '
+                                'of %s: %s', type(err).__name__,
+                                training_hash, err)
+            self.jobs.update(training_hash, optimize_error='{}'.format(err))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def log_storage_stats(self, training_hash, before):
+        """Log the storage transfers made since the before snapshot."""
+        stats = collections.Counter(self.storage_client.stats)
+        stats.subtract(before)
+        stats = {k: v for k, v in sorted(stats.items()) if v}
+        self.logger.info('Storage transfers for %s: %s', training_hash,
+                         stats or 'none')
+
+    def get_dataset_digest(self, filepath, local_path=None):
+        """Returns a digest identifying the dataset, or None if unknown.
+
+        Hashes local_path if given.  Otherwise uses the content ID reported
+        by the cloud, so that the dataset need not be downloaded.  Sharded
+        datasets are only fingerprinted once downloaded.
+        """
+        if local_path is not None and os.path.isdir(local_path):
+            return checksum.encode_hex(checksum.directory_digest(local_path))
+        if local_path is not None:
+            return checksum.encode_hex(checksum.file_digest(local_path))
+        if storage.is_dataset(filepath):
+            return None  # the checksum is of the manifest or a placeholder
+        try:
+            return self.storage_client.get_content_id(filepath)
+        except Exception as err:  # pylint: disable=broad-except
+            self.logger.debug('Could not identify the content of %s: %s',
+                              filepath, err)
+            return None
+
+    def get_fingerprint(self, digest, hash_values):
+        """Fingerprint the job, including the export variants it requests.
+
+        Args:
+            digest: digest identifying the dataset
+            hash_values: the job hash
+
+        Returns:
+            fingerprint: hex digest of the training request
+        """
+        export = {'optimize': self.should_optimize(hash_values)}
+        if export['optimize']:
+            quantization = hash_values.get('quantization') or self.quantization
+            try:
+                quantization = optimize.get_quantization(quantization)
+            except ValueError:
+                pass  # recorded as the optimize_error after training
+            export['quantization'] = quantization
+        return utils.get_fingerprint(digest, export=export, **hash_values)
+
+    def use_cached_result(self, training_hash, fingerprint, hash_values):
+        """Finish the job with the result of an identical earlier job.
+
+        Returns:
+            True if a cached result was found and the job is done
+        """
+        if str(hash_values.get('force_retrain', '')).lower() in \
+                ('1', 'true', 'yes'):
+            return False
+
+        result = self.jobs.get_cached_result(fingerprint)
+        if not result:
+            return False
+
+        if self.should_optimize(hash_values) and \
+                'optimized_export' not in result:
+            self.logger.info('Not reusing the result of %s for %s, which '
+                             'has no optimized export.', result.get('job'),
+                             training_hash)
+            return False
+
+        self.logger.info('Reusing the result of %s for identical job %s.',
+                         result.get('job'), training_hash)
+        fields = {k: v for k, v in result.items() if k != 'job'}
+        self.jobs.mark_done(training_hash, cached_from=result.get('job'),
+                            **fields)
+        return True
+
+    def cache_result(self, training_hash, fingerprint):
+        """Index the result of a completed job under its fingerprint."""
+        try:
+            job = self.jobs.get_job(training_hash)
+            fields = {k: job[k] for k in self.cached_fields if k in job}
+            self.jobs.cache_result(fingerprint, job=training_hash, **fields)
+        except Exception as err:  # pylint: disable=broad-except
+            # the job itself succeeded, so do not mark it as failed
+            self.logger.warning('Encountered %s while caching the result of '
+                                '%s: %s', type(err).__name__, training_hash,
+                                err)
+
+    def next_job(self, keys=None):
+        """Returns the next job to train and its dataset, if prefetched.
+
+        Args:
+            keys: announced job keys to try instead of scanning all jobs
+        """
+        if self.prefetcher is not None:
+            key, local_path = self.prefetcher.take()
+            if key is not None:
+                return key, local_path
+        return self.jobs.claim_next(self.status, 'downloading',
+                                    keys=keys), None
+
+    def join_next(self, keys=None):
+        """Join a distributed job that is waiting for participants.
+
+        Args:
+            keys: announced job keys to try instead of scanning all jobs
+
+        Returns:
+            key of the joined job and this worker's rank, or (None, None)
+        """
+        address = distributed.get_address(self.worker_host)
+        return self.jobs.join_next(address, keys=keys)
+
+    def gather(self, training_hash, hash_values):
+        """Become the chief of a claimed distributed job and invite others.
+
+        Returns:
+            the chief's rank
+        """
+        address = distributed.get_address(self.worker_host)
+        model_name = self.get_model_name(
+            hash_values.get('file_name').rstrip('/'), hash_values)
+        self.jobs.set_status(training_hash, distributed.GATHERING,
+                             model=model_name,
+                             rendezvous=address, ranks=1, worker_0=address)
+        self.jobs.publish(training_hash)
+        self.logger.info('Waiting for %s workers to join %s at %s.',
+                         distributed.get_num_workers(hash_values) - 1,
+                         training_hash, address)
+        return 0
+
+    def wait_for_jobs(self):
+        """Wait until a job may be available.
+
+        Returns:
+            list of announced job keys, or None if all jobs should be scanned
+        """
+        if self.listener is None:
+            self._stop.wait(self.interval)
+            return None
+        return self.listener.wait(self.interval)
+
+    def process(self, training_hash, local_path=None, rank=None):
+        """Download the dataset and train a single job.
+
+        Args:
+            training_hash: key of the claimed job hash
+            local_path: path to the dataset if it was already downloaded
+            rank: this worker's rank if it joined a distributed job
+
+        Returns:
+            True if the job finished successfully, otherwise False
+        """
+        hash_values = self.jobs.get_job(training_hash)
+        filepath = hash_values.get('file_name')
+        num_workers = distributed.get_num_workers(hash_values)
+        rendezvous = None
+        job_dir = None
+        fingerprint = None
+        storage_stats = collections.Counter(self.storage_client.stats)
+        try:
+            # distributed jobs train a different model, so their results
+            # are neither cached nor served from the cache
+            if self.cache_results and num_workers == 1:
+                digest = self.get_dataset_digest(filepath)
+                if digest is not None:
+                    fingerprint = self.get_fingerprint(digest, hash_values)
+                    if self.use_cached_result(
+                            training_hash, fingerprint, hash_values):
+                        return True
+
+            if num_workers > 1:
+                if rank is None:
+                    # fail before anyone else joins
+                    distributed.check_supported(**hash_values)
+                    rank = self.gather(training_hash, hash_values)
+                rendezvous = distributed.Rendezvous(
+                    self.jobs, training_hash, rank, num_workers,
+                    timeout=self.rendezvous_timeout)
+
+            if local_path is None:
+                if rendezvous is None:
+                    self.jobs.set_status(training_hash, 'downloading')
+                # Download outside of a temporary directory so that an
+                # interrupted download is resumed instead of restarted.
+                local_path = self.storage_client.download_dataset(
+                    filepath,
+                    _get_download_dir(self.download_dir, training_hash))
+
+            if self.cache_results and fingerprint is None and \
+                    rendezvous is None:
+                digest = self.get_dataset_digest(filepath, local_path)
+                fingerprint = self.get_fingerprint(digest, hash_values)
+                if self.use_cached_result(
+                        training_hash, fingerprint, hash_values):
+                    return True
+
+            executor = self.executor
+            if rendezvous is None:
+                model_name = self.get_model_name(local_path, hash_values)
+                kwargs, job_dir = self.get_notebook_kwargs(
+                    model_name, hash_values)
+                make_notebook = self.make_notebook or utils.make_notebook
+                notebook_path = make_notebook(local_path, **kwargs)
+                if self.placement is not None:
+                    cpu.configure_notebook(notebook_path)
+            else:
+                # wait until every participant has joined and has the data
+                job = rendezvous.barrier('ready')
+                model_name = job['model']
+                kwargs, job_dir = self.get_notebook_kwargs(
+                    model_name, hash_values, rank)
+                make_script = self.make_script or distributed.make_script
+                notebook_path = make_script(
+                    local_path, rendezvous.get_tf_config(job), **kwargs)
+                executor = self.distributed_executor
+
+            if not rank:
+                fields = {}
+                if job_dir is None:
+                    fields['export_path'] = '{}/{}'.format(
+                        settings.EXPORT_DIR, model_name)
+                self.jobs.mark_training(training_hash, model_name, **fields)
+
+                self.logger.debug('Updated model %s status to "training"',
+                                  model_name)
+
+            if self.prefetcher is not None and not self.stopped:
+                self.prefetcher.start()
+
+            job_governor = governor.ResourceGovernor.from_hash(
+                hash_values, scratch_dir=job_dir or settings.NOTEBOOK_DIR,
+                placement=self.placement)
+
+            executor(notebook_path, job_governor)
+
+            if rank:
+                # the chief uploads the results and finishes the job
+                self.logger.info('Finished training %s as rank %s.',
+                                 training_hash, rank)
+                return True
+
+            if self.should_optimize(hash_values):
+                self.optimize_export(training_hash, model_name, local_path,
+                                     hash_values, job_dir)
+
+            if job_dir is not None:
+                self.upload_artifacts(training_hash, job_dir)
+
+            self.jobs.mark_done(training_hash)
+
+            if fingerprint is not None:
+                self.cache_result(training_hash, fingerprint)
+            return True
+
+        except distributed.RendezvousError as err:
+            self.logger.warning('Could not train %s: %s', training_hash, err)
+            # let other workers gather the job rather than fail it, unless
+            # another participant already put it back or reported an outcome
+            if self.jobs.requeue(training_hash, distributed.GATHERING,
+                                 self.status,
+                                 fields=distributed.CLUSTER_FIELDS,
+                                 prefixes=distributed.CLUSTER_PREFIXES):
+                self.logger.info('Put %s back in the queue.', training_hash)
+                self.jobs.publish(training_hash)
+            return False
+
+        except governor.ResourceLimitExceeded as err:
+            self.logger.error('Terminated %s: %s', training_hash, err)
+            self.jobs.mark_failed(training_hash, err, limit=err.limit)
+            return False
+
+        except Exception as err:  # pylint: disable=broad-except
+            self.logger.error('Encountered %s during training: %s',
+                              type(err).__name__, err)
+            self.jobs.mark_failed(training_hash, err)
+            return False
+
+        finally:
+            _remove(local_path)
+            _remove(os.path.join(self.download_dir, training_hash))
+            if job_dir is not None:
+                shutil.rmtree(job_dir, ignore_errors=True)
+            self.log_storage_stats(training_hash, storage_stats)
+
+    def run(self, forever=settings.RUN_FOREVER):
+        """Train jobs until there are none left or the worker is stopped.
+
+        Args:
+            forever: if True, wait for new jobs instead of exiting
+
+        Returns:
+            True if every processed job finished successfully
+        """
+        success = True
+        keys = None
+        if forever and self.listener is not None:
+            self.listener.start()
+        try:
+            while not self.stopped:
+                try:
+                    # distributed jobs waiting for participants come first
+                    training_hash, rank = self.join_next(keys)
+                    local_path = None
+                    if training_hash is None:
+                        training_hash, local_path = self.next_job(keys)
+                except job_store.TRANSIENT_ERRORS as err:
+                    # claims are not retried, so rescan after a pause
+                    if not forever:
+                        raise err
+                    self.logger.warning('Encountered %s while claiming a job: '
+                                        '%s.  Backing off for %s seconds...',
+                                        type(err).__name__, err,
+                                        self.jobs.backoff)
+                    self._stop.wait(self.jobs.backoff)
+                    keys = None
+                    continue
+                if training_hash is None:
+                    if not forever:
+                        # could not find a hash with status == STATUS
+                        break
+                    keys = self.wait_for_jobs()
+                    continue
+                keys = None
+
+                success = self.process(
+                    training_hash, local_path, rank) and success
+
+                if not forever:
+                    break
+        finally:
+            if self.listener is not None:
+                self.listener.stop()
+            if self.prefetcher is not None:
+                self.prefetcher.release()
+        return success
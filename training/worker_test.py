@@ -0,0 +1,795 @@
+# Copyright 2016-2018 The Van Valen Lab at the California Institute of
+# Technology (Caltech), with support from the Paul Allen Family Foundation,
+# Google, & National Institutes of Health (NIH) under Grant U24CA224309-01.
+# All rights reserved.
+#
+# Licensed under a modified Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.github.com/vanvalenlab/kiosk-training/LICENSE
+#
+# The Work provided may be used for non-commercial academic purposes only.
+# For any other use of the Work, including commercial use, please contact:
+# vanvalenlab@gmail.com
+#
+# Neither the name of Caltech nor the names of its contributors may be used
+# to endorse or promote products derived from this software without specific
+# prior written permission.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Tests for the training Worker"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import tempfile
+import threading
+import time
+
+from training import checksum
+from training import cpu
+from training import dispatch
+from training import distributed
+from training import governor
+from training import job_store
+from training import optimize
+from training import settings
+from training import storage
+from training import utils
+from training import worker
+
+
+class DummyStorage(object):
+
+    def __init__(self, files):
+        self.files = files
+        self.downloads = []
+        self.stats = collections.Counter()
+
+    def get_object_info(self, filepath):
+        return len(self.files[filepath]), {}
+
+    def get_dataset_size(self, filepath):
+        return self.get_object_info(filepath)[0]
+
+    def get_content_id(self, filepath):
+        return storage.Storage.get_content_id(self, filepath)
+
+    def download_dataset(self, filepath, download_dir=None):
+        self.downloads.append(filepath)
+        if filepath.endswith('/'):
+            dest = os.path.join(download_dir, filepath.split('/')[-2])
+            os.makedirs(dest)
+            for key, content in self.files.items():
+                if key.startswith(filepath):
+                    with open(os.path.join(dest, key[len(filepath):]),
+                              'wb') as f:
+                        f.write(content)
+            return dest
+        if filepath not in self.files:
+            raise Exception('{} does not exist'.format(filepath))
+        dest = os.path.join(download_dir, os.path.basename(filepath))
+        with open(dest, 'wb') as f:
+            f.write(self.files[filepath])
+        return dest
+
+
+def _make_notebook(data, **kwargs):
+    assert os.path.exists(data)
+    output_dir = kwargs.get('output_dir', settings.NOTEBOOK_DIR)
+    return os.path.join(output_dir, '{}.ipynb'.format(kwargs['model_name']))
+
+
+def _setup(redis_client, monkeypatch, num_jobs=2):
+    monkeypatch.setattr(utils, 'make_notebook', _make_notebook)
+    files = {}
+    for i in range(num_jobs):
+        filepath = 'uploads/data_{}.npz'.format(i)
+        files[filepath] = str(i).encode() * 10
+        redis_client.hmset('train_{}'.format(i), {
+            'status': 'new',
+            'file_name': filepath,
+        })
+    jobs = job_store.JobStore(redis_client, prefix='train', backoff=0)
+    return jobs, DummyStorage(files)
+
+
+class TestPrefetcher(object):
+
+    def test_prefetch(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch)
+        with tempfile.TemporaryDirectory() as tempdir:
+            prefetcher = worker.Prefetcher(jobs, stg, tempdir, max_bytes=100)
+            prefetcher.start()
+            key, local_path = prefetcher.take()
+            assert redis_client.hget(key, 'status') == 'prefetching'
+            assert os.path.exists(local_path)
+
+            # nothing reserved after take()
+            assert prefetcher.take() == (None, None)
+
+    def test_budget(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch)
+        with tempfile.TemporaryDirectory() as tempdir:
+            prefetcher = worker.Prefetcher(jobs, stg, tempdir, max_bytes=5)
+            prefetcher.start()
+            assert prefetcher.take() == (None, None)
+            assert not stg.downloads
+            for i in range(2):
+                key = 'train_{}'.format(i)
+                assert redis_client.hget(key, 'status') == 'new'
+
+    def test_release(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        with tempfile.TemporaryDirectory() as tempdir:
+            prefetcher = worker.Prefetcher(jobs, stg, tempdir, max_bytes=100)
+            prefetcher.start()
+            prefetcher._thread.join()
+            local_path = prefetcher.local_path
+            assert os.path.exists(local_path)
+
+            prefetcher.release()
+            assert redis_client.hget('train_0', 'status') == 'new'
+            assert not os.path.exists(local_path)
+            assert prefetcher.take() == (None, None)
+
+            # nothing is reserved once closed
+            prefetcher.close()
+            prefetcher.take()
+            prefetcher.start()
+            assert prefetcher.take() == (None, None)
+            assert redis_client.hget('train_0', 'status') == 'new'
+
+    def test_release_during_claim(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        claim_next = jobs.claim_next
+
+        def release_while_claiming(*args, **kwargs):
+            key = claim_next(*args, **kwargs)
+            prefetcher.release()
+            return key
+
+        jobs.claim_next = release_while_claiming
+        with tempfile.TemporaryDirectory() as tempdir:
+            prefetcher = worker.Prefetcher(jobs, stg, tempdir, max_bytes=100)
+            prefetcher.start()
+            assert prefetcher.take() == (None, None)
+            assert redis_client.hget('train_0', 'status') == 'new'
+            assert not stg.downloads
+
+    def test_release_during_download(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        download_dataset = stg.download_dataset
+
+        def release_while_downloading(*args, **kwargs):
+            local_path = download_dataset(*args, **kwargs)
+            prefetcher.release()
+            return local_path
+
+        stg.download_dataset = release_while_downloading
+        with tempfile.TemporaryDirectory() as tempdir:
+            prefetcher = worker.Prefetcher(jobs, stg, tempdir, max_bytes=100)
+            prefetcher.start()
+            assert prefetcher.take() == (None, None)
+            assert redis_client.hget('train_0', 'status') == 'new'
+            # the finished download is not left behind
+            assert stg.downloads
+            assert not os.listdir(tempdir)
+
+    def test_download_error(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        stg.files = {}
+        stg.get_dataset_size = lambda *_: 0
+        with tempfile.TemporaryDirectory() as tempdir:
+            prefetcher = worker.Prefetcher(jobs, stg, tempdir, max_bytes=100)
+            prefetcher.start()
+            # the job is still handed over, to be downloaded again
+            assert prefetcher.take() == ('train_0', None)
+
+
+class TestWorker(object):
+
+    def test_run(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=3)
+        executed = []
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            def executor(notebook_path, _):
+                # the next job is downloaded while this one trains
+                executed.append(notebook_path)
+                if len(executed) == 1:
+                    trainer.prefetcher._thread.join()
+                    assert len(stg.downloads) == 2
+                if len(executed) == 3:
+                    trainer.stop()
+
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    download_dir=tempdir, prefetch=True,
+                                    interval=0)
+            assert trainer.run(forever=True)
+            assert len(executed) == 3
+            assert len(stg.downloads) == 3
+            for i in range(3):
+                key = 'train_{}'.format(i)
+                assert redis_client.hget(key, 'status') == 'done'
+            # downloaded datasets are cleaned up
+            assert not os.listdir(tempdir)
+
+    def test_run_same_dataset(self, redis_client, monkeypatch):
+        # the prefetched dataset is not removed with the current one
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=2)
+        redis_client.hset('train_1', 'file_name', 'uploads/data_0.npz')
+        executed = []
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            def executor(notebook_path, _):
+                executed.append(notebook_path)
+                if len(executed) == 1:
+                    trainer.prefetcher._thread.join()
+                else:
+                    trainer.stop()
+
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    download_dir=tempdir, prefetch=True,
+                                    cache_results=False, interval=0)
+            assert trainer.run(forever=True)
+            assert stg.downloads == ['uploads/data_0.npz'] * 2
+            for i in range(2):
+                key = 'train_{}'.format(i)
+                assert redis_client.hget(key, 'status') == 'done'
+            assert not os.listdir(tempdir)
+
+    def test_run_once(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch)
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg, executor=lambda *_: None,
+                                    download_dir=tempdir, prefetch=False)
+            assert trainer.run(forever=False)
+            statuses = sorted(redis_client.hget('train_{}'.format(i), 'status')
+                              for i in range(2))
+            assert statuses == ['done', 'new']
+
+            # no jobs left
+            redis_client.hmset('train_1', {'status': 'done'})
+            assert trainer.run(forever=False)
+
+    def test_run_transient_error(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        claim_next = jobs.claim_next
+        errors = [job_store.TRANSIENT_ERRORS[0]('connection lost')]
+
+        def flaky_claim_next(*args, **kwargs):
+            if errors:
+                raise errors.pop()
+            return claim_next(*args, **kwargs)
+
+        monkeypatch.setattr(jobs, 'claim_next', flaky_claim_next)
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg,
+                                    executor=lambda *_: trainer.stop(),
+                                    download_dir=tempdir, prefetch=False,
+                                    interval=0)
+            # the worker survives and claims the job once redis is back
+            assert trainer.run(forever=True)
+            assert not errors
+            assert redis_client.hget('train_0', 'status') == 'done'
+
+    def test_stop_releases_prefetched_job(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch)
+        with tempfile.TemporaryDirectory() as tempdir:
+            def executor(*_):
+                trainer.prefetcher._thread.join()
+                trainer.stop()
+
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    download_dir=tempdir, prefetch=True)
+            assert trainer.run(forever=True)
+            statuses = sorted(redis_client.hget('train_{}'.format(i), 'status')
+                              for i in range(2))
+            assert statuses == ['done', 'new']
+
+    def test_stop_releases_before_job_ends(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch)
+        statuses = []
+        with tempfile.TemporaryDirectory() as tempdir:
+            def executor(*_):
+                trainer.prefetcher._thread.join()
+                trainer.stop()
+                trainer._stopping.join()
+                # released while the current job is still training
+                statuses.extend(redis_client.hget('train_{}'.format(i),
+                                                  'status') for i in range(2))
+
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    download_dir=tempdir, prefetch=True)
+            assert trainer.run(forever=True)
+            assert sorted(statuses) == ['new', 'training']
+
+    def test_stop_in_signal_handler(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch)
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg, download_dir=tempdir,
+                                    prefetch=True)
+            trainer.prefetcher.start()
+            trainer.prefetcher._thread.join()
+            # the signal may interrupt the main thread holding the lock
+            with trainer.prefetcher._lock:
+                trainer.stop()
+                assert trainer.stopped
+            trainer._stopping.join()
+            statuses = [redis_client.hget('train_{}'.format(i), 'status')
+                        for i in range(2)]
+            assert statuses == ['new', 'new']
+
+    def test_event_dispatch(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch)
+        redis_client.hset('train_1', 'status', 'held')
+        listener = dispatch.JobListener(jobs, timeout=0.05)
+        executed = []
+
+        def executor(notebook_path, _):
+            executed.append(notebook_path)
+            if len(executed) == 2:
+                trainer.stop()
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            # the sweep interval is longer than the test may take
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    download_dir=tempdir, prefetch=False,
+                                    interval=60, listener=listener)
+            thread = threading.Thread(target=trainer.run, args=(True,))
+            thread.daemon = True
+            thread.start()
+
+            deadline = time.time() + 10
+            while time.time() < deadline and not (
+                    redis_client.subscribers and
+                    redis_client.hget('train_0', 'status') == 'done'):
+                time.sleep(0.01)
+
+            # the idle worker wakes up as soon as the job is published
+            redis_client.hset('train_1', 'status', 'new')
+            jobs.publish('train_1')
+            thread.join(10)
+            assert not thread.is_alive()
+            assert redis_client.hget('train_1', 'status') == 'done'
+            assert not redis_client.subscribers
+
+    def test_sharded_dataset(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        stg.files = {'uploads/shards/fov_{}.npz'.format(i): b'x' * 10
+                     for i in range(3)}
+        redis_client.hset('train_0', 'file_name', 'uploads/shards/')
+        datasets = []
+
+        def make_notebook(data, **kwargs):
+            datasets.append(sorted(os.listdir(data)))
+            return _make_notebook(data, **kwargs)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg, executor=lambda *_: None,
+                                    download_dir=tempdir, prefetch=False,
+                                    cache_results=True,
+                                    make_notebook=make_notebook)
+            assert trainer.run(forever=False)
+            # the notebook is given the directory of shards
+            assert datasets == [['fov_0.npz', 'fov_1.npz', 'fov_2.npz']]
+            job = redis_client.hgetall('train_0')
+            assert job['status'] == 'done'
+            assert '_shards_' in job['model']
+            # the directory is removed after training
+            assert not os.listdir(tempdir)
+
+    def test_optimize_export(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=3)
+        redis_client.hset('train_1', 'quantization', 'int8')
+        redis_client.hset('train_2', 'optimize_export', 'false')
+        calls, uploads = [], []
+
+        def optimize_export(export_dir, output_dir, calibration_data,
+                            quantization):
+            calls.append((export_dir, quantization))
+            os.makedirs(output_dir)
+            if quantization == 'int8':
+                raise ValueError('thrown-on-purpose')
+            return {'quantization': quantization}
+
+        monkeypatch.setattr(optimize, 'optimize_export', optimize_export)
+        monkeypatch.setattr(optimize, 'load_calibration_data',
+                            lambda path: None)
+        stg.upload_tree = lambda directory, prefix: uploads.append(
+            (sorted(os.listdir(directory)), prefix))
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg, executor=lambda *_: None,
+                                    download_dir=tempdir, prefetch=False,
+                                    cache_results=False, optimize=True,
+                                    quantization='float16')
+            for _ in range(3):
+                assert trainer.run(forever=False)
+
+            job = redis_client.hgetall('train_0')
+            assert job['status'] == 'done'
+            assert job['benchmark'] == '{"quantization": "float16"}'
+            assert job['optimized_export'] == '{}/{}_optimized'.format(
+                settings.EXPORT_DIR, job['model'])
+            assert uploads == [(['benchmark.json'], '{}/{}_optimized'.format(
+                settings.EXPORT_PREFIX, job['model']))]
+            # the export was downloaded to be optimized
+            assert stg.downloads[1] == '{}/{}/'.format(
+                settings.EXPORT_PREFIX, job['model'])
+
+            # a failed optimization does not fail the job
+            job = redis_client.hgetall('train_1')
+            assert job['status'] == 'done'
+            assert job['optimize_error'] == 'thrown-on-purpose'
+            assert 'benchmark' not in job
+
+            # jobs can opt out
+            assert len(calls) == 2
+            assert 'benchmark' not in redis_client.hgetall('train_2')
+            assert not os.listdir(tempdir)
+
+    def test_optimize_packaged_export(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        uploads = []
+
+        def optimize_export(export_dir, output_dir, *_):
+            assert os.listdir(export_dir) == ['1']
+            os.makedirs(output_dir)
+            return {}
+
+        monkeypatch.setattr(optimize, 'optimize_export', optimize_export)
+
+        def upload_archive(directory, subdir=None, compression=None):
+            uploads.append(sorted(os.listdir(os.path.join(directory,
+                                                          'models'))))
+            return 'output/artifacts/x.tar.gz', 'url', []
+
+        stg.upload_archive = upload_archive
+
+        def executor(notebook_path, _):
+            os.makedirs(os.path.join(os.path.dirname(notebook_path),
+                                     'models', '1'))
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    download_dir=tempdir, prefetch=False,
+                                    package_artifacts=True, optimize=True)
+            monkeypatch.setattr(settings, 'NOTEBOOK_DIR', tempdir)
+            assert trainer.run(forever=False)
+            job = redis_client.hgetall('train_0')
+            # the variant is archived with the original export
+            name = '{}_optimized'.format(job['model'])
+            assert job['optimized_export'] == 'models/{}'.format(name)
+            assert uploads == [['1', name]]
+
+    def test_process_failure(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+
+        def executor(*_):
+            raise ValueError('thrown-on-purpose')
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    download_dir=tempdir, prefetch=False)
+            assert not trainer.run(forever=False)
+            job = redis_client.hgetall('train_0')
+            assert job['status'] == 'failed'
+            assert job['reason'] == 'thrown-on-purpose'
+            assert not os.listdir(tempdir)
+
+    def test_package_artifacts(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        redis_client.hset('train_0', 'export_dir', 'gs://elsewhere')
+        uploads = []
+
+        def upload_archive(directory, subdir=None, compression=None):
+            uploads.append(sorted(os.listdir(directory)))
+            return 'output/artifacts/x.tar.gz', 'url', [['a', 1]]
+
+        stg.upload_archive = upload_archive
+
+        def executor(notebook_path, job_governor):
+            assert job_governor.scratch_dir == os.path.dirname(notebook_path)
+            # the notebook writes its export and logs to the job directory
+            job_dir = os.path.dirname(notebook_path)
+            for name in ('models', 'logs'):
+                os.makedirs(os.path.join(job_dir, name))
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            monkeypatch.setattr(settings, 'NOTEBOOK_DIR', tempdir)
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    download_dir=tempdir, prefetch=False,
+                                    package_artifacts=True)
+            kwargs, job_dir = trainer.get_notebook_kwargs(
+                'model', jobs.get_job('train_0'))
+            assert kwargs['export_dir'] == os.path.join(job_dir, 'models')
+
+            assert trainer.run(forever=False)
+            assert uploads == [['logs', 'models']]
+            job = redis_client.hgetall('train_0')
+            assert job['status'] == 'done'
+            assert job['artifacts'] == 'output/artifacts/x.tar.gz'
+            assert json.loads(job['artifacts_manifest']) == [['a', 1]]
+            # the job directory is removed after uploading
+            assert not os.listdir(tempdir)
+
+    def test_cached_result(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        executed = []
+
+        def executor(notebook_path, _):
+            executed.append(notebook_path)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    download_dir=tempdir, prefetch=False,
+                                    cache_results=True)
+            assert trainer.run(forever=False)
+            first = redis_client.hgetall('train_0')
+            assert len(executed) == 1
+
+            # resubmit the same dataset with equivalent parameters
+            redis_client.hmset('train_1', {
+                'status': 'new',
+                'file_name': 'uploads/data_0.npz',
+                'epochs': '10',
+            })
+            assert trainer.run(forever=False)
+            second = redis_client.hgetall('train_1')
+            assert len(executed) == 1
+            assert second['status'] == 'done'
+            assert second['model'] == first['model']
+            assert second['export_path'] == first['export_path']
+            assert second['cached_from'] == 'train_0'
+
+            # the cloud checksum is used before downloading
+            stg.get_object_info = lambda _: (10, {
+                'md5': checksum.file_digest(__file__)})
+            stg.downloads = []
+            redis_client.hmset('train_2', {
+                'status': 'new',
+                'file_name': 'uploads/data_0.npz',
+            })
+            assert trainer.run(forever=False)
+            assert len(executed) == 2
+            assert len(stg.downloads) == 1
+            redis_client.hmset('train_3', {
+                'status': 'new',
+                'file_name': 'uploads/data_0.npz',
+            })
+            assert trainer.run(forever=False)
+            assert len(executed) == 2
+            assert not stg.downloads[1:]
+
+            # users can opt out
+            redis_client.hmset('train_4', {
+                'status': 'new',
+                'file_name': 'uploads/data_0.npz',
+                'force_retrain': 'true',
+            })
+            assert trainer.run(forever=False)
+            assert len(executed) == 3
+            assert 'cached_from' not in redis_client.hgetall('train_4')
+
+            # an optimized export is a different result, and one that could
+            # not be built is not reused
+            monkeypatch.setattr(optimize, 'optimize_export', None)
+            for i in (5, 6):
+                redis_client.hmset('train_{}'.format(i), {
+                    'status': 'new',
+                    'file_name': 'uploads/data_0.npz',
+                    'optimize_export': 'true',
+                })
+                assert trainer.run(forever=False)
+                job = redis_client.hgetall('train_{}'.format(i))
+                assert 'cached_from' not in job
+                assert 'optimize_error' in job
+            assert len(executed) == 5
+
+    def test_dataset_digest(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        stg.get_object_info = lambda _: (10, {'md5': b'x' * 16})
+        trainer = worker.Worker(jobs, stg, prefetch=False)
+        assert trainer.get_dataset_digest('uploads/data.npz') == '78' * 16
+        # large S3 uploads have no MD5 but are identified all the same
+        stg.get_content_id = lambda _: 'etag:abc-2:10'
+        assert trainer.get_dataset_digest('uploads/data.npz') == \
+            'etag:abc-2:10'
+        # manifests and prefixes are hashed once downloaded
+        manifest = 'uploads/data{}'.format(settings.MANIFEST_SUFFIX)
+        assert trainer.get_dataset_digest(manifest) is None
+        assert trainer.get_dataset_digest('uploads/data/') is None
+        with tempfile.TemporaryDirectory() as tempdir:
+            assert trainer.get_dataset_digest('uploads/data/', tempdir)
+
+    def test_placement(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        cells = []
+
+        def make_notebook(data, **kwargs):
+            path = _make_notebook(data, **kwargs)
+            with open(path, 'w') as f:
+                json.dump({'cells': []}, f)
+            return path
+
+        def executor(notebook_path, job_governor):
+            assert job_governor.placement is placement
+            with open(notebook_path) as f:
+                cells.extend(json.load(f)['cells'])
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            monkeypatch.setattr(settings, 'NOTEBOOK_DIR', tempdir)
+            placement = cpu.CPUPlacement(2)
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    make_notebook=make_notebook,
+                                    download_dir=tempdir, prefetch=False,
+                                    placement=placement)
+            assert trainer.run(forever=False)
+        # the notebook sizes the thread pools of older TensorFlow builds
+        assert ''.join(cells[0]['source']) == cpu.THREADING_CELL
+
+    def test_resource_limit(self, redis_client, monkeypatch):
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        redis_client.hset('train_0', 'max_runtime', '60')
+
+        def executor(_, job_governor):
+            assert job_governor.max_runtime == 60
+            raise governor.ResourceLimitExceeded('max_runtime', 61, 60)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg, executor=executor,
+                                    download_dir=tempdir, prefetch=False)
+            assert not trainer.run(forever=False)
+            job = redis_client.hgetall('train_0')
+            assert job['status'] == 'failed'
+            assert job['limit'] == 'max_runtime'
+            assert job['reason'] == 'Exceeded max_runtime: 61 > 60'
+
+    def test_distributed(self, redis_client, monkeypatch):
+        monkeypatch.setattr(distributed, 'get_tensorflow_version',
+                            lambda: (2, 4))
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        redis_client.hmset('train_0', {'num_workers': '3',
+                                       'transform': 'fgbg'})
+        scripts, executed = [], []
+
+        def make_script(data, tf_config, **kwargs):
+            assert os.path.exists(data)
+            scripts.append((tf_config, kwargs))
+            return 'script_{}.py'.format(tf_config['task']['index'])
+
+        def executor(script_path, _):
+            # nobody trains before every participant is ready
+            assert redis_client.hget('train_0', 'barrier_ready') == '3'
+            executed.append(script_path)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            threads = []
+            for i in range(3):
+                download_dir = os.path.join(tempdir, str(i))
+                os.makedirs(download_dir)
+                trainer = worker.Worker(jobs, stg, executor=None,
+                                        distributed_executor=executor,
+                                        make_script=make_script,
+                                        download_dir=download_dir,
+                                        prefetch=False, worker_host='host')
+                threads.append(threading.Thread(target=trainer.run,
+                                                args=(False,)))
+            threads[0].start()
+            while redis_client.hget('train_0', 'status') != 'gathering':
+                time.sleep(0.01)
+            for thread in threads[1:]:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+
+        job = redis_client.hgetall('train_0')
+        assert job['status'] == 'done'
+        assert sorted(executed) == ['script_0.py', 'script_1.py',
+                                    'script_2.py']
+        assert job['rendezvous'] == job['worker_0']
+        assert sorted(t['task']['index'] for t, _ in scripts) == [0, 1, 2]
+        cluster = [job['worker_{}'.format(i)] for i in range(3)]
+        assert all(a.startswith('host:') for a in cluster)
+        for tf_config, kwargs in scripts:
+            assert tf_config['cluster'] == {'worker': cluster}
+            assert kwargs['model_name'] == job['model']
+
+    def test_distributed_timeout(self, redis_client, monkeypatch):
+        monkeypatch.setattr(distributed, 'get_tensorflow_version',
+                            lambda: (2, 4))
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        redis_client.hmset('train_0', {'num_workers': '2',
+                                       'transform': 'fgbg'})
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg, executor=None,
+                                    distributed_executor=None,
+                                    download_dir=tempdir, prefetch=False,
+                                    worker_host='host',
+                                    rendezvous_timeout=0.05)
+            assert not trainer.run(forever=False)
+            # put back for other workers to gather
+            job = redis_client.hgetall('train_0')
+            assert job['status'] == 'new'
+            assert not [name for name in job
+                        if name in ('ranks', 'rendezvous', 'model') or
+                        name.startswith(('worker_', 'barrier_'))]
+            # nobody may join it until it is gathered again
+            assert jobs.join('train_0', 'host:1') is None
+
+    def test_distributed_chiefs(self, redis_client, monkeypatch):
+        # two chiefs waiting for each other must not deadlock
+        monkeypatch.setattr(distributed, 'get_tensorflow_version',
+                            lambda: (2, 4))
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=2)
+        for key in ('train_0', 'train_1'):
+            redis_client.hmset(key, {'num_workers': '2',
+                                     'transform': 'fgbg'})
+
+        def chief(trainer, key):
+            trainer.process(key)
+            trainer.run(forever=True)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainers, threads = [], []
+            for i, timeout in enumerate((0.5, 10)):
+                download_dir = os.path.join(tempdir, str(i))
+                os.makedirs(download_dir)
+                trainers.append(worker.Worker(
+                    jobs, stg, executor=None,
+                    distributed_executor=lambda *_: None,
+                    make_script=lambda *_, **__: 'script.py',
+                    download_dir=download_dir, prefetch=False,
+                    worker_host='host', interval=0.01,
+                    rendezvous_timeout=timeout))
+                # each claims a job of its own
+                key = 'train_{}'.format(i)
+                assert jobs.claim(key, 'new', 'downloading')
+                threads.append(threading.Thread(
+                    target=chief, args=(trainers[-1], key)))
+                threads[-1].start()
+
+            # the first to time out puts its job back and joins the other
+            deadline = time.time() + 30
+            while time.time() < deadline and any(
+                    redis_client.hget(k, 'status') != 'done'
+                    for k in ('train_0', 'train_1')):
+                time.sleep(0.05)
+            for trainer in trainers:
+                trainer.stop()
+            for thread in threads:
+                thread.join(10)
+
+        assert redis_client.hget('train_0', 'status') == 'done'
+        assert redis_client.hget('train_1', 'status') == 'done'
+
+    def test_distributed_unsupported(self, redis_client, monkeypatch):
+        monkeypatch.setattr(distributed, 'get_tensorflow_version',
+                            lambda: (2, 4))
+        jobs, stg = _setup(redis_client, monkeypatch, num_jobs=1)
+        redis_client.hmset('train_0', {'num_workers': '2',
+                                       'transform': 'watershed'})
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            trainer = worker.Worker(jobs, stg, executor=None,
+                                    distributed_executor=None,
+                                    download_dir=tempdir, prefetch=False,
+                                    worker_host='host', cache_results=True)
+            assert not trainer.run(forever=False)
+            job = redis_client.hgetall('train_0')
+            assert job['status'] == 'failed'
+            assert 'transform' in job['reason']
+            assert 'rendezvous' not in job
+            assert not stg.downloads